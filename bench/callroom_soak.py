@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import os
+import gc
+import sys
+import time
+import socket
+import struct
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retro_server.ServerConfig import ServerConfig
+from retro_server.SessionTable import SessionTable
+from retro_server.AudioServer import AudioServer, CallRoom
+
+"""\
+Soak test of the call registry: Runs many simulated calls
+through the callrooms and the audio relay and reports the
+memory usage, which must stay flat.
+
+Each call goes through the same steps as in AudioServer:
+both participants join the callroom, meet and get ready, the
+call is handed over to the relay, a few bytes are relayed and
+both participants hang up. Every 10th call only one
+participant shows up (rendezvous timeout). The handshake
+threads are replaced by plain objects, the connections by
+socketpairs.
+
+'rooms' and 'relay-calls' must drop to 0 after every batch,
+'callrooms-alive' (CallRoom objects not yet freed) must not
+exceed one batch and the RSS must not grow with the number of
+calls.
+
+  python3 bench/callroom_soak.py --calls 100000
+
+"""
+
+
+class Conn:
+	""" Minimal TCPSocket replacement for the relay """
+	def __init__(self, sock):
+		self.fd = sock
+
+	def close(self):
+		self.fd.close()
+
+
+class Participant:
+	""" Stands in for an AudioTransferThread """
+	def __init__(self, userid, sock):
+		self.userid = userid
+		self.fd     = Conn(sock)
+		self.joined = None
+		self.wait   = 0.0
+		self.done   = False
+
+	def join(self):
+		pass
+
+
+class Server:
+	""" Minimal RetroServer replacement """
+	def __init__(self, conf):
+		self.conf     = conf
+		self.sessions = SessionTable()
+
+	def get_conn_by_address(self, address):
+		return None
+
+
+def get_rss():
+	""" Returns current RSS in MB """
+	try:
+		with open('/proc/self/statm') as f:
+			pages = int(f.read().split()[1])
+		return pages * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+	except OSError:
+		# Peak RSS (KB on Linux)
+		return resource.getrusage(
+			resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_call(aserv, i, clients):
+	"""\
+	Set up call number i, the client ends of the sockets of
+	a started call are appended to clients.
+	"""
+	callid = struct.pack('!QQ', i, i)
+	room = aserv.calls.join(callid)
+
+	if i % 10 == 9:
+		# Nobody else shows up
+		a,b = socket.socketpair()
+		t = Participant(b'A' * 8, b)
+		room.add_caller(t)
+		if not room.wait_partners(t, 0):
+			aserv.setup_timeout()
+			aserv.calls.leave(room)
+		a.close()
+		b.close()
+		return
+
+	parts = []
+	for userid in (b'A' * 8, b'B' * 8):
+		a,b = socket.socketpair()
+		parts.append(Participant(userid, b))
+		clients.append(a)
+	for t in parts:
+		room.add_caller(t)
+	for t in parts:
+		room.wait_partners(t, 0)
+		if room.set_ready(t):
+			aserv.start_call(room)
+
+
+def main():
+	p = argparse.ArgumentParser(description='Soak test of the '\
+		'call registry')
+	p.add_argument('--calls', type=int, default=100000,
+		help='Number of calls')
+	p.add_argument('--batch', type=int, default=200,
+		help='Concurrent calls')
+	p.add_argument('--report', type=int, default=10000,
+		help='Report every n calls')
+	args = p.parse_args()
+
+	conf = ServerConfig(tempfile.mkdtemp())
+	aserv = AudioServer(Server(conf))
+	aserv.relay.start()
+
+	print("calls    rooms  relay-calls  callrooms-alive  rss-MB")
+	t0 = time.monotonic()
+	i = 0
+	while i < args.calls:
+		clients = []
+		for j in range(min(args.batch, args.calls - i)):
+			run_call(aserv, i, clients)
+			i += 1
+
+		# Relay some data, then hang up
+		for sock in clients[::2]:
+			sock.send(b'x' * 160)
+		for sock in clients:
+			sock.close()
+
+		deadline = time.monotonic() + 10
+		while aserv.calls.get_stats()['audio_rooms']\
+		      and time.monotonic() < deadline:
+			time.sleep(0.001)
+
+		if i % args.report == 0 or i == args.calls:
+			gc.collect()
+			alive = sum(1 for o in gc.get_objects()
+					if isinstance(o, CallRoom))
+			print("{:7}  {:5}  {:11}  {:15}  {:6.1f}".format(i,
+				aserv.calls.get_stats()['audio_rooms'],
+				aserv.relay.get_stats()['audio_calls'],
+				alive, get_rss()))
+
+	stats = aserv.get_stats()
+	aserv.relay.stop()
+	print("{} calls in {:.0f} s, setups={} timeouts={}".format(
+		args.calls, time.monotonic() - t0,
+		stats['audio_setups'], stats['audio_setup_timeouts']))
+
+
+if __name__ == '__main__':
+	main()
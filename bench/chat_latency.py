@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+import os
+import sys
+import ssl
+import json
+import time
+import socket
+import argparse
+import logging
+import tempfile
+import threading
+import subprocess
+
+from libretro.protocol import Proto
+from libretro.net import NetClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retro_server.RetroServer import RetroServer
+from retro_server.ClientThread import ClientThread
+from retro_server.FileServer import FileServer, OPT_TOKEN, pack_option
+from retro_server.ServiceProcess import ServiceProcess
+from retro_server.Router import Router
+from retro_server.UploadStore import UploadStore
+
+"""\
+Benchmark of chat latency while file transfers are running,
+with the fileserver running as thread of the chat process
+versus in a process of its own ([fileserver] process).
+
+A RetroServer is set up in a temporary directory (self-signed
+certificate, two users). Its fileserver is started as in
+RetroServer.__start_servers: a FileServer thread, or a
+ServiceProcess and the Router. Two ClientThreads run the chat
+loop (recv_packet, dispatch) on socketpairs, the chat
+handshake is skipped. The clients run in a child process: one
+sends T_CHATMSG to the other, which answers, and the round
+trip time through ClientThread.dispatch/forward_message is
+measured. Meanwhile 'streams' clients repeatedly download a
+test file from the fileserver over TLS.
+
+  none      No file transfers (baseline)
+  thread    FileServer thread in the chat process
+  process   FileServer in a ServiceProcess
+
+Needs the openssl command to create the certificate.
+
+  python3 bench/chat_latency.py --streams 4 --size 256
+
+"""
+
+USER_A = bytes.fromhex('aa' * 8)
+USER_B = bytes.fromhex('bb' * 8)
+FILEID = bytes.fromhex('ff' * 16)
+
+
+def free_port():
+	""" Returns a free TCP port on localhost """
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+def make_server(basedir, mode, args):
+	"""\
+	Create server directory, certificate, users and test
+	file.
+	Return:
+	  RetroServer instance
+	"""
+	for d in ('certs', 'users', 'uploads', 'msg', 'ipc'):
+		os.makedirs(os.path.join(basedir, d), exist_ok=True)
+	subprocess.run(['openssl', 'req', '-x509', '-newkey',
+		'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=bench',
+		'-keyout', os.path.join(basedir, 'certs/key.pem'),
+		'-out', os.path.join(basedir, 'certs/cert.pem')],
+		check=True, stdout=subprocess.DEVNULL,
+		stderr=subprocess.DEVNULL)
+	for userid in (USER_A, USER_B):
+		open(os.path.join(basedir, 'users',
+			userid.hex() + '.pem'), 'w').close()
+
+	serv = RetroServer(basedir)
+	conf = serv.conf
+	conf.server_address = '127.0.0.1'
+	conf.fileserver_enable = mode != 'none'
+	conf.fileserver_port = free_port()
+	conf.fileserver_process = mode == 'process'
+	conf.fileserver_delete_files = False
+	conf.fileserver_sendfile = args.sendfile
+	conf.accept_timeout = 1
+	conf.cluster_node = 'bench'
+
+	store = UploadStore(conf)
+	with open(store.get_path(FILEID), 'wb') as f:
+		block = os.urandom(1 << 20)
+		for i in range(args.size):
+			f.write(block)
+	store.set_complete(FILEID, args.size << 20)
+	return serv
+
+
+def chat_loop(cli):
+	""" Chat loop of ClientThread.start_chatloop """
+	while not cli.done:
+		try:
+			pckt = cli.conn.recv_packet(timeout_sec=1)
+		except Exception:
+			break
+		if pckt == False: continue
+		elif not pckt: break
+		cli.dispatch(pckt)
+
+
+def download(port, token, end, stats):
+	"""\
+	Client: Download the test file over TLS until 'end'.
+	"""
+	ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	ctx.check_hostname = False
+	ctx.verify_mode = ssl.CERT_NONE
+	buf = bytearray(0x10000)
+
+	while time.monotonic() < end:
+		sock = ctx.wrap_socket(socket.create_connection(
+				('127.0.0.1', port)))
+		conn = NetClient()
+		conn.set_conn(sock, sock.getpeername())
+		conn.send_packet(Proto.T_FILE_DOWNLOAD,
+			FILEID + pack_option(OPT_TOKEN, token))
+		pckt = conn.recv_packet(timeout_sec=10)
+		if not pckt or pckt[0] != Proto.T_SUCCESS:
+			stats['errors'] += 1
+			sock.close()
+			break
+
+		size = int.from_bytes(pckt[1][:4], 'big')
+		nrecv = 0
+		while nrecv < size:
+			n = sock.recv_into(buf)
+			if not n: break
+			nrecv += n
+		stats['bytes'] += nrecv
+		sock.close()
+
+
+def run_clients(socks, args, ready, out):
+	"""\
+	Child process: Wait for the token, then run the
+	downloads and measure the chat round trip times.
+	"""
+	go = json.loads(ready.readline())
+	end = time.monotonic() + args.duration
+
+	a = NetClient()
+	a.set_conn(socks[0], ('127.0.0.1', 0))
+	b = NetClient()
+	b.set_conn(socks[1], ('127.0.0.1', 0))
+
+	def echo():
+		while True:
+			pckt = b.recv_packet(timeout_sec=1)
+			if pckt == False: continue
+			elif not pckt: break
+			b.send_packet(Proto.T_CHATMSG,
+				USER_B + USER_A + pckt[1][16:])
+	threading.Thread(target=echo, daemon=True).start()
+
+	stats = {'bytes': 0, 'errors': 0}
+	loaders = [threading.Thread(target=download, args=(go['port'],
+			bytes.fromhex(go['token']), end, stats))
+			for i in range(args.streams if go['port'] else 0)]
+	for t in loaders:
+		t.start()
+
+	rtt = []
+	msg = USER_A + USER_B + b'x' * 64
+	while time.monotonic() < end:
+		t0 = time.monotonic()
+		a.send_packet(Proto.T_CHATMSG, msg)
+		pckt = a.recv_packet(timeout_sec=10)
+		if not pckt:
+			break
+		rtt.append(time.monotonic() - t0)
+		time.sleep(args.interval / 1000)
+
+	# Finish the running downloads
+	for t in loaders:
+		t.join()
+
+	rtt.sort()
+	out.write(json.dumps({
+		'msgs'   : len(rtt),
+		'p50'    : rtt[len(rtt)//2] * 1000 if rtt else 0,
+		'p99'    : rtt[len(rtt)*99//100] * 1000 if rtt else 0,
+		'max'    : rtt[-1] * 1000 if rtt else 0,
+		'mb'     : stats['bytes'] / (1 << 20),
+		'errors' : stats['errors']
+	}))
+	out.close()
+
+
+def bench_mode(mode, args):
+	"""\
+	Measure chat latency in given mode.
+	Return:
+	  Dictionary with the results
+	"""
+	basedir = tempfile.mkdtemp()
+	serv = make_server(basedir, mode, args)
+	pairs = [socket.socketpair() for i in range(2)]
+
+	# Fork the clients and the service process before
+	# any thread is started.
+	r,w = os.pipe()
+	r2,w2 = os.pipe()
+	client = os.fork()
+	if client == 0:
+		os.close(r)
+		os.close(w2)
+		for s,c in pairs:
+			s.close()
+		run_clients([c for s,c in pairs], args,
+			os.fdopen(r2), os.fdopen(w, 'w'))
+		os._exit(0)
+	os.close(w)
+	os.close(r2)
+	for s,c in pairs:
+		c.close()
+
+	if mode == 'process':
+		serv.fileserv = ServiceProcess(serv, 'fileserver',
+				FileServer)
+		serv.fileserv.start()
+		serv.router = Router(serv, serv.conf.cluster_node)
+		if not serv.router.open():
+			raise RuntimeError("router failed")
+		serv.router.start()
+	elif mode == 'thread':
+		serv.fileserv = FileServer(serv)
+		serv.fileserv.start()
+
+	clis = []
+	for (s,c),userid in zip(pairs, (USER_A, USER_B)):
+		conn = NetClient()
+		conn.set_conn(s, ('127.0.0.1', 0))
+		cli = ClientThread(serv, conn)
+		cli.userid = userid
+		serv.add_conn(cli)
+		t = threading.Thread(target=chat_loop, args=(cli,))
+		t.start()
+		clis.append((cli, t))
+
+	# Let the fileserver (and its router) come up before
+	# the token is passed to it.
+	time.sleep(1)
+	token = serv.issue_token(USER_A)
+	with os.fdopen(w2, 'w') as f:
+		f.write(json.dumps({'token': token.hex(),
+			'port': serv.conf.fileserver_port
+				if serv.fileserv else 0}) + '\n')
+
+	with os.fdopen(r) as f:
+		result = json.loads(f.read())
+	os.waitpid(client, 0)
+
+	for cli,t in clis:
+		cli.done = True
+		t.join()
+		serv.remove_conn(cli)
+	for s,c in pairs:
+		s.close()
+	if isinstance(serv.fileserv, ServiceProcess):
+		serv.fileserv.stop()
+	elif serv.fileserv:
+		serv.fileserv.done = True
+		serv.fileserv.join()
+	if serv.router:
+		serv.router.done = True
+	return result
+
+
+def main():
+	p = argparse.ArgumentParser(description='Chat latency while '\
+		'file transfers are running')
+	p.add_argument('--streams', type=int, default=4,
+		help='Concurrent downloads')
+	p.add_argument('--size', type=int, default=256,
+		help='Filesize (MB)')
+	p.add_argument('--duration', type=float, default=5,
+		help='Seconds per mode')
+	p.add_argument('--interval', type=float, default=10,
+		help='Milliseconds between chat messages')
+	p.add_argument('--sendfile', action='store_true',
+		help='Use socket.sendfile for the downloads')
+	p.add_argument('--modes', default='none,thread,process',
+		help='Modes to run (comma separated)')
+	args = p.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	print("mode     msgs   p50-ms  p99-ms  max-ms  download-MB/s")
+	for mode in args.modes.split(','):
+		r = bench_mode(mode, args)
+		if r['errors']:
+			print("{}: {} downloads failed".format(mode,
+				r['errors']))
+		print("{:7}  {:5}  {:6.2f}  {:6.2f}  {:6.2f}  {:13.1f}"\
+			.format(mode, r['msgs'], r['p50'], r['p99'],
+			r['max'], r['mb'] / args.duration))
+
+
+if __name__ == '__main__':
+	main()
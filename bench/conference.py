@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import resource
+import selectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retro_server.AudioRelay import AudioRelay, RelayCall, FrameReader
+
+"""\
+Benchmark of the audio relay: CPU usage and latency versus
+the number of participants per call (room size).
+
+For every room size, 'calls' calls are relayed for 'duration'
+seconds. Every participant sends a chunk of 'chunk' bytes each
+'interval' ms, carrying its send time. The participants run in
+a child process, so the CPU time of this process is the time
+spent by the relay. Two-party calls are relayed as plain byte
+streams, larger rooms as conferences (framed).
+
+  python3 bench/conference.py --sizes 2,3,5,8 --calls 10
+
+"""
+
+TS = struct.Struct('!d')
+
+
+class Conn:
+	""" Minimal TCPSocket replacement for the relay """
+	def __init__(self, sock):
+		self.fd = sock
+
+	def close(self):
+		self.fd.close()
+
+
+def run_participants(socks, args, out):
+	"""\
+	Child process: Send chunks on all sockets and measure
+	the latency of all received chunks.
+	Args:
+	  socks: List of (socket, userid, framed)
+	  args:  Parsed arguments
+	  out:   Pipe to write the result (json) to
+	"""
+	sel = selectors.DefaultSelector()
+	state = {}
+	for sock,userid,framed in socks:
+		sock.setblocking(False)
+		state[sock] = (FrameReader() if framed else None, {})
+		sel.register(sock, selectors.EVENT_READ)
+
+	pad = bytes(args.chunk - TS.size)
+	lat = []
+	interval = args.interval / 1000
+	next_send = time.monotonic()
+	end = next_send + args.duration
+
+	while True:
+		now = time.monotonic()
+		if now >= end:
+			break
+		if now >= next_send:
+			for sock,userid,framed in socks:
+				try:
+					sock.send(TS.pack(time.monotonic()) + pad)
+				except BlockingIOError:
+					pass
+			next_send += interval
+
+		for key,mask in sel.select(max(0, next_send - now)):
+			reader,bufs = state[key.fileobj]
+			try:
+				data = key.fileobj.recv(0x10000)
+			except BlockingIOError:
+				continue
+			if reader:
+				frames = reader.feed(data)
+			else:	frames = [(None, data)]
+
+			# Per sender stream, split into chunks
+			t = time.monotonic()
+			for userid,payload in frames:
+				buf = bufs.get(userid, b'') + payload
+				n = len(buf) // args.chunk * args.chunk
+				for i in range(0, n, args.chunk):
+					lat.append(t - TS.unpack_from(buf, i)[0])
+				bufs[userid] = buf[n:]
+
+	lat.sort()
+	out.write(json.dumps({
+		'chunks' : len(lat),
+		'p50'    : lat[len(lat)//2] * 1000 if lat else 0,
+		'p99'    : lat[len(lat)*99//100] * 1000 if lat else 0
+	}))
+	out.close()
+
+
+def bench_size(size, args):
+	"""\
+	Relay 'calls' calls with 'size' participants each.
+	Return:
+	  Dictionary with the results
+	"""
+	relay = AudioRelay(args.loops, use_splice=False)
+	relay.start()
+
+	framed = size > 2
+	calls  = []
+	client = []
+	for i in range(args.calls):
+		call = RelayCall(struct.pack('!Q', i) * 2, framed=framed)
+		for j in range(size):
+			a,b = socket.socketpair()
+			userid = struct.pack('!II', i, j)
+			call.add_leg(Conn(b), userid)
+			client.append((a, userid, framed))
+		calls.append(call)
+
+	r,w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		for call in calls:
+			for leg in call.legs:
+				leg.sock.close()
+		run_participants(client, args, os.fdopen(w, 'w'))
+		os._exit(0)
+
+	os.close(w)
+	for sock,_,_ in client:
+		sock.close()
+
+	ru0 = resource.getrusage(resource.RUSAGE_SELF)
+	t0  = time.monotonic()
+	for call in calls:
+		relay.add_call(call)
+
+	with os.fdopen(r) as f:
+		result = json.loads(f.read())
+	os.waitpid(pid, 0)
+
+	t1  = time.monotonic()
+	ru1 = resource.getrusage(resource.RUSAGE_SELF)
+	stats = relay.get_stats()
+	relay.stop()
+
+	cpu = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+	result.update({
+		'size'   : size,
+		'cpu'    : 100 * cpu / (t1 - t0),
+		'us_per_chunk' : 1e6 * cpu / result['chunks']\
+				if result['chunks'] else 0,
+		'bytes'  : stats['audio_bytes']
+	})
+	return result
+
+
+def main():
+	p = argparse.ArgumentParser(description='Audio relay CPU '\
+		'and latency versus room size')
+	p.add_argument('--sizes', default='2,3,5,8',
+		help='Room sizes (comma separated)')
+	p.add_argument('--calls', type=int, default=10,
+		help='Concurrent calls per room size')
+	p.add_argument('--duration', type=float, default=5,
+		help='Seconds per room size')
+	p.add_argument('--chunk', type=int, default=160,
+		help='Bytes per chunk')
+	p.add_argument('--interval', type=float, default=20,
+		help='Milliseconds between chunks')
+	p.add_argument('--loops', type=int, default=1,
+		help='Relay loops')
+	args = p.parse_args()
+
+	print("size  calls  relay-cpu%  us/chunk  chunks  p50-ms  p99-ms")
+	for size in [int(s) for s in args.sizes.split(',')]:
+		r = bench_size(size, args)
+		print("{:4}  {:5}  {:10.1f}  {:8.1f}  {:6}  {:6.2f}  {:6.2f}"\
+			.format(r['size'], args.calls, r['cpu'],
+			r['us_per_chunk'], r['chunks'], r['p50'], r['p99']))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retro_server.ServerConfig import ServerConfig
+from retro_server.FileServer import FileTransfer
+
+"""\
+Benchmark of file downloads: Throughput and peak memory (RSS)
+of sending a large file with FileTransfer.send_file.
+
+Every mode runs in a child process of its own, its peak RSS is
+taken from the resource usage of the child. The client reads
+from the other end of a socketpair (no TLS) and discards the
+data.
+
+  read      Whole file read into memory and sent at once
+            (the former implementation, for comparison)
+  chunked   Fixed-size chunks through a reusable buffer
+  sendfile  socket.sendfile (zero-copy)
+
+  python3 bench/download.py --size 1024
+
+"""
+
+
+class Conn:
+	""" Minimal NetClient replacement, send_file uses .conn """
+	def __init__(self, sock):
+		self.conn = sock
+
+
+class Fileserver:
+	""" Minimal FileServer replacement without limits """
+	def __init__(self, conf):
+		self.conf = conf
+
+	def throttle(self, userid, nbytes):
+		pass
+
+	def is_shaped(self):
+		return False
+
+
+def drain(sock, bufsize):
+	""" Read and discard everything from socket """
+	buf = bytearray(bufsize)
+	while sock.recv_into(buf):
+		pass
+
+
+def run_mode(mode, path, size, conf):
+	"""\
+	Child process: Send file in given mode.
+	Return:
+	  Seconds it took
+	"""
+	a,b = socket.socketpair()
+	reader = threading.Thread(target=drain,
+			args=(b, conf.fileserver_chunk_size))
+	reader.start()
+
+	conf.fileserver_sendfile = mode == 'sendfile'
+	transfer = FileTransfer(Fileserver(conf), Conn(a))
+
+	t0 = time.monotonic()
+	with open(path, 'rb') as fin:
+		if mode == 'read':
+			a.sendall(fin.read())
+			nsent = size
+		else:	nsent = transfer.send_file(fin, size)
+	a.shutdown(socket.SHUT_WR)
+	reader.join()
+	t1 = time.monotonic()
+
+	a.close()
+	b.close()
+	if nsent != size:
+		raise RuntimeError("sent {}/{} byte".format(nsent, size))
+	return t1 - t0
+
+
+def main():
+	p = argparse.ArgumentParser(description='Download throughput '\
+		'and peak RSS')
+	p.add_argument('--size', type=int, default=512,
+		help='Filesize (MB)')
+	p.add_argument('--chunk', type=int, default=0x10000,
+		help='Chunk size (byte)')
+	p.add_argument('--modes', default='read,chunked,sendfile',
+		help='Modes to run (comma separated)')
+	p.add_argument('--dir', default=None,
+		help='Directory of the test file')
+	args = p.parse_args()
+
+	conf = ServerConfig(tempfile.mkdtemp())
+	conf.fileserver_chunk_size = args.chunk
+	size = args.size << 20
+
+	fd,path = tempfile.mkstemp(dir=args.dir)
+	with os.fdopen(fd, 'wb') as f:
+		block = os.urandom(1 << 20)
+		for i in range(args.size):
+			f.write(block)
+
+	print("mode      MB/s     peak-RSS-MB")
+	try:
+		for mode in args.modes.split(','):
+			r,w = os.pipe()
+			pid = os.fork()
+			if pid == 0:
+				os.close(r)
+				secs = run_mode(mode, path, size, conf)
+				os.write(w, repr(secs).encode())
+				os._exit(0)
+
+			os.close(w)
+			with os.fdopen(r) as f:
+				out = f.read()
+			_,status,ru = os.wait4(pid, 0)
+			if status or not out:
+				print("{:8}  failed".format(mode))
+				continue
+
+			# ru_maxrss is in KB on Linux
+			print("{:8}  {:7.0f}  {:11.1f}".format(mode,
+				args.size / float(out), ru.ru_maxrss / 1024))
+	finally:
+		os.remove(path)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import queue
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retro_server.ServerConfig import ServerConfig
+from retro_server.FileServer import FileTransfer, OPT_PART, get_part_range
+
+"""\
+Benchmark of chunked transfers: Download throughput versus
+the number of parallel streams over a high-latency link.
+
+The file is split into one part per stream (see
+get_part_range), each part is sent with FileTransfer.send_file
+through a proxy which delays the data by half the round trip
+time and, like a TCP window, lets at most 'window' bytes per
+stream be in flight until they are acknowledged one round
+trip after they were sent. A single stream is thus limited to
+window/rtt. The sockets are socketpairs (no TLS).
+
+  python3 bench/parallel.py --streams 1,2,4,8 --rtt 50
+
+"""
+
+
+class Conn:
+	""" Minimal NetClient replacement, send_file uses .conn """
+	def __init__(self, sock):
+		self.conn = sock
+
+
+class Fileserver:
+	""" Minimal FileServer replacement without limits """
+	def __init__(self, conf):
+		self.conf = conf
+
+	def throttle(self, userid, nbytes):
+		pass
+
+	def is_shaped(self):
+		return False
+
+
+class LatencyProxy:
+	"""\
+	Forwards one stream from 'upstream' to 'downstream'
+	with delay and a limited window.
+	"""
+	def __init__(self, upstream, downstream, rtt, window):
+		self.up      = upstream
+		self.down    = downstream
+		self.delay   = rtt / 2
+		self.window  = window
+		self.inflight = 0
+		self.credits = collections.deque() # (release time, bytes)
+		self.queue   = queue.Queue()       # (deliver time, data)
+		self.cond    = threading.Condition()
+		self.threads = [threading.Thread(target=self.__read),
+				threading.Thread(target=self.__write)]
+
+	def start(self):
+		for t in self.threads:
+			t.start()
+
+	def join(self):
+		for t in self.threads:
+			t.join()
+
+	def __read(self):
+		while True:
+			with self.cond:
+				while True:
+					now = time.monotonic()
+					while self.credits and self.credits[0][0] <= now:
+						self.inflight -= self.credits.popleft()[1]
+					if self.inflight < self.window:
+						break
+					self.cond.wait(self.credits[0][0] - now
+						if self.credits else None)
+				room = self.window - self.inflight
+
+			data = self.up.recv(min(room, 0x10000))
+			if not data:
+				self.queue.put(None)
+				return
+			with self.cond:
+				self.inflight += len(data)
+			self.queue.put((time.monotonic() + self.delay, data))
+
+	def __write(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.down.shutdown(socket.SHUT_WR)
+				return
+			t,data = item
+			wait = t - time.monotonic()
+			if wait > 0:
+				time.sleep(wait)
+			self.down.sendall(data)
+			with self.cond:
+				self.credits.append((t + self.delay, len(data)))
+				self.cond.notify()
+
+
+def drain(sock, result, idx):
+	""" Read and count everything from socket """
+	buf = bytearray(0x10000)
+	total = 0
+	while True:
+		n = sock.recv_into(buf)
+		if not n:
+			break
+		total += n
+	result[idx] = total
+
+
+def bench_streams(nstreams, path, size, args, conf):
+	"""\
+	Download the file in 'nstreams' parts at once.
+	Return:
+	  Seconds it took
+	"""
+	threads = []
+	proxies = []
+	socks   = []
+	received = [0] * nstreams
+
+	def send_part(sock, idx):
+		opts = {OPT_PART: struct.pack('!IIQ', idx, nstreams, size)}
+		_,_,_,offset,length = get_part_range(opts)
+		transfer = FileTransfer(Fileserver(conf), Conn(sock))
+		with open(path, 'rb') as fin:
+			transfer.send_file(fin, length, offset)
+		sock.shutdown(socket.SHUT_WR)
+
+	t0 = time.monotonic()
+	for idx in range(nstreams):
+		srv,up = socket.socketpair()
+		down,cli = socket.socketpair()
+		socks += [srv, up, down, cli]
+
+		proxy = LatencyProxy(up, down, args.rtt / 1000,
+				args.window << 10)
+		proxy.start()
+		proxies.append(proxy)
+		threads += [
+			threading.Thread(target=send_part, args=(srv, idx)),
+			threading.Thread(target=drain,
+				args=(cli, received, idx))]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	t1 = time.monotonic()
+
+	for proxy in proxies:
+		proxy.join()
+	for sock in socks:
+		sock.close()
+	if sum(received) != size:
+		raise RuntimeError("received {}/{} byte".format(
+			sum(received), size))
+	return t1 - t0
+
+
+def main():
+	p = argparse.ArgumentParser(description='Chunked download '\
+		'throughput versus number of streams')
+	p.add_argument('--streams', default='1,2,4,8',
+		help='Stream counts (comma separated)')
+	p.add_argument('--size', type=int, default=32,
+		help='Filesize (MB)')
+	p.add_argument('--rtt', type=float, default=50,
+		help='Round trip time (ms)')
+	p.add_argument('--window', type=int, default=256,
+		help='Window per stream (KB)')
+	args = p.parse_args()
+
+	conf = ServerConfig(tempfile.mkdtemp())
+	size = args.size << 20
+
+	fd,path = tempfile.mkstemp()
+	with os.fdopen(fd, 'wb') as f:
+		block = os.urandom(1 << 20)
+		for i in range(args.size):
+			f.write(block)
+
+	print("rtt={:.0f}ms window={}KB, single stream limit {:.1f} MB/s"\
+		.format(args.rtt, args.window,
+		args.window / 1024 / (args.rtt / 1000)))
+	print("streams  seconds  MB/s")
+	try:
+		for n in [int(s) for s in args.streams.split(',')]:
+			secs = bench_streams(n, path, size, args, conf)
+			print("{:7}  {:7.2f}  {:5.1f}".format(n, secs,
+				args.size / secs))
+	finally:
+		os.remove(path)
+
+
+if __name__ == '__main__':
+	main()
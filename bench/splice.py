@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import socket
+import struct
+import argparse
+import resource
+import selectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retro_server.AudioRelay import AudioRelay, RelayCall, splice_available
+
+"""\
+Benchmark of the audio relay: CPU time per call with splice
+forwarding versus the userspace relay.
+
+'calls' two-party calls are relayed for 'duration' seconds,
+both participants of each call send 'rate' KB/s. The
+participants run in a child process, so the CPU time of this
+process is the time spent by the relay. The sockets are TCP
+connections over the loopback device (splice needs real
+sockets).
+
+  python3 bench/splice.py --calls 50 --rate 16
+
+"""
+
+
+class Conn:
+	""" Minimal TCPSocket replacement for the relay """
+	def __init__(self, sock):
+		self.fd = sock
+
+	def close(self):
+		self.fd.close()
+
+
+def tcp_pair(listener):
+	""" Returns a connected pair of TCP sockets """
+	a = socket.create_connection(listener.getsockname())
+	b,_ = listener.accept()
+	return a, b
+
+
+def run_participants(socks, args):
+	"""\
+	Child process: Send 'rate' KB/s on every socket and
+	read everything received.
+	"""
+	sel = selectors.DefaultSelector()
+	for sock in socks:
+		sock.setblocking(False)
+		sel.register(sock, selectors.EVENT_READ)
+
+	interval = 0.01
+	chunk = bytes(max(int(args.rate * 1024 * interval), 1))
+	next_send = time.monotonic()
+	end = next_send + args.duration
+
+	while time.monotonic() < end:
+		now = time.monotonic()
+		if now >= next_send:
+			for sock in socks:
+				try:
+					sock.send(chunk)
+				except BlockingIOError:
+					pass
+			next_send += interval
+		for key,mask in sel.select(max(0, next_send - now)):
+			try:
+				key.fileobj.recv(0x10000)
+			except BlockingIOError:
+				pass
+
+
+def bench_mode(use_splice, args):
+	"""\
+	Relay the calls in given mode.
+	Return:
+	  (cpu seconds, wall seconds, bytes relayed, splice calls)
+	"""
+	relay = AudioRelay(1, use_splice)
+	relay.start()
+
+	listener = socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(128)
+
+	calls  = []
+	client = []
+	for i in range(args.calls):
+		call = RelayCall(struct.pack('!Q', i) * 2)
+		for j in range(2):
+			a,b = tcp_pair(listener)
+			call.add_leg(Conn(b), struct.pack('!II', i, j))
+			client.append(a)
+		calls.append(call)
+	listener.close()
+
+	pid = os.fork()
+	if pid == 0:
+		for call in calls:
+			for leg in call.legs:
+				leg.sock.close()
+		run_participants(client, args)
+		os._exit(0)
+
+	for sock in client:
+		sock.close()
+
+	ru0 = resource.getrusage(resource.RUSAGE_SELF)
+	t0  = time.monotonic()
+	for call in calls:
+		relay.add_call(call)
+	time.sleep(0.5)
+	nsplice = relay.get_stats()['audio_splice_calls']
+	os.waitpid(pid, 0)
+	t1  = time.monotonic()
+	ru1 = resource.getrusage(resource.RUSAGE_SELF)
+
+	nbytes = relay.get_stats()['audio_bytes']
+	relay.stop()
+	cpu = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+	return cpu, t1 - t0, nbytes, nsplice
+
+
+def main():
+	p = argparse.ArgumentParser(description='Audio relay CPU '\
+		'per call, splice versus userspace')
+	p.add_argument('--calls', type=int, default=50,
+		help='Concurrent two-party calls')
+	p.add_argument('--rate', type=float, default=16,
+		help='KB/s sent by each participant')
+	p.add_argument('--duration', type=float, default=5,
+		help='Seconds per mode')
+	args = p.parse_args()
+
+	modes = [('userspace', False)]
+	if splice_available():
+		modes.append(('splice', True))
+	else:
+		print("os.splice() not available, userspace only")
+
+	print("mode       splice-calls  relay-cpu%  cpu-ms/call/s  cpu-s/GB")
+	for name,use_splice in modes:
+		cpu,wall,nbytes,nsplice = bench_mode(use_splice, args)
+		print("{:9}  {:12}  {:10.1f}  {:13.3f}  {:8.2f}".format(
+			name, nsplice, 100 * cpu / wall,
+			1000 * cpu / wall / args.calls,
+			cpu / nbytes * (1 << 30) if nbytes else 0))
+
+
+if __name__ == '__main__':
+	main()
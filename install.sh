@@ -59,6 +59,7 @@ function create_config_file() {
 	echo "#certfile = $base/certs/cert.pem" >> $file
 	echo "#userdir = $base/users" >> $file
 	echo "#msgdir = $base/msg" >> $file
+	echo "#ipcdir = $base/ipc" >> $file
 	echo "#uploaddir = $base/msg" >> $file
 	echo "#daemonize = False" >> $file
 	echo "#pidfile = $base/retro-server.pid" >> $file
@@ -72,6 +73,7 @@ function create_config_file() {
 	echo "[server]" >> $file
 	echo "address = 0.0.0.0" >> $file
 	echo "port = $serv_port" >> $file
+	echo "#workers = 1" >> $file
 	echo >> $file
 	echo "[fileserver]" >> $file
 	echo "port = $fileserv_port" >> $file
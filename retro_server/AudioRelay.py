@@ -0,0 +1,966 @@
+import os
+import errno
+import fcntl
+import socket
+import selectors
+import struct
+import threading
+import logging
+
+from collections import deque
+from itertools import islice
+from time import monotonic
+
+"""\
+Event-loop based relay for audio calls.
+
+Once the participants of a call have finished the handshake
+(see AudioServer.py), their sockets are handed over to the
+relay. The relay runs a fixed number of loops (threads),
+each call is pinned to the least loaded loop. A loop waits
+for all of its sockets with a selector, reads whatever is
+available and forwards it to the other participants with
+non-blocking writes.
+
+  - Read sizes adapt to the traffic of each connection
+    (READ_MIN ... READ_MAX).
+  - Data a participant can't take immediately is queued
+    (without copying) and written once its socket becomes
+    writable. If more than MAX_PENDING bytes are queued for
+    a participant, reading from the others is paused.
+  - Participants may join a running conference, if a
+    participant leaves, the others stay connected until
+    only one is left.
+
+Two-party calls are relayed as plain byte streams. In a
+conference (a call created with framed=True, see
+AudioServer.py) each participant receives the streams of
+several senders, so every chunk is framed:
+
+  userid(8) + length(2) + payload
+
+userid is the sender and length the size of the payload.
+The frame of a received chunk is built once and shared by
+all receivers. FrameReader splits a framed stream into the
+streams of the senders again (client side).
+
+On Linux, calls with two participants are forwarded with
+os.splice() if enabled ([audioserver] splice): Each leg owns
+a pipe holding the data for it, which is moved from the
+sending socket into the pipe and from the pipe to the
+receiving socket inside the kernel, without copying it to
+userspace. If splice isn't available (or fails for a socket),
+the userspace path above is used.
+
+With a delay budget ([audioserver] max_delay_ms), data queued
+for a slow participant doesn't build up without bound: Queued
+data older than the budget is dropped, in whole frames
+([audioserver] frame_size) of the participant's stream, so
+the receiver stays frame aligned. The kernel's socket buffers
+are kept small (SO_SNDBUF, TCP_NOTSENT_LOWAT).
+Calls are always forwarded in userspace then, the age of data
+in a pipe is unknown. In a conference only whole frames of the
+relay are dropped, each of them holds whole audio frames of its
+sender.
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+READ_MIN    = 1024
+READ_MAX    = 0x10000
+MAX_PENDING = 0x40000
+
+# Max. number of buffers passed to a single sendmsg()
+IOV_MAX = 64
+
+# Size of the kernel's socket send buffer and max. unsent
+# bytes in it, if the delay is bounded
+SNDBUF = 8192
+NOTSENT_LOWAT = 2048
+
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0)\
+		| getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+# Header of the frames of a conference, sender userid(8)
+# + payload length(2)
+FRAME_HEADER = struct.Struct('!8sH')
+MAX_FRAME    = 0xFFFF
+
+
+def splice_available():
+	"""\
+	Returns True if os.splice() is available.
+	"""
+	return hasattr(os, 'splice')
+
+
+class FrameReader:
+	"""\
+	Splits the stream a participant of a conference
+	receives into the frames of the senders.
+	"""
+	def __init__(self):
+		self.buf = bytearray()
+
+
+	def feed(self, data):
+		"""\
+		Add received data.
+		Return:
+		  List of (userid, payload) of all complete frames
+		"""
+		self.buf += data
+		frames = []
+		pos = 0
+		while len(self.buf) - pos >= FRAME_HEADER.size:
+			userid,n = FRAME_HEADER.unpack_from(self.buf, pos)
+			end = pos + FRAME_HEADER.size + n
+			if end > len(self.buf):
+				break
+			frames.append((userid,
+				bytes(self.buf[pos+FRAME_HEADER.size:end])))
+			pos = end
+		del self.buf[:pos]
+		return frames
+
+
+
+class RelayLeg:
+	"""\
+	Connection of a single participant of a relayed call.
+	"""
+	def __init__(self, call, fd, userid, wait=0.0):
+		"""\
+		Args:
+		  call:   RelayCall instance
+		  fd:     TCPSocket of participant
+		  userid: Userid of participant
+		  wait:   Time participant waited for a partner (s)
+		"""
+		self.call     = call
+		self.fd       = fd
+		self.sock     = fd.fd
+		self.userid   = userid
+		self.outq     = deque()	# Buffers waiting to be sent
+		self.qinfo    = deque()	# (stream offset, time) of buffers
+		self.pipe     = None	# (read fd, write fd) in splice mode
+		self.pending  = 0	# Bytes in outq or pipe
+		self.max_pending = MAX_PENDING
+		self.readsize = 4096	# Current read size
+		self.events   = 0	# Registered selector events
+		self.nrecv    = 0	# Bytes received
+		self.nsent    = 0	# Bytes sent
+		self.nqueued  = 0	# Bytes passed to the leg
+		self.ndropped = 0	# Bytes dropped
+		self.ndrops   = 0	# Number of drops
+		self.delay_max = 0.0	# Max. queueing delay (s)
+		self.partial_head = False # Head of outq partially sent?
+		self.rest     = b''	# Incomplete audio frame (framed)
+
+		# QoS metrics
+		self.wait     = wait	# Partner-wait time (s)
+		self.nchunks  = 0	# Chunks received
+		self.jitter   = 0.0	# Interarrival jitter (s)
+		self.arrival  = None	# Time of last chunk
+		self.gap      = None	# Last interarrival time
+		self.blocked  = 0.0	# Time with data waiting to be sent
+		self.blocked_since = None
+
+		self.sock.setblocking(False)
+
+
+	def peers(self):
+		""" Returns the other legs of the call """
+		return [l for l in self.call.legs if l is not self]
+
+
+	def arrived(self, now):
+		"""\
+		Account received chunk, the interarrival jitter
+		is the smoothed variation of the interarrival time
+		(like RFC 3550).
+		"""
+		self.nchunks += 1
+		if self.arrival is not None:
+			gap = now - self.arrival
+			if self.gap is not None:
+				d = abs(gap - self.gap)
+				self.jitter += (d - self.jitter) / 16
+			self.gap = gap
+		self.arrival = now
+
+
+	def update_blocked(self):
+		"""\
+		Account the time data is waiting to be sent to
+		participant, call if pending changed.
+		"""
+		if self.pending:
+			if self.blocked_since is None:
+				self.blocked_since = monotonic()
+		elif self.blocked_since is not None:
+			self.blocked += monotonic() - self.blocked_since
+			self.blocked_since = None
+
+
+	def get_stats(self):
+		"""\
+		Returns dictionary with the metrics of both
+		directions, in = from participant, out = to
+		participant.
+		"""
+		blocked = self.blocked
+		since   = self.blocked_since
+		if since is not None:
+			blocked += monotonic() - since
+		return {
+			'userid'     : self.userid.hex() if self.userid else '?',
+			'wait_ms'    : round(self.wait * 1000, 1),
+			'in_bytes'   : self.nrecv,
+			'in_chunks'  : self.nchunks,
+			'jitter_ms'  : round(self.jitter * 1000, 1),
+			'out_bytes'  : self.nsent,
+			'blocked_ms' : round(blocked * 1000, 1),
+			'dropped'    : self.ndropped,
+			'delay_max_ms' : round(self.delay_max * 1000, 1)
+		}
+
+
+	def get_delay(self):
+		""" Returns age of oldest queued data (s) """
+		try:
+			return monotonic() - self.qinfo[0][1]
+		except IndexError:
+			return 0.0
+
+
+
+class RelayCall:
+	"""\
+	A call handled by the relay.
+	"""
+	def __init__(self, callid, on_close=None, on_leave=None,
+			framed=False):
+		"""\
+		Args:
+		  callid:   Id of call
+		  on_close: Function called with this RelayCall
+		            when the call was closed or None
+		  on_leave: Function called with the RelayLeg of a
+		            participant who left a running call or
+		            None
+		  framed:   Conference, the data is framed and
+		            participants may join later
+		"""
+		self.callid   = callid
+		self.framed   = framed
+		self.legs     = []
+		self.on_close = on_close
+		self.on_leave = on_leave
+		self.loop     = None	# RelayLoop serving the call
+		self.splice   = False	# Forwarded with splice?
+		self.closed   = False
+		self.started  = monotonic()
+		self.setup    = 0.0	# Setup latency (s)
+		self.left     = []	# Legs of participants who left
+
+
+	def add_leg(self, fd, userid, wait=0.0):
+		"""\
+		Add participant (TCPSocket, userid, partner-wait
+		time) to call.
+		"""
+		self.legs.append(RelayLeg(self, fd, userid, wait))
+
+
+	def get_stats(self):
+		"""\
+		Returns dictionary with the metrics of the call and
+		its participants.
+		"""
+		return {
+			'callid'   : self.callid.hex()[:16],
+			'duration' : round(monotonic() - self.started, 1),
+			'setup_ms' : round(self.setup * 1000, 1),
+			'splice'   : self.splice,
+			'framed'   : self.framed,
+			'legs'     : [l.get_stats() for l in
+					list(self.legs) + self.left]
+		}
+
+
+
+class RelayLoop(threading.Thread):
+	"""\
+	A single relay loop, serving a subset of all calls.
+	"""
+	def __init__(self, idx, use_splice=False, max_delay=0,
+			frame_size=1):
+		"""\
+		Args:
+		  idx:        Index of loop
+		  use_splice: Forward 2-party calls with splice
+		  max_delay:  Delay budget (s), 0=unbounded
+		  frame_size: Frame size of the audio streams
+		"""
+		super().__init__(daemon=True)
+		self.idx      = idx
+		self.use_splice = use_splice
+		self.max_delay  = max_delay
+		self.frame_size = min(max(frame_size, 1), MAX_FRAME)
+		self.selector = selectors.DefaultSelector()
+		self.calls    = set()	# Calls served by this loop
+		self.incoming = deque()	# Calls to add
+		self.nbytes   = 0	# Bytes relayed
+		self.ndropped = 0	# Bytes dropped
+		self.ndrops   = 0	# Number of drops
+		self.done     = False
+
+		# Wakes up the selector if calls were added
+		# or the loop shall stop.
+		self.wakeup_r,self.wakeup_w = socket.socketpair()
+		self.wakeup_r.setblocking(False)
+		self.wakeup_w.setblocking(False)
+		self.selector.register(self.wakeup_r,
+				selectors.EVENT_READ, None)
+
+
+	def add_call(self, call):
+		"""\
+		Add call to loop (thread-safe).
+		"""
+		call.loop = self
+		self.incoming.append((call, None))
+		self.__wakeup()
+
+
+	def add_leg(self, call, leg):
+		"""\
+		Add participant (RelayLeg) to a call of this
+		loop (thread-safe).
+		"""
+		self.incoming.append((call, leg))
+		self.__wakeup()
+
+
+	def stop(self):
+		"""\
+		Stop loop, close all calls and wait for thread.
+		"""
+		self.done = True
+		self.__wakeup()
+		if self.is_alive():
+			self.join()
+
+
+	def run(self):
+		while not self.done:
+			try:
+				events = self.selector.select(timeout=1)
+			except Exception as e:
+				LOG.error("RelayLoop[{}]: select, {}"\
+					.format(self.idx, e))
+				break
+
+			for key,mask in events:
+				leg = key.data
+				if leg is None:
+					self.__drain_wakeup()
+					continue
+				if leg.call.closed or not leg.events:
+					continue	# Closed or left
+				if mask & selectors.EVENT_READ:
+					if leg.call.splice:
+						self.__splice_read(leg)
+					else:	self.__read(leg)
+				if mask & selectors.EVENT_WRITE\
+				   and not leg.call.closed and leg.events:
+					if leg.call.splice:
+						self.__splice_write(leg)
+					else:	self.__write(leg)
+
+		for call in list(self.calls):
+			self.close_call(call)
+		for call,leg in self.incoming:
+			if leg:
+				leg.fd.close()
+			self.close_call(call)
+		self.selector.close()
+		self.wakeup_r.close()
+		self.wakeup_w.close()
+
+
+	def close_call(self, call):
+		"""\
+		Close all connections of a call.
+		"""
+		if call.closed:
+			return
+		call.closed = True
+		self.calls.discard(call)
+
+		for leg in call.legs:
+			if leg.events:
+				try:
+					self.selector.unregister(leg.sock)
+				except (KeyError, ValueError):
+					pass
+				leg.events = 0
+			try:
+				leg.fd.close()
+			except Exception:
+				pass
+			leg.pending = 0
+			leg.update_blocked()
+		self.__close_pipes(call)
+
+		LOG.debug("RelayLoop[{}]: call {} closed, {}".format(
+			self.idx, call.callid.hex()[:16], ", ".join(
+			"{}: {}/{} byte in/out, {} byte dropped, max. delay"\
+			" {:.1f} ms".format(l.userid.hex() if l.userid else '?',
+			l.nrecv, l.nsent, l.ndropped, l.delay_max * 1000)
+			for l in call.legs)))
+
+		if call.on_close:
+			try:
+				call.on_close(call)
+			except Exception as e:
+				LOG.error("RelayLoop: on_close, " + str(e))
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __wakeup(self):
+		try:
+			self.wakeup_w.send(b'\x00')
+		except (BlockingIOError, OSError):
+			pass
+
+
+	def __drain_wakeup(self):
+		"""\
+		Read wakeup bytes and add incoming calls.
+		"""
+		try:
+			while self.wakeup_r.recv(1024):
+				pass
+		except (BlockingIOError, OSError):
+			pass
+
+		while self.incoming:
+			call,leg = self.incoming.popleft()
+			if leg:
+				self.__join(call, leg)
+				continue
+			self.calls.add(call)
+			if self.use_splice and not call.framed\
+			   and len(call.legs) == 2:
+				self.__open_pipes(call)
+			for leg in call.legs:
+				if self.max_delay:
+					self.__limit_sndbuf(leg)
+				self.__update(leg)
+
+
+	def __join(self, call, leg):
+		"""\
+		Add participant to running conference.
+		"""
+		if call.closed or not call.framed:
+			leg.fd.close()
+			return
+		call.legs.append(leg)
+		if self.max_delay:
+			self.__limit_sndbuf(leg)
+		self.__update_call(call)
+
+
+	def __leave(self, leg):
+		"""\
+		Remove participant from call, the call is closed
+		if less than two participants are left.
+		"""
+		call = leg.call
+		if call.closed:
+			return
+		if len(call.legs) <= 2:
+			self.close_call(call)
+			return
+
+		if leg.events:
+			try:
+				self.selector.unregister(leg.sock)
+			except (KeyError, ValueError):
+				pass
+			leg.events = 0
+		try:
+			leg.fd.close()
+		except Exception:
+			pass
+		call.legs.remove(leg)
+		leg.pending = 0
+		leg.update_blocked()
+		call.left.append(leg)
+
+		LOG.debug("RelayLoop[{}]: {} left call {}, {}/{} byte"\
+			" in/out".format(self.idx, leg.userid.hex()
+			if leg.userid else '?', call.callid.hex()[:16],
+			leg.nrecv, leg.nsent))
+		if call.on_leave:
+			try:
+				call.on_leave(leg)
+			except Exception as e:
+				LOG.error("RelayLoop: on_leave, " + str(e))
+
+		# Reading may continue now
+		self.__update_call(call)
+
+
+	def __limit_sndbuf(self, leg):
+		"""\
+		Limit the data in the kernel's socket buffer, the
+		backlog has to build up in the relay's queue, where
+		it can be dropped.
+		"""
+		try:
+			leg.sock.setsockopt(socket.SOL_SOCKET,
+				socket.SO_SNDBUF,
+				max(SNDBUF, 4 * self.frame_size))
+			opt = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+			if opt is not None:
+				leg.sock.setsockopt(socket.IPPROTO_TCP, opt,
+					max(NOTSENT_LOWAT, self.frame_size))
+		except OSError as e:
+			LOG.debug("RelayLoop: setsockopt, " + str(e))
+
+
+	def __open_pipes(self, call):
+		"""\
+		Create the pipes for forwarding call with splice.
+		"""
+		try:
+			for leg in call.legs:
+				leg.pipe = os.pipe()
+				for fd in leg.pipe:
+					os.set_blocking(fd, False)
+				if hasattr(fcntl, 'F_SETPIPE_SZ'):
+					try:
+						fcntl.fcntl(leg.pipe[1],
+							fcntl.F_SETPIPE_SZ,
+							MAX_PENDING)
+					except OSError:
+						pass	# Keep default size
+				if hasattr(fcntl, 'F_GETPIPE_SZ'):
+					leg.max_pending = fcntl.fcntl(
+						leg.pipe[1], fcntl.F_GETPIPE_SZ)
+				else:	leg.max_pending = 0x10000
+			call.splice = True
+		except OSError as e:
+			LOG.warning("RelayLoop: pipe, " + str(e))
+			self.__close_pipes(call)
+
+
+	def __close_pipes(self, call):
+		"""\
+		Close the pipes of a call, it's forwarded in
+		userspace afterwards.
+		"""
+		call.splice = False
+		for leg in call.legs:
+			if leg.pipe:
+				for fd in leg.pipe:
+					os.close(fd)
+				leg.pipe = None
+				leg.max_pending = MAX_PENDING
+
+
+	def __read(self, leg):
+		"""\
+		Read from participant and forward data to the
+		others.
+		"""
+		framed = leg.call.framed
+		try:
+			data = leg.sock.recv(min(leg.readsize, MAX_FRAME
+					- len(leg.rest)) if framed
+					else leg.readsize)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as e:
+			LOG.debug("RelayLoop: recv, " + str(e))
+			self.__leave(leg)
+			return
+
+		if not data:
+			# Participant left the call
+			self.__leave(leg)
+			return
+
+		leg.arrived(monotonic())
+
+		# Adapt read size to traffic
+		n = len(data)
+		if n == leg.readsize:
+			leg.readsize = min(leg.readsize * 2, READ_MAX)
+		elif n < leg.readsize // 4:
+			leg.readsize = max(leg.readsize // 2, READ_MIN)
+
+		leg.nrecv   += n
+		self.nbytes += n
+
+		if framed:
+			# Frame whole audio frames of the sender,
+			# the rest is kept for the next chunk.
+			if leg.rest:
+				data = leg.rest + data
+			end = len(data) // self.frame_size * self.frame_size
+			leg.rest = data[end:]
+			if not end:
+				return
+			data = FRAME_HEADER.pack(leg.userid or bytes(8),
+					end) + data[:end]
+
+		# All peers get the same buffer
+		for peer in leg.peers():
+			self.__send(peer, data)
+			if leg.call.closed:
+				return
+		self.__update_call(leg.call)
+
+
+	def __send(self, leg, data):
+		"""\
+		Send data to participant, the rest that can't be
+		sent immediately is queued.
+		"""
+		offset = leg.nqueued
+		leg.nqueued += len(data)
+
+		if not leg.outq:
+			try:
+				n = leg.sock.send(data)
+			except (BlockingIOError, InterruptedError):
+				n = 0
+			except OSError as e:
+				LOG.debug("RelayLoop: send, " + str(e))
+				self.__leave(leg)
+				return
+
+			leg.nsent += n
+			if n == len(data):
+				return
+			data = memoryview(data)[n:]
+			offset += n
+			leg.partial_head = n > 0
+
+		leg.outq.append(data)
+		leg.qinfo.append((offset, monotonic()))
+		leg.pending += len(data)
+
+		if self.max_delay:
+			self.__drop_stale(leg)
+
+
+	def __drop_stale(self, leg):
+		"""\
+		Drop the queued data older than the delay budget.
+		"""
+		now = monotonic()
+		if now - leg.qinfo[0][1] <= self.max_delay:
+			return
+
+		if leg.call.framed:
+			n = self.__drop_stale_frames(leg, now)
+		else:	n = self.__drop_stale_bytes(leg, now)
+		if not n:
+			return
+
+		leg.pending  -= n
+		leg.ndropped += n
+		leg.ndrops   += 1
+		self.ndropped += n
+		self.ndrops   += 1
+
+
+	def __drop_stale_frames(self, leg, now):
+		"""\
+		Drop stale frames of a conference, each queued
+		buffer is a frame. A partially sent frame is kept.
+		Return:
+		  Number of bytes dropped
+		"""
+		head = None
+		if leg.partial_head:
+			head = (leg.outq.popleft(), leg.qinfo.popleft())
+
+		n = 0
+		while leg.outq and now - leg.qinfo[0][1] > self.max_delay:
+			n += len(leg.outq.popleft())
+			leg.qinfo.popleft()
+
+		if head:
+			leg.outq.appendleft(head[0])
+			leg.qinfo.appendleft(head[1])
+		return n
+
+
+	def __drop_stale_bytes(self, leg, now):
+		"""\
+		Drop stale data of a byte stream. Only whole audio
+		frames are dropped, the frame which is partially
+		sent and the frame at the end of the stale data
+		are kept.
+		Return:
+		  Number of bytes dropped
+		"""
+		# Stream offsets of the frames to drop (b0...b1)
+		fs  = self.frame_size
+		end = 0
+		for (offset,t),buf in zip(leg.qinfo, leg.outq):
+			if now - t <= self.max_delay:
+				break
+			end = offset + len(buf)
+		b0 = -(-leg.qinfo[0][0] // fs) * fs
+		b1 = end // fs * fs
+		if b1 <= b0:
+			return 0
+
+		keep = []
+		n = 0	# Bytes dropped
+		while leg.outq:
+			buf = leg.outq[0]
+			offset,t = leg.qinfo[0]
+			if offset >= b1:
+				break
+			leg.outq.popleft()
+			leg.qinfo.popleft()
+			n += len(buf)
+			if offset < b0:
+				# Rest of partially sent frame
+				buf0 = memoryview(buf)[:b0-offset]
+				keep.append((buf0, (offset, t)))
+				n -= len(buf0)
+			if offset + len(buf) > b1:
+				leg.outq.appendleft(memoryview(buf)[b1-offset:])
+				leg.qinfo.appendleft((b1, t))
+				n -= len(leg.outq[0])
+				break
+		for buf,info in reversed(keep):
+			leg.outq.appendleft(buf)
+			leg.qinfo.appendleft(info)
+		return n
+
+
+	def __write(self, leg):
+		"""\
+		Send queued data to participant.
+		"""
+		if self.max_delay and leg.outq:
+			self.__drop_stale(leg)
+
+		while leg.outq:
+			bufs = list(islice(leg.outq, IOV_MAX))
+			try:
+				n = leg.sock.sendmsg(bufs)
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError as e:
+				LOG.debug("RelayLoop: send, " + str(e))
+				self.__leave(leg)
+				return
+
+			sent = n
+			leg.nsent   += n
+			leg.pending -= n
+			now = monotonic()
+			while n:
+				head = leg.outq[0]
+				offset,t = leg.qinfo[0]
+				if len(head) <= n:
+					n -= len(head)
+					leg.outq.popleft()
+					leg.qinfo.popleft()
+					leg.partial_head = False
+					leg.delay_max = max(leg.delay_max, now - t)
+				else:
+					leg.outq[0]  = memoryview(head)[n:]
+					leg.qinfo[0] = (offset + n, t)
+					leg.partial_head = True
+					n = 0
+
+			if sent < sum(len(b) for b in bufs):
+				break	# Socket buffer is full
+
+		self.__update_call(leg.call)
+
+
+	def __splice_read(self, leg):
+		"""\
+		Move data from participant's socket into the pipe
+		of its peer and forward it.
+		"""
+		peer  = leg.peers()[0]
+		space = peer.max_pending - peer.pending
+		if space <= 0:
+			return
+
+		try:
+			n = os.splice(leg.sock.fileno(), peer.pipe[1],
+					space, flags=SPLICE_FLAGS)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as e:
+			if e.errno == errno.EINVAL and not leg.pending\
+			   and not peer.pending:
+				# Splice not supported for socket,
+				# nothing was moved yet.
+				LOG.warning("RelayLoop: splice not supported"\
+					", using userspace relay")
+				self.use_splice = False
+				self.__close_pipes(leg.call)
+				self.__read(leg)
+			else:
+				LOG.debug("RelayLoop: splice, " + str(e))
+				self.__leave(leg)
+			return
+
+		if not n:
+			# Participant left the call
+			self.__leave(leg)
+			return
+
+		leg.arrived(monotonic())
+		leg.nrecv    += n
+		self.nbytes  += n
+		peer.pending += n
+		self.__splice_write(peer)
+
+
+	def __splice_write(self, leg):
+		"""\
+		Move data from participant's pipe to its socket.
+		"""
+		while leg.pending:
+			try:
+				n = os.splice(leg.pipe[0], leg.sock.fileno(),
+					leg.pending, flags=SPLICE_FLAGS)
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError as e:
+				LOG.debug("RelayLoop: splice, " + str(e))
+				self.__leave(leg)
+				return
+			if not n:
+				break
+			leg.pending -= n
+			leg.nsent   += n
+
+		self.__update_call(leg.call)
+
+
+	def __update_call(self, call):
+		for leg in call.legs:
+			self.__update(leg)
+
+
+	def __update(self, leg):
+		"""\
+		Register the events the leg is waiting for.
+		Reading pauses while any peer has too much data
+		queued.
+		"""
+		if leg.call.closed:
+			return
+		leg.update_blocked()
+
+		events = 0
+		if all(p.pending < p.max_pending for p in leg.peers()):
+			events |= selectors.EVENT_READ
+		if leg.pending:
+			events |= selectors.EVENT_WRITE
+
+		if events == leg.events:
+			return
+		if not leg.events:
+			self.selector.register(leg.sock, events, leg)
+		elif not events:
+			self.selector.unregister(leg.sock)
+		else:	self.selector.modify(leg.sock, events, leg)
+		leg.events = events
+
+
+
+class AudioRelay:
+	"""\
+	Runs the relay loops and distributes the calls.
+	"""
+	def __init__(self, nloops, use_splice=False, max_delay=0,
+			frame_size=1):
+		"""\
+		Args:
+		  nloops:     Number of relay loops (threads)
+		  use_splice: Forward with splice, if available
+		  max_delay:  Delay budget (s), 0=unbounded
+		  frame_size: Frame size of the audio streams
+		"""
+		# Delay of data in a pipe can't be bounded
+		use_splice = use_splice and splice_available()\
+				and not max_delay
+		self.loops = [RelayLoop(i, use_splice, max_delay,
+				frame_size) for i in range(max(nloops, 1))]
+
+
+	def start(self):
+		for loop in self.loops:
+			loop.start()
+
+
+	def stop(self):
+		for loop in self.loops:
+			loop.stop()
+
+
+	def add_call(self, call):
+		"""\
+		Pass call (RelayCall) to the least loaded loop.
+		"""
+		loop = min(self.loops, key=lambda l: len(l.calls)\
+				+ len(l.incoming))
+		loop.add_call(call)
+
+
+	def add_leg(self, call, fd, userid, wait=0.0):
+		"""\
+		Add participant (TCPSocket, userid, partner-wait
+		time) to a call passed to add_call before.
+		"""
+		call.loop.add_leg(call, RelayLeg(call, fd, userid, wait))
+
+
+	def get_call_stats(self):
+		"""\
+		Returns list with the metrics of all running calls
+		(see RelayCall.get_stats).
+		"""
+		return [c.get_stats() for l in self.loops
+				for c in list(l.calls)]
+
+
+	def get_stats(self):
+		return {
+			'audio_calls'       : sum(len(l.calls)
+						for l in self.loops),
+			'audio_splice_calls': sum(1 for l in self.loops
+						for c in list(l.calls) if c.splice),
+			'audio_participants': sum(len(c.legs) for l in self.loops
+						for c in list(l.calls)),
+			'audio_bytes'       : sum(l.nbytes for l in self.loops),
+			'audio_relay_loops' : len(self.loops),
+			'audio_dropped'     : sum(l.ndropped for l in self.loops),
+			'audio_drops'       : sum(l.ndrops for l in self.loops),
+			'audio_delay_ms'    : round(1000 * max((leg.get_delay()
+						for l in self.loops
+						for c in list(l.calls)
+						for leg in c.legs), default=0), 1)
+		}
@@ -2,23 +2,60 @@ import threading
 import logging
 import socket
 
-from time import sleep as time_sleep
+from time import monotonic
 from libretro.net import TCPSocket
 from libretro.crypto import random_buffer
 
+from . AudioRelay import AudioRelay, RelayCall
+from . UdpRelay import UdpRelay
+from . SessionTable import SessionTable
+from . import Metrics
+
 """\
-The audio-server manages audio calls between 2 clients.
-It is implemented for running as a thread.
+The audio-server manages audio calls between 2 or more
+clients (conference). It is implemented for running as a
+thread.
+
+A client is authorized by the call id it sends first. The
+call id is registered as token for all calling partners
+when the call is set up via the chatserver (see
+SessionTable.py). The address of the connection is used
+as fallback. Each user of the token may join the call once
+at a time.
 
 For network/audio performance reasons all audio data is
 transmitted over simple TCP and no transport layer
 security is implemented. The voicecalls are end-to-end
 encrypted by the calling partners.
 
+The handshake of each connection is done by a short-lived
+AudioTransferThread. Once two participants of a call are
+ready, their connections are handed over to the AudioRelay,
+which forwards the audio data of all calls from a few event
+loops (see AudioRelay.py).
+
+A call whose call id is valid for more than two users when
+the first participant joins is a conference: Participants
+getting ready later are added to the running call, each
+participant's stream is forwarded to all others (no mixing),
+framed with the sender's userid (see AudioRelay.py). The
+participants of a conference get 0x03 instead of 0x01 as OK,
+a third participant of a two-party call is refused.
+
 """
 
 LOG = logging.getLogger(__name__)
 
+# Seconds to wait for the calling partner
+RENDEZVOUS_TIMEOUT = 10
+
+CALLS = Metrics.counter('retro_audio_calls_total',
+		'Relayed audio calls')
+SETUP_LATENCY = Metrics.histogram('retro_audio_setup_seconds',
+		'Time from the first participant joining a call '\
+		'until the call starts')
+
+
 class AudioServer(threading.Thread):
 
 	def __init__(self, server):
@@ -37,12 +74,40 @@ class AudioServer(threading.Thread):
 		self.fd = TCPSocket()
 
 
-		# A dictionary to keep track of the calls
-		# and which users are calling.
-		# The keys are the callid's and the values
-		# are CallRooms.
-		self.callrooms = {}
-
+		# Keeps track of the calls and which users
+		# are calling.
+		self.calls = CallRegistry(self.conf.audioserver_max_calls)
+
+		# Relays the audio data of all running calls
+		self.relay = AudioRelay(self.conf.audioserver_relay_loops,
+				self.conf.audioserver_splice,
+				self.conf.audioserver_max_delay_ms / 1000,
+				self.conf.audioserver_frame_size)
+
+		# Optional UDP relay, listens at the same port
+		self.udp = UdpRelay(self) if self.conf.audioserver_udp\
+				else None
+
+		# Call setup statistics, setup latency is the time
+		# from the first participant joining a call until
+		# the call starts.
+		self.nsetups      = 0
+		self.ntimeouts    = 0
+		self.setup_total  = 0.0
+		self.setup_max    = 0.0
+		self.stats_lock   = threading.Lock()
+
+		# QoS metrics of the participants of finished
+		# calls (see RelayLeg.get_stats).
+		self.qos = {
+			'legs'       : 0,
+			'chunks'     : 0,
+			'jitter'     : 0.0,	# Sum of jitter_ms
+			'jitter_max' : 0.0,
+			'blocked'    : 0.0,	# Sum of blocked_ms
+			'wait'       : 0.0,	# Sum of wait_ms
+			'wait_max'   : 0.0
+		}
 
 		self.done = False
 
@@ -61,6 +126,9 @@ class AudioServer(threading.Thread):
 
 		LOG.info("Starting audioserver at {} ...".format(
 				self.fd.get_addrstr()))
+		self.relay.start()
+		if self.udp and self.udp.open():
+			self.udp.start()
 
 		while not self.done:
 			try:
@@ -68,24 +136,13 @@ class AudioServer(threading.Thread):
 				if cfd == False: continue
 				if cfd == None:  break
 
-				cliconn = self.serv.get_conn_by_address(cfd.addr)
-				if not cliconn:
-					# Currently accepted client has no
-					# permissions to connect to audio
-					# server since it's not connected
-					# to the chatserver simultaniously.
-					LOG.warning("AudioServer: No perm "\
-						"{}".format(cfd.addr))
-					cfd.close('rw')
-					continue
-
 				LOG.debug("AudioServer: accepted {}".format(cfd.addr))
 
-
-				# Starting the audio transfer thread
-				thread = AudioTransferThread(self, cfd, cliconn.userid)
+				# Starting the audio transfer thread,
+				# permissions are checked after the
+				# callid was received.
+				thread = AudioTransferThread(self, cfd)
 				thread.start()
-				time_sleep(0.1)
 
 
 			except Exception as e:
@@ -102,54 +159,367 @@ class AudioServer(threading.Thread):
 		LOG.info("Shutting down audioserver")
 		self.done = True
 
-		for callroom in self.callrooms.values():
-			callroom.close_call()
-
+		self.calls.close_all()
+		self.relay.stop()
+		if self.udp:
+			self.udp.stop()
 		self.fd.close()
 
 
-	def get_callroom(self, callid):
+	def start_call(self, callroom):
+		"""\
+		Hand the connections of the ready participants of a
+		callroom over to the relay. The first call starts
+		the relayed call, later participants are added to
+		the running call.
+		"""
+		with callroom.lock:
+			threads = callroom.ready[callroom.nstarted:]
+			callroom.nstarted = len(callroom.ready)
+			if callroom.call:
+				for t in threads:
+					if callroom.conference:
+						self.relay.add_leg(callroom.call,
+							t.fd, t.userid, t.wait)
+					else:	t.fd.close()
+				return
+
+			call = RelayCall(callroom.callid,
+				lambda call: self.__call_closed(callroom, call),
+				lambda leg: callroom.remove_caller(leg.userid),
+				callroom.conference)
+			for t in threads:
+				call.add_leg(t.fd, t.userid, t.wait)
+			latency = monotonic() - min(t.joined for t in threads)
+			call.setup = latency
+			callroom.call = call
+			self.relay.add_call(call)
+
+		CALLS.inc()
+		SETUP_LATENCY.observe(latency)
+
+		with self.stats_lock:
+			self.nsetups     += 1
+			self.setup_total += latency
+			self.setup_max    = max(self.setup_max, latency)
+		LOG.debug("AudioServer: call setup took {:.1f} ms".format(
+			latency * 1000))
+
+
+	def setup_timeout(self):
+		""" Count call whose partner didn't show up """
+		with self.stats_lock:
+			self.ntimeouts += 1
+
+
+	def get_stats(self):
+		"""\
+		Returns dictionary with audioserver statistics.
+		"""
+		stats = self.relay.get_stats()
+		stats.update(self.calls.get_stats())
+		if self.udp:
+			stats.update(self.udp.get_stats())
+		with self.stats_lock:
+			stats['audio_setups'] = self.nsetups
+			stats['audio_setup_timeouts'] = self.ntimeouts
+			stats['audio_setup_avg_ms'] = round(1000\
+				* self.setup_total / self.nsetups, 1)\
+				if self.nsetups else 0
+			stats['audio_setup_max_ms'] = round(
+				1000 * self.setup_max, 1)
+			qos = dict(self.qos)
+
+		# QoS of finished and running calls
+		for call in self.relay.get_call_stats():
+			for leg in call['legs']:
+				self.__add_qos(qos, leg)
+		n = qos['legs']
+		stats['audio_chunks'] = qos['chunks']
+		stats['audio_jitter_avg_ms'] = round(qos['jitter'] / n, 1)\
+				if n else 0
+		stats['audio_jitter_max_ms'] = qos['jitter_max']
+		stats['audio_blocked_ms'] = round(qos['blocked'], 1)
+		stats['audio_wait_avg_ms'] = round(qos['wait'] / n, 1)\
+				if n else 0
+		stats['audio_wait_max_ms'] = qos['wait_max']
+		return stats
+
+
+	def get_call_stats(self):
+		"""\
+		Returns list with the QoS metrics of all running
+		calls, see RelayCall.get_stats.
+		"""
+		return self.relay.get_call_stats()
+
+
+	def log_call_stats(self):
+		"""\
+		Log the QoS metrics of all running calls (called
+		on SIGUSR1).
+		"""
+		for call in self.get_call_stats():
+			LOG.info("Call {}: duration={} setup_ms={} splice={}"\
+				" framed={}".format(call['callid'],
+				call['duration'], call['setup_ms'],
+				call['splice'], call['framed']))
+			for leg in call['legs']:
+				LOG.info("  " + " ".join("{}={}".format(k, v)
+						for k,v in leg.items()))
+
+
+	def is_conference(self, callid):
+		"""\
+		Returns True if given call id is valid for more
+		than two users.
+		"""
+		userids = self.serv.sessions.check_token(callid,
+				SessionTable.CALL)
+		return bool(userids) and len(userids) > 2
+
+
+	def authorize(self, callid, address, exclude=()):
+		"""\
+		Get the userid of an audio connection.
+		Args:
+		  callid:  Callid sent by the client
+		  address: Address of client
+		  exclude: Userids already joined the call
+		Return:
+		  Userid or None if client has no permissions
+		"""
+		userids = self.serv.sessions.check_token(callid,
+				SessionTable.CALL)
+		if userids:
+			userids = [u for u in userids if u not in exclude]
+			if len(userids) > 1:
+				# Prefer the user connected from
+				# this address.
+				conn = self.serv.get_conn_by_address(address)
+				if conn and conn.userid in userids:
+					return conn.userid
+			return userids[0] if userids else None
+
+		conn = self.serv.get_conn_by_address(address)
+		if conn and conn.userid not in exclude:
+			return conn.userid
+		return None
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __call_closed(self, callroom, call):
+		"""\
+		Remove callroom of finished call and keep the QoS
+		metrics of its participants.
+		"""
+		self.calls.release(callroom)
+		stats = call.get_stats()
+		with self.stats_lock:
+			for leg in stats['legs']:
+				self.__add_qos(self.qos, leg)
+		LOG.debug("AudioServer: call {} finished after {} s, {}"\
+			.format(stats['callid'], stats['duration'], "; ".join(
+			" ".join("{}={}".format(k, v) for k,v in leg.items())
+			for leg in stats['legs'])))
+
+
+	def __add_qos(self, qos, leg):
+		"""\
+		Add QoS metrics of participant (RelayLeg.get_stats)
+		to totals.
+		"""
+		qos['legs']      += 1
+		qos['chunks']    += leg['in_chunks']
+		qos['jitter']    += leg['jitter_ms']
+		qos['jitter_max'] = max(qos['jitter_max'], leg['jitter_ms'])
+		qos['blocked']   += leg['blocked_ms']
+		qos['wait']      += leg['wait_ms']
+		qos['wait_max']   = max(qos['wait_max'], leg['wait_ms'])
+
+
+
+
+class CallRegistry:
+	"""\
+	Keeps the callrooms, key=callid, value=CallRoom.
+	A callroom is created when the first participant
+	connects and removed if all participants left before
+	the call started (e.g. rendezvous timeout) or when
+	the relayed call has finished.
+	"""
+	def __init__(self, max_calls):
+		"""\
+		Args:
+		  max_calls: Max. number of concurrent calls
+		             (0 = unlimited)
+		"""
+		self.max_calls = max_calls
+		self.rooms     = {}
+		self.rejected  = 0	# Calls refused by limit
+		self.lock      = threading.Lock()
+
+
+	def join(self, callid, conference=False):
+		"""\
+		Get callroom by callid, create it if missing.
+		Args:
+		  callid:     Id of call
+		  conference: Create room for a conference
+		Return:
+		  CallRoom or None if the max. number of calls
+		  is reached.
+		"""
+		with self.lock:
+			room = self.rooms.get(callid)
+			if room:
+				return room
+			if self.max_calls and len(self.rooms) >= self.max_calls:
+				self.rejected += 1
+				return None
+			room = CallRoom(callid, conference)
+			self.rooms[callid] = room
+			return room
+
+
+	def leave(self, room):
+		"""\
+		Remove callroom if no participant is left and the
+		call wasn't started.
+		"""
+		with self.lock, room.cond:
+			if not room.threads and self.rooms.get(room.callid) is room:
+				del self.rooms[room.callid]
+				room.closed = True
+
+
+	def release(self, room):
 		"""\
-		Get callroom by callid.
+		Remove callroom of a finished call.
 		"""
-		if callid not in self.callrooms:
-			self.callrooms[callid] = CallRoom(callid)
-		return self.callrooms[callid]
+		with self.lock:
+			if self.rooms.get(room.callid) is room:
+				del self.rooms[room.callid]
+		with room.cond:
+			room.closed  = True
+			room.threads = []
+
+
+	def close_all(self):
+		"""\
+		Close all callrooms.
+		"""
+		with self.lock:
+			rooms = list(self.rooms.values())
+			self.rooms = {}
+		for room in rooms:
+			room.close_call()
+
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				'audio_rooms'          : len(self.rooms),
+				'audio_calls_rejected' : self.rejected
+			}
 
 
 class CallRoom:
 	"""\
 	Connects the participants of a call.
+	The participants meet at the callroom: Each one waits
+	(wait_partners) until somebody else joined, tells its
+	client and then signals that it's ready (set_ready). As
+	soon as two participants are ready the call is started,
+	participants getting ready later join the running call
+	if it's a conference. The number of participants is
+	limited by the users of the callid (see
+	AudioServer.authorize).
 	"""
 
-	def __init__(self, callid):
-		self.callid  = b'' # Call ID
+	def __init__(self, callid, conference=False):
+		self.callid  = callid # Call ID
+		self.conference = conference # More than 2 participants?
 		self.threads = []  # List with AudioTransferThreads.
+		self.ready   = []  # Ready participants
+		self.nstarted = 0  # Ready participants passed to relay
+		self.call    = None # RelayCall, once started
+		self.closed  = False
 		self.lock    = threading.Lock()
+		self.cond    = threading.Condition(self.lock)
 
 	def add_caller(self, audioTransferThread):
 		"""\
 		Add participant to call.
-		This will "connect" both callers (set thread.partner).
+		Return:
+		  False if the room was closed in the meantime
 		"""
-		with self.lock:
-			if self.threads:
-				# Connect both threads
-				self.threads[0].partner = audioTransferThread
-				audioTransferThread.partner = self.threads[0]
+		audioTransferThread.joined = monotonic()
+		with self.cond:
+			if self.closed:
+				return False
 			self.threads.append(audioTransferThread)
+			self.cond.notify_all()
+			return True
+
+	def remove_caller(self, userid):
+		"""\
+		Remove participant who left the running call, the
+		user may join again.
+		"""
+		with self.cond:
+			self.threads = [t for t in self.threads
+					if t.userid != userid]
+
+	def wait_partners(self, audioTransferThread, timeout_sec):
+		"""\
+		Wait until another participant joined the call. If
+		that doesn't happen within timeout, the participant
+		is removed from the room.
+		Return:
+		  True if somebody else joined, else False
+		"""
+		with self.cond:
+			ok = self.cond.wait_for(lambda: self.closed
+					or self.has_partners(), timeout_sec)
+			if ok and not self.closed:
+				return True
+			if audioTransferThread in self.threads:
+				self.threads.remove(audioTransferThread)
+			return False
+
+	def set_ready(self, audioTransferThread):
+		"""\
+		Mark a participant as ready (handshake done).
+		Return:
+		  True if at least two participants are ready, the
+		  caller must then start the call or join it
+		  (AudioServer.start_call).
+		"""
+		with self.lock:
+			self.ready.append(audioTransferThread)
+			return len(self.ready) >= 2
+
+	def has_partners(self):
+		"""\
+		Does the call have at least 2 participants?
+		"""
+		return len(self.threads) >= 2
 
 	def is_full(self):
 		"""\
-		Does the call have 2 participants?
-		Check this before starting the call...
+		Is a two-party call complete?
 		"""
-		return len(self.threads) == 2
+		return not self.conference and len(self.threads) >= 2
 
 	def close_call(self):
 		"""\
 		Stop the call.
 		"""
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
 		for t in self.threads:
 			t.done = True
 		for t in self.threads:
@@ -159,23 +529,23 @@ class CallRoom:
 
 class AudioTransferThread(threading.Thread):
 	"""\
-	Thread which transmits audio data between
-	two clients.
+	Thread which does the handshake of an audio connection.
+	Afterwards the connection is relayed by the AudioRelay.
 	"""
-	def __init__(self, audioserv, fd, userid):
+	def __init__(self, audioserv, fd):
 		"""\
 		Args:
 		  audioserv: AudioServer instance
 		  fd:        Freshly accepted TCPSocket
-		  userid:    Userid of client
 		"""
 		super().__init__()
 		self.aserv    = audioserv
 		self.fd       = fd	# Client socket (TCPSocket)
-		self.userid   = userid	# Client userid
-		self.partner  = None	# Talking partner (AudioTransferThread)
+		self.userid   = None	# Client userid
 		self.callroom = None	# Assigned callroom
 		self.callid   = None	# Id of call (16byte!!)
+		self.joined   = None	# Time the callroom was joined
+		self.wait     = 0.0	# Time waited for a partner (s)
 		self.callidx  = ""	# Callid as hex string
 		self.done     = False	# Thread done?
 
@@ -188,33 +558,16 @@ class AudioTransferThread(threading.Thread):
 		# Receive callid from client and wait for
 		# communication partner.
 		if not self.__handshake():
+			self.fd.close()
 			return
 
-		# Wait 1 sec to let calling partner accomplish
-		# its setup ...
-		time_sleep(1)
-
-		LOG.debug("AudioThread[{}]: Starting transmission loop ..."\
-			.format(self.userid))
-
-		while not self.done and not self.partner.done:
-			data = self.recv(
-					max_bytes=1024,
-					timeout_sec=1)
-
-			if data == None:  break
-			if data == False: continue
-
-			if data and not self.partner.send(data):
-				break
-
-
-		self.partner.done = True
-		self.done         = True
-
-		self.fd.close()
-		LOG.debug("AudioThread[{}]: finished"\
-				.format(self.userid))
+		# The second ready participant starts the call,
+		# later ones join it. The relay owns the connection
+		# from now on.
+		if self.callroom.set_ready(self):
+			LOG.debug("AudioThread[{}]: Starting/joining call {}"\
+				.format(self.userid, self.callidx))
+			self.aserv.start_call(self.callroom)
 
 
 	def __handshake(self):
@@ -222,8 +575,10 @@ class AudioTransferThread(threading.Thread):
 		Performs the audioserver handshake.
 
 		- Receive 16 byte call ID
-		- Wait for calling partner to connect
-		- Send 0x01 (OK) or 0x02 (No calling partner)
+		- Check permissions
+		- Wait for a calling partner to connect
+		- Send 0x01 (OK), 0x03 (OK, conference) or 0x02
+		  (No calling partner)
 
 		Return:
 		  True if handshake succeeded, else False
@@ -236,45 +591,73 @@ class AudioTransferThread(threading.Thread):
 
 			if not self.callid or len(self.callid) != 16:
 				LOG.warning("AudioThread[{}]: Failed to recv callid!"\
-					.format(self.userid))
+					.format(self.fd.addr))
 				return False
 
 			self.callidx = self.callid.hex()[:16]
 
 		except Exception as e:
 			LOG.error("AudioThread[{}]: recv callid, {}"\
-				.format(self.userid, e))
+				.format(self.fd.addr, e))
 			return False
 
-		# Get according callroom
-		self.callroom = self.aserv.get_callroom(self.callid)
-		self.callroom.add_caller(self)
+		# Get according callroom, if the room is removed
+		# before we joined, the next one is taken.
+		while True:
+			self.callroom = self.aserv.calls.join(self.callid,
+					self.aserv.is_conference(self.callid))
+			if not self.callroom:
+				LOG.warning("AudioServer: Too many calls, "\
+					"refused {}".format(self.fd.addr))
+				self.send(b'2')
+				return False
 
-		timeout_sec=10
+			if self.callroom.is_full():
+				# The stream of a two-party call can't
+				# be shared with a further participant.
+				LOG.warning("AudioServer: Two-party call {} "\
+					"is full, refused {}".format(
+					self.callidx, self.fd.addr))
+				self.send(b'2')
+				return False
 
-		LOG.debug("AudioThread[{}]: Waiting for calling partner ..."\
-			.format(self.userid))
+			self.userid = self.aserv.authorize(self.callid,
+					self.fd.addr,
+					[t.userid for t in self.callroom.threads])
+			if not self.userid:
+				# Client has no permissions to connect
+				# to the audio server, since it's not
+				# connected to the chatserver or not
+				# part of the call.
+				LOG.warning("AudioServer: No perm "\
+					"{}".format(self.fd.addr))
+				self.aserv.calls.leave(self.callroom)
+				return False
 
-		while not self.callroom.is_full():
+			if self.callroom.add_caller(self):
+				break
 
-			if timeout_sec == 0:
-				# Calling partner dindn't join the call
-				# within 10 seconds, send b'2' to client.
-				LOG.debug("AudioThread[{}]: No one joined"\
-					" the call within 10 sec :-("\
-						.format(self.userid))
-				self.send(b'2')
-				return False
+		LOG.debug("AudioThread[{}]: Waiting for calling partner ..."\
+			.format(self.userid))
 
-			time_sleep(1)
-			timeout_sec -= 1
+		if not self.callroom.wait_partners(self, RENDEZVOUS_TIMEOUT):
+			# Calling partner dindn't join the call
+			# in time, send b'2' to client.
+			LOG.debug("AudioThread[{}]: No one joined"\
+				" the call within {} sec :-("\
+				.format(self.userid, RENDEZVOUS_TIMEOUT))
+			self.aserv.setup_timeout()
+			self.aserv.calls.leave(self.callroom)
+			self.send(b'2')
+			return False
 
 
-		# The calling partner joined the call.
-		# Send b'1' to the client.
-		LOG.debug("AudioThread[{}]: Found calling partner {}"\
-			.format(self.userid, self.partner.userid))
-		self.send(b'1')
+		# The calling partner joined the call. Send b'1'
+		# to the client, b'3' if the call is a conference.
+		self.wait = monotonic() - self.joined
+		LOG.debug("AudioThread[{}]: Found {} calling partner(s)"\
+			.format(self.userid, len(self.callroom.threads) - 1))
+		self.send(b'3' if self.callroom.conference else b'1')
 
 		return True
 
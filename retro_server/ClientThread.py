@@ -3,6 +3,7 @@ from os.path import join as path_join
 from os.path import exists as path_exists
 from threading import Thread
 from time import sleep as time_sleep
+from time import perf_counter
 from base64 import b64encode,b64decode
 import logging
 
@@ -10,6 +11,7 @@ from libretro.protocol import *
 from libretro.crypto import RetroPublicKey
 
 from . MsgStore import MsgStore
+from . import Metrics
 
 """\
 Client Thread.
@@ -21,6 +23,22 @@ accepted by the RetroServer.
 
 LOG = logging.getLogger(__name__)
 
+HANDSHAKES = Metrics.counter('retro_handshakes_total',
+		'Chat handshakes', ('result',))
+PACKETS    = Metrics.counter('retro_packets_total',
+		'Packets received from chat clients', ('type',))
+UNKNOWN    = Metrics.counter('retro_packets_unknown_total',
+		'Packets of unknown type received from chat clients')
+FORWARD_LATENCY = Metrics.histogram('retro_forward_seconds',
+		'Time to forward (or store) a chat/file message')
+HANDLER_LATENCY = Metrics.histogram('retro_handler_seconds',
+		'Time spent handling a packet in the chat loop '\
+		'(sampled)', ('type',))
+
+# Packet type names used as metric labels
+PACKET_NAMES = {v:k for k,v in vars(Proto).items()
+		if k.startswith('T_') and isinstance(v, int)}
+
 class ClientThread(Thread):
 
 	def __init__(self, serv, conn):
@@ -41,6 +59,20 @@ class ClientThread(Thread):
 		self.userid = None	# Clients userid
 		self.frids  = []	# ID's of all friends of client
 		self.done   = False	# Is finished ?
+		self.npackets = 0	# Packets handled in chat loop
+
+		# Handlers of the chat loop, key=packet type
+		self.handlers = {
+			Proto.T_CHATMSG     : self.forward_message,
+			Proto.T_FILEMSG     : self.forward_message,
+			Proto.T_FRIENDS     : self.query_friends,
+			Proto.T_GET_PUBKEY  : self.add_friend,
+			Proto.T_START_CALL  : self.forward_call_message,
+			Proto.T_ACCEPT_CALL : self.forward_call_message,
+			Proto.T_STOP_CALL   : self.forward_call_message,
+			Proto.T_REJECT_CALL : self.forward_call_message,
+			Proto.T_GOODBYE     : self.goodbye
+		}
 
 	def run(self):
 		"""\
@@ -113,7 +145,7 @@ class ClientThread(Thread):
 			return False
 
 		# Add user to RetroServer.users
-		self.serv.users.append(new_userid)
+		self.serv.add_user(new_userid)
 
 		# Delete registration key from db
 		self.servDb.delete_regkey(regkey)
@@ -133,10 +165,12 @@ class ClientThread(Thread):
 		"""
 
 		if not self.handshake(pckt):
+			HANDSHAKES.labels('failed').inc()
 			return
+		HANDSHAKES.labels('ok').inc()
 		LOG.debug("User {} connected".format(self.userid.hex()))
 
-		self.serv.conns[self.userid] = self
+		self.serv.add_conn(self)
 		self.send_unreceived_messages()
 
 		while not self.done:
@@ -151,51 +185,41 @@ class ClientThread(Thread):
 				LOG.error("ClientThread: "+str(e))
 				break
 
-
-			if pckt[0] == Proto.T_CHATMSG:
-				# Forward chat message
-				self.forward_message(pckt)
-
-			elif pckt[0] == Proto.T_FILEMSG:
-				# Forward file message
-				self.forward_message(pckt)
-
-			elif pckt[0] == Proto.T_FRIENDS:
-				# Client queries the connection status
-				# of all it's friends.
-				self.update_friends(pckt)
-				self.send_status_to_all_friends(
-					Proto.T_FRIEND_ONLINE)
-
-			elif pckt[0] == Proto.T_GET_PUBKEY:
-				# Add friend
-				self.add_friend(pckt)
-
-			elif pckt[0] in (Proto.T_START_CALL,
-					 Proto.T_ACCEPT_CALL,
-					 Proto.T_STOP_CALL,
-					 Proto.T_REJECT_CALL):
-				# Messages referring to audio calls, are
-				# forwarded to the receiver directly.
-				to = pckt[1][8:16]
-				if to in self.serv.conns:
-					self.serv.conns[to]\
-						.send_packet(pckt[0], pckt[1])
-
-			elif pckt[0] == Proto.T_GOODBYE:
-				# Disconnect
-				break
-
-			else:
-				LOG.warning("ClientThread.recv: Invalid "\
-					"message-type '{}'".format(pckt[0]))
+			self.dispatch(pckt)
 
 
 		self.send_status_to_all_friends(Proto.T_FRIEND_OFFLINE)
 		LOG.debug("User {} disconnected".format(self.userid.hex()))
 
 		# Remove client from self.serv
-		self.serv.conns.pop(self.userid)
+		self.serv.remove_conn(self)
+
+
+	def dispatch(self, pckt):
+		"""\
+		Pass packet to the handler of its type. Every
+		[metrics] sample'th packet the time spent in the
+		handler is recorded (0 = never).
+		"""
+		handler = self.handlers.get(pckt[0])
+		if not handler:
+			UNKNOWN.inc()
+			LOG.warning("ClientThread.recv: Invalid "\
+				"message-type '{}'".format(pckt[0]))
+			return
+
+		name = PACKET_NAMES.get(pckt[0], pckt[0])
+		PACKETS.labels(name).inc()
+
+		sample = self.conf.metrics_sample
+		self.npackets += 1
+		if not sample or self.npackets % sample:
+			handler(pckt)
+			return
+
+		start = perf_counter()
+		handler(pckt)
+		HANDLER_LATENCY.labels(name).observe(perf_counter() - start)
 
 
 	def handshake(self, pckt):
@@ -204,7 +228,7 @@ class ClientThread(Thread):
 		- Check if user is 'registered'
 		- Load user's pubkey
 		- Verify signature with pubkey
-		- Send T_SUCCESS or T_ERROR
+		- Send T_SUCCESS + transfer token or T_ERROR
 
 		Args:
 		  pckt: T_HELLO packet
@@ -233,7 +257,7 @@ class ClientThread(Thread):
 			return False
 
 		# Check if user is already connected
-		if userid in self.serv.conns:
+		if self.serv.get_conn(userid):
 			LOG.debug("Handshake: "\
 				+useridx+" is already connected")
 			self.conn.send_packet(Proto.T_ERROR,
@@ -255,11 +279,15 @@ class ClientThread(Thread):
 			return False
 		else:
 			# Authenticated :-)
+			# The transfer token authorizes the client
+			# at the fileserver (see SessionTable.py).
 			self.userid = userid
-			self.conn.send_packet(Proto.T_SUCCESS)
+			self.conn.send_packet(Proto.T_SUCCESS,
+				self.serv.issue_token(userid))
 			return True
 
 
+	@Metrics.timed(FORWARD_LATENCY)
 	def forward_message(self, pckt):
 		"""\
 		Forward message-type 'message' and 'file-message'
@@ -278,17 +306,65 @@ class ClientThread(Thread):
 				"Receiver {} doesn't exist!"\
 				.format(tox).encode())
 		else:
-			if to in self.serv.conns:
-				# Client is online, send message
-				self.serv.conns[to].send_packet(
-					pckt[0], pckt[1])
-			else:
+			# If client is online send message, otherwise
+			# store it.
+			conn = self.serv.get_conn(to)
+			if not conn or not conn.send_packet(pckt[0], pckt[1]):
 				# Client is offline, store message
 				LOG.debug("forward_msg: receiver {} "\
 					"is offline".format(tox))
 				self.serv.msgStore.store_msg(pckt[0], pckt[1])
 
 
+	def query_friends(self, pckt):
+		"""\
+		Client queries the connection status of all
+		it's friends (T_FRIENDS).
+		"""
+		self.update_friends(pckt)
+		self.send_status_to_all_friends(Proto.T_FRIEND_ONLINE)
+
+
+	def forward_call_message(self, pckt):
+		"""\
+		Messages referring to audio calls, are forwarded
+		to the receiver directly (T_START_CALL, ...).
+		"""
+		if not pckt[1] or len(pckt[1]) < 16:
+			LOG.warning("ClientThread.forward_call: "\
+				"Invalid packet format")
+			return
+
+		to = pckt[1][8:16]
+
+		if len(pckt[1]) >= 32:
+			# The callee's T_ACCEPT_CALL confirms the
+			# invitation, the callid then authorizes
+			# the partners at the audioserver.
+			callid = pckt[1][16:32]
+			if pckt[0] == Proto.T_START_CALL:
+				ok = self.serv.invite_call(callid,
+						self.userid, to)
+			elif pckt[0] == Proto.T_ACCEPT_CALL:
+				ok = self.serv.add_call_token(callid,
+						self.userid, to)
+			else:	ok = True
+			if not ok:
+				LOG.warning("ClientThread.forward_call: "\
+					"{} not authorized for call {}"\
+					.format(self.userid.hex(),
+					callid.hex()[:16]))
+				return
+		conn = self.serv.get_conn(to)
+		if conn:
+			conn.send_packet(pckt[0], pckt[1])
+
+
+	def goodbye(self, pckt):
+		""" Client disconnects (T_GOODBYE) """
+		self.done = True
+
+
 	def update_friends(self, pckt):
 		"""\
 		Forward message-type T_FRIENDS.
@@ -377,9 +453,9 @@ class ClientThread(Thread):
 		to all friends.
 		"""
 		for frid in self.frids:
-			if frid in self.serv.conns:
-				self.serv.conns[frid]\
-					.send_packet(status, self.userid)
+			conn = self.serv.get_conn(frid)
+			if conn:
+				conn.send_packet(status, self.userid)
 
 
 	def create_user(self, userid, pubkey_bytes):
@@ -410,3 +486,4 @@ class ClientThread(Thread):
 
 	def send_packet(self, pckt_type, *pckt_data):
 		self.conn.send_packet(pckt_type, *pckt_data)
+		return True
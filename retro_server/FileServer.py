@@ -1,24 +1,254 @@
-from os.path import join as path_join
 from os.path import exists as path_exists
 from os import remove as os_remove
 from os import stat as os_stat
 
+import os
+import errno
+import hashlib
+import queue
 import struct
 import threading
 import logging
 
+from time import monotonic
+from time import sleep as time_sleep
+
 from libretro.protocol import Proto
+from libretro.net import can_read
+from libretro.crypto import random_buffer
+
 from . TLSListener import TLSListener
+from . UploadStore import UploadStore
+from . SessionTable import SessionTable
+from . Janitor import Janitor
+from . import Metrics
 
 """\
 The fileserver manages the filetransfers between a client
 and the server. It is implemented for running as a thread.
 
+Accepted connections are served by a fixed pool of transfer
+threads (see TransferPool), further connections wait in a
+bounded queue. The bandwidth may be limited globally and per
+user by token buckets (see TokenBucket).
+
+Initial packet of a transfer:
+
+  T_FILE_UPLOAD:   fileid(16) + filesize(4) + [options]
+  T_FILE_DOWNLOAD: fileid(16) + [options]
+
+Options are optional trailing fields, each one encoded
+as type(1) + length(2) + value:
+
+  OPT_TOKEN   Transfer token (see SessionTable.py)
+  OPT_RESUME  Resume token of upload (16) or empty
+  OPT_OFFSET  First byte to download (8)
+  OPT_LENGTH  Number of bytes to download (8)
+  OPT_PART    Part of chunked transfer: index(4) + count(4)
+              + filesize(8), see get_part_range()
+  OPT_RECIPIENTS
+              Upload serves several downloads: count(2) +
+              ttl(4), see get_fanout()
+  OPT_DIGEST  Upload: SHA-256 of the complete file (32),
+              verified while the file is received.
+              Download: empty, requests the digest which is
+              appended to T_SUCCESS as option OPT_DIGEST.
 
 """
 
 LOG = logging.getLogger(__name__)
 
+OPT_TOKEN  = 0x01
+OPT_RESUME = 0x02
+OPT_OFFSET = 0x03
+OPT_LENGTH = 0x04
+OPT_PART   = 0x05
+OPT_RECIPIENTS = 0x06
+OPT_DIGEST = 0x07
+
+DIGEST_SIZE = 32
+
+RESUME_TOKEN_SIZE = 16
+
+# Seconds between purges of idle bandwidth buckets
+PURGE_INTERVAL = 60
+
+TRANSFER_BYTES = Metrics.counter('retro_transfer_bytes_total',
+		'Bytes up- and downloaded')
+
+
+def rate_str(nbytes, seconds):
+	"""\
+	Returns transfer rate as string (e.g. '12.5 MB/s').
+	"""
+	if seconds <= 0:
+		return "- MB/s"
+	return "{:.1f} MB/s".format(nbytes / seconds / 1000000)
+
+
+def preallocate(f, size):
+	"""\
+	Reserve 'size' bytes of disk space for file 'f'.
+	Raise:
+	  OSError: Not enough disk space
+	"""
+	if size <= 0 or not hasattr(os, 'posix_fallocate'):
+		return
+	try:
+		os.posix_fallocate(f.fileno(), 0, size)
+	except OSError as e:
+		# Filesystem doesn't support fallocate
+		if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+			raise
+
+
+def hash_file(path, bufsize, nbytes=None, hasher=None):
+	"""\
+	Hash the contents of a file.
+	Args:
+	  path:    Path to file
+	  bufsize: Size of read buffer
+	  nbytes:  Number of bytes to hash (default: all)
+	  hasher:  hashlib object to update (default: new
+	           SHA-256 object)
+	Return:
+	  The hashlib object
+	"""
+	if hasher is None:
+		hasher = hashlib.sha256()
+	buf  = memoryview(bytearray(bufsize))
+	left = nbytes
+	with open(path, "rb") as f:
+		while left is None or left > 0:
+			size = len(buf) if left is None\
+				else min(len(buf), left)
+			n = f.readinto(buf[:size])
+			if not n: break
+			hasher.update(buf[:n])
+			if left is not None:
+				left -= n
+	return hasher
+
+
+def recv_into(sock, buf, timeout_sec=None):
+	"""\
+	Receive from (TLS-)socket into given buffer.
+	Return:
+	  Number of bytes received (0 if closed)
+	  None if timeout exceeded
+	"""
+	pending = sock.pending() if hasattr(sock, 'pending') else 0
+	if not pending and not can_read(sock, timeout_sec):
+		return None
+	return sock.recv_into(buf)
+
+
+def get_uint_option(opts, typ, default=None):
+	"""\
+	Get option value as unsigned integer (1, 2, 4 or 8 byte).
+	Raise:
+	  ValueError: Invalid option size
+	"""
+	if typ not in opts:
+		return default
+	fmt = {1:'!B', 2:'!H', 4:'!I', 8:'!Q'}.get(len(opts[typ]))
+	if not fmt:
+		raise ValueError("Invalid size of option {}".format(typ))
+	return struct.unpack(fmt, opts[typ])[0]
+
+
+def get_part_range(opts):
+	"""\
+	Get the byte range of a part of a chunked transfer.
+	A file of 'filesize' bytes is split into 'count' parts
+	of ceil(filesize/count) bytes, the last part may be
+	smaller.
+	Return:
+	  (index, count, filesize, offset, length) or None
+	  if option OPT_PART isn't given.
+	Raise:
+	  ValueError: Invalid option
+	"""
+	if OPT_PART not in opts:
+		return None
+	if len(opts[OPT_PART]) != 16:
+		raise ValueError("Invalid size of option OPT_PART")
+
+	idx,count,filesize = struct.unpack('!IIQ', opts[OPT_PART])
+	if count == 0 or idx >= count:
+		raise ValueError("Invalid part {}/{}".format(idx, count))
+
+	partsize = -(-filesize // count)
+	offset   = min(idx * partsize, filesize)
+	length   = min(partsize, filesize - offset)
+	return idx, count, filesize, offset, length
+
+
+def get_fanout(opts):
+	"""\
+	Get the fan-out of an upload. The file is deleted after
+	'count' complete downloads or 'ttl' seconds after the
+	upload, whatever comes first. A count of 0 means no
+	limit of downloads, a ttl of 0 no expiry.
+	Return:
+	  (count, ttl) or None if option OPT_RECIPIENTS isn't
+	  given.
+	Raise:
+	  ValueError: Invalid option
+	"""
+	if OPT_RECIPIENTS not in opts:
+		return None
+	if len(opts[OPT_RECIPIENTS]) != 6:
+		raise ValueError("Invalid size of option OPT_RECIPIENTS")
+
+	count,ttl = struct.unpack('!HI', opts[OPT_RECIPIENTS])
+	if not count and not ttl:
+		raise ValueError("Fan-out needs recipients or ttl")
+	return count, ttl
+
+
+def get_digest_option(opts):
+	"""\
+	Get the file digest of an upload.
+	Return:
+	  Digest (32 byte) or None if OPT_DIGEST isn't given.
+	Raise:
+	  ValueError: Invalid option size
+	"""
+	digest = opts.get(OPT_DIGEST)
+	if digest is not None and len(digest) != DIGEST_SIZE:
+		raise ValueError("Invalid size of option OPT_DIGEST")
+	return digest
+
+
+def pack_option(typ, value):
+	"""\
+	Returns option encoded as type(1) + length(2) + value.
+	"""
+	return struct.pack('!BH', typ, len(value)) + value
+
+
+def parse_options(buf):
+	"""\
+	Parse options of initial packet.
+	Return:
+	  Dictionary with key=option type, value=option value
+	Raise:
+	  ValueError: Invalid option format
+	"""
+	opts = {}
+	i = 0
+	while i < len(buf):
+		if i+3 > len(buf):
+			raise ValueError("Truncated option header")
+		typ,n = struct.unpack('!BH', buf[i:i+3])
+		if i+3+n > len(buf):
+			raise ValueError("Truncated option {}".format(typ))
+		opts[typ] = buf[i+3:i+3+n]
+		i += 3+n
+	return opts
+
+
 class FileServer(threading.Thread):
 
 	def __init__(self, server):
@@ -35,8 +265,30 @@ class FileServer(threading.Thread):
 		self.fserv = TLSListener(server.conf,
 				'fileserver')
 
-		# List with TLSConn handles
-		self.conns = []
+		# Transfer threads and queue of waiting connections
+		self.pool = TransferPool(
+				self.conf.fileserver_max_transfers,
+				self.conf.fileserver_max_queued,
+				self.conf.fileserver_max_transfers_per_user)
+		# Bandwidth limits, global and per user (key=userid)
+		self.bucket = TokenBucket(self.conf.fileserver_rate_limit)
+		self.user_buckets = {}
+		# Bytes transferred and time of last get_stats() call,
+		# used to compute the transfer rate.
+		self.nbytes = 0
+		self.last_stats = (monotonic(), 0)
+		# Bytes reserved by running uploads
+		self.budget = UploadBudget(
+				self.conf.fileserver_upload_budget)
+		# State of uploaded files
+		self.store = UploadStore(self.conf)
+		# Cleanup of uploaddir
+		self.janitor = Janitor(self)
+		# Parts of chunked downloads which have been sent,
+		# key=(fileid, userid of downloader),
+		# value=[set(part indices), time of last part]
+		self.download_parts = {}
+		self.lock = threading.Lock()
 		# Fileserver is done?
 		self.done = True
 
@@ -51,29 +303,35 @@ class FileServer(threading.Thread):
 			return False
 
 		self.done = False
+		next_purge = monotonic() + PURGE_INTERVAL
+		self.pool.start()
+		self.janitor.start()
 
 		while not self.done:
 			try:
+				if monotonic() >= next_purge:
+					self.__purge_user_buckets()
+					next_purge = monotonic()\
+						+ PURGE_INTERVAL
+
 				# Accept TLS connection
 				conn = self.fserv.accept(
 						self.conf.accept_timeout)
 				if not conn: continue
 
-				# Check if connected user has permissions
-				# to up/download files.
-				if not self.serv.get_conn_by_address(conn.host):
-					LOG.debug("FileServer: No perm "\
-						"{}".format(conn.host))
-					conn.close()
-					continue
-
+				# Permissions are checked by the transfer
+				# thread (see FileTransferThread.authorize).
 				LOG.debug("FileServer: accepted " +\
 					conn.tostr())
 
-				# Starting file transfer thread
-				cli = FileTransferThread(self, conn)
-				self.conns.append(cli)
-				cli.start()
+				# Queue transfer for the transfer threads
+				if not self.pool.submit(FileTransfer(self, conn)):
+					LOG.warning("FileServer: too many "\
+						"transfers, refused {}"\
+						.format(conn.host))
+					conn.send_packet(Proto.T_ERROR,
+						b"Server busy, try again later")
+					conn.close()
 
 			except Exception as e:
 				LOG.error("FileServer.run: "+str(e))
@@ -84,183 +342,1021 @@ class FileServer(threading.Thread):
 
 		LOG.info("Shutting down fileserver")
 		self.fserv.close()
+		self.pool.stop()
+		self.janitor.stop()
+		return True
+
+
+	def throttle(self, userid, nbytes):
+		"""\
+		Account 'nbytes' transferred for given user. Blocks
+		as long as the user's or the global bandwidth limit
+		is exceeded.
+		"""
+		TRANSFER_BYTES.inc(nbytes)
+		with self.lock:
+			self.nbytes += nbytes
+			bucket = self.user_buckets.get(userid)
+			if not bucket:
+				bucket = TokenBucket(
+					self.conf.fileserver_user_rate_limit)
+				self.user_buckets[userid] = bucket
+		bucket.consume(nbytes)
+		self.bucket.consume(nbytes)
+
+
+	def is_shaped(self):
+		"""\
+		Returns True if any bandwidth limit is set.
+		"""
+		return bool(self.conf.fileserver_rate_limit
+			or self.conf.fileserver_user_rate_limit)
+
+
+	def download_part_done(self, fileid, userid, idx, count):
+		"""\
+		Mark part of chunked download as sent. The parts
+		are tracked per downloader, so several downloads
+		of a file with fan-out don't mix.
+		Return:
+		  True if all parts have been sent to given user,
+		  else False
+		"""
+		key = (fileid, userid)
+		with self.lock:
+			entry = self.download_parts.setdefault(key,
+					[set(), 0])
+			entry[0].add(idx)
+			entry[1] = monotonic()
+			if len(entry[0]) < count:
+				return False
+			self.download_parts.pop(key)
+			return True
+
+
+	def purge_download_parts(self, max_age):
+		"""\
+		Forget chunked downloads without a part sent within
+		max_age seconds (abandoned downloads).
+		Return:
+		  Number of removed downloads
+		"""
+		now = monotonic()
+		with self.lock:
+			stale = [k for k,(_,t) in self.download_parts.items()
+					if now - t >= max_age]
+			for key in stale:
+				del self.download_parts[key]
+		return len(stale)
+
+
+	def get_stats(self):
+		"""\
+		Returns dictionary with fileserver statistics.
+		"""
+		now = monotonic()
+		with self.lock:
+			tlast,nlast = self.last_stats
+			self.last_stats = (now, self.nbytes)
+			nbytes = self.nbytes
 
-		for conn in self.conns:
+		stats = self.budget.get_stats()
+		stats.update(self.pool.get_stats())
+		stats.update(self.janitor.get_stats())
+		stats['transfer_bytes'] = nbytes
+		stats['transfer_rate']  = rate_str(nbytes-nlast, now-tlast)
+		if self.conf.fileserver_dedup:
+			stats.update(self.store.get_blob_stats())
+		return stats
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __purge_user_buckets(self):
+		"""\
+		Remove bandwidth buckets of users without active
+		transfers.
+		"""
+		active = self.pool.get_userids()
+		with self.lock:
+			for userid in list(self.user_buckets):
+				if userid not in active:
+					del self.user_buckets[userid]
+
+
+
+class UploadBudget:
+	"""\
+	Global budget of bytes, which may be reserved by running
+	uploads to uploaddir. New uploads are refused if the
+	budget is exhausted.
+	"""
+	def __init__(self, limit):
+		"""\
+		Args:
+		  limit: Budget in bytes (0 = unlimited)
+		"""
+		self.limit     = limit
+		self.used      = 0	# Bytes reserved
+		self.admitted  = 0	# Number of admitted uploads
+		self.rejected  = 0	# Number of rejected uploads
+		self.lock      = threading.Lock()
+
+
+	def reserve(self, nbytes):
+		"""\
+		Reserve bytes for an upload.
+		Return:
+		  True on success, False if budget is exhausted
+		"""
+		with self.lock:
+			if self.limit and self.used + nbytes > self.limit:
+				self.rejected += 1
+				return False
+			self.used += nbytes
+			self.admitted += 1
+			return True
+
+
+	def release(self, nbytes):
+		"""\
+		Release bytes of a finished upload.
+		"""
+		with self.lock:
+			self.used -= nbytes
+
+
+	def reject(self):
+		""" Count upload rejected for other reasons """
+		with self.lock:
+			self.rejected += 1
+
+
+	def get_stats(self):
+		return {
+			'upload_budget_limit'    : self.limit,
+			'upload_budget_used'     : self.used,
+			'uploads_admitted'       : self.admitted,
+			'uploads_rejected'       : self.rejected
+		}
+
+
+
+class TransferPool:
+	"""\
+	Fixed number of threads running the FileTransfers.
+	Transfers wait in a bounded FIFO queue until a thread
+	becomes free, if the queue is full new connections are
+	refused. The connections of each user are counted once
+	authorized (see add_user), so a single user can't keep
+	all threads busy.
+	"""
+	def __init__(self, nthreads, max_queued, max_per_user=0):
+		"""\
+		Args:
+		  nthreads:     Number of transfer threads
+		  max_queued:   Max. number of waiting transfers
+		  max_per_user: Max. number of connections of a
+		                user (0 = unlimited)
+		"""
+		self.nthreads = max(nthreads, 1)
+		self.queue    = queue.Queue(max(max_queued, 1))
+		self.threads  = []
+		self.active   = set()	# Running FileTransfers
+		self.accepted = 0	# Number of queued transfers
+		self.rejected = 0	# Number of refused transfers
+		self.max_per_user = max_per_user
+		self.users    = {}	# Connections, key=userid
+		self.limited  = 0	# Refused by per user limit
+		self.lock     = threading.Lock()
+
+
+	def start(self):
+		"""\
+		Start the transfer threads.
+		"""
+		for i in range(self.nthreads):
+			thread = threading.Thread(target=self.__work,
+					daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+
+	def submit(self, transfer):
+		"""\
+		Queue transfer for the next free thread.
+		Return:
+		  True on success, False if queue is full
+		"""
+		try:
+			self.queue.put_nowait(transfer)
+		except queue.Full:
+			with self.lock:
+				self.rejected += 1
+			return False
+		with self.lock:
+			self.accepted += 1
+		return True
+
+
+	def waiting(self):
+		""" Returns number of waiting transfers """
+		return self.queue.qsize()
+
+
+	def add_user(self, userid):
+		"""\
+		Count authorized connection of given user.
+		Return:
+		  False if the user has max_per_user connections
+		  already, the connection must be refused.
+		"""
+		with self.lock:
+			n = self.users.get(userid, 0)
+			if self.max_per_user and n >= self.max_per_user:
+				self.limited += 1
+				return False
+			self.users[userid] = n + 1
+			return True
+
+
+	def remove_user(self, userid):
+		""" Release connection counted by add_user """
+		with self.lock:
+			n = self.users.get(userid, 0) - 1
+			if n > 0:
+				self.users[userid] = n
+			else:	self.users.pop(userid, None)
+
+
+	def get_userids(self):
+		""" Returns set with users of running transfers """
+		with self.lock:
+			return set(t.userid for t in self.active)
+
+
+	def stop(self):
+		"""\
+		Stop running transfers, close waiting ones and join
+		the transfer threads.
+		"""
+		with self.lock:
+			for transfer in self.active:
+				transfer.done = True
+
+		while True:
 			try:
-				conn.done = True
-				conn.join()
+				transfer = self.queue.get_nowait()
+			except queue.Empty:
+				break
+			transfer.conn.close()
+
+		for thread in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			try:
+				thread.join()
 			except Exception as e:
 				LOG.warning("Failed to join thread: " + str(e))
+		self.threads = []
 
-		return True
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				'transfers_active'   : len(self.active),
+				'transfers_queued'   : self.queue.qsize(),
+				'transfers_accepted' : self.accepted,
+				'transfers_rejected' : self.rejected,
+				'transfers_user_limited' : self.limited
+			}
+
+
+	def __work(self):
+		"""\
+		Transfer thread main loop.
+		"""
+		while True:
+			transfer = self.queue.get()
+			if transfer is None:
+				return
+
+			with self.lock:
+				self.active.add(transfer)
+			try:
+				transfer.run()
+			except Exception as e:
+				LOG.error("TransferPool: " + str(e))
+			finally:
+				with self.lock:
+					self.active.discard(transfer)
+
+
+
+class TokenBucket:
+	"""\
+	Token bucket for limiting the bandwidth. Tokens (bytes)
+	are refilled at 'rate' per second up to one second worth
+	of tokens. Consumers may overdraw the bucket and then
+	sleep until the debt is paid off, so concurrent
+	transfers share the bandwidth.
+	"""
+	def __init__(self, rate):
+		"""\
+		Args:
+		  rate: Bytes per second (0 = unlimited)
+		"""
+		self.rate   = rate
+		self.tokens = rate
+		self.stamp  = monotonic()
+		self.lock   = threading.Lock()
 
 
+	def consume(self, nbytes):
+		"""\
+		Take 'nbytes' tokens, blocks until they are covered.
+		"""
+		if not self.rate:
+			return
+
+		with self.lock:
+			now = monotonic()
+			self.tokens = min(self.rate, self.tokens\
+				+ (now - self.stamp) * self.rate)
+			self.stamp   = now
+			self.tokens -= nbytes
+			wait = -self.tokens / self.rate
+
+		if wait > 0:
+			time_sleep(wait)
+
 
-class FileTransferThread(threading.Thread):
+
+class FileTransfer:
 	"""\
-	Thread which either sends file to client (download)
-	or receives file from client (upload).
+	Serves a fileserver connection, which either sends files
+	to the client (download) or receives files from the
+	client (upload). Run by a thread of the TransferPool.
 	"""
 	def __init__(self, fileserv, conn):
-		super().__init__()
-		self.fserv = fileserv
-		self.conf  = fileserv.conf
-		self.conn  = conn
+		self.fserv  = fileserv
+		self.conf   = fileserv.conf
+		self.conn   = conn
+		self.userid = None	# Userid of authorized client
+		self.done   = False	# Transfer done?
 
 
 	def run(self):
 		"""\
-		Run the filethread for either uploading or
-		downloading a file.
+		Run the filethread for uploading and downloading
+		files. A connection may carry a sequence of
+		transfers, after each transfer the next initial
+		packet is awaited for fileserver_idle_timeout
+		seconds.
 		"""
 		LOG.debug("FileServer: waiting for initial packet ...")
 
-		# Receive initial packet (type,fileid,size)
-		pckt = self.__recv_initial_packet()
-		if not pckt: return
+		timeout    = self.conf.recv_timeout
+		ntransfers = 0
+		counted    = False	# Counted by pool.add_user?
 
-		# Start up/download
-		try:
-			if pckt[0] == Proto.T_FILE_UPLOAD:
-				self.do_upload(pckt)
-			else:	self.do_download(pckt)
-		except Exception as e:
-			LOG.error("FileTransferThread: "+str(e))
+		while not self.done:
+			# Receive initial packet (type,fileid,size)
+			pckt = self.__recv_initial_packet(timeout,
+					ntransfers > 0)
+			if not pckt: break
+
+			# Start up/download
+			try:
+				if self.userid is None\
+				   and not self.authorize(pckt[2]):
+					LOG.debug("FileServer: No perm "\
+						"{}".format(self.conn.host))
+					self.conn.send_packet(Proto.T_ERROR,
+						b"Permission denied")
+					break
+				if not counted:
+					if not self.fserv.pool.add_user(self.userid):
+						LOG.warning("FileServer: too many "\
+							"transfers of {}, refused {}"\
+							.format(self.userid.hex(),
+							self.conn.host))
+						self.conn.send_packet(Proto.T_ERROR,
+							b"Too many transfers, try "\
+							b"again later")
+						break
+					counted = True
+				if pckt[0] == Proto.T_FILE_UPLOAD:
+					ok = self.do_upload(pckt)
+				else:	ok = self.do_download(pckt)
+			except Exception as e:
+				LOG.error("FileTransfer: "+str(e))
+				break
+
+			# Connection can't be reused after a
+			# broken transfer.
+			if not ok: break
+
+			ntransfers += 1
+			timeout = self.conf.fileserver_idle_timeout
+
+			# Don't keep the thread busy with an idle
+			# connection while others are waiting.
+			if self.fserv.pool.waiting():
+				break
+
+		if counted:
+			self.fserv.pool.remove_user(self.userid)
+		LOG.debug("FileServer: closing {} after {} transfer(s)"\
+			.format(self.conn.host, ntransfers))
 
-		# Close connection and remove it from connection
-		# dictionary.
 		self.conn.close()
-		self.fserv.conns.remove(self)
+
+
+	def authorize(self, opts):
+		"""\
+		Check if connected user has permissions to
+		up/download files. The user is identified by the
+		transfer token option or (if missing) by the
+		address of the connection.
+		Return:
+		  True if authorized, else False
+		"""
+		serv = self.fserv.serv
+
+		if OPT_TOKEN in opts:
+			# Only transfer tokens, call ids don't
+			# authorize file transfers.
+			userids = serv.sessions.check_token(opts[OPT_TOKEN],
+					SessionTable.TRANSFER)
+			if userids:
+				self.userid = userids[0]
+		else:
+			conn = serv.get_conn_by_address(self.conn.host)
+			if conn:
+				self.userid = conn.userid
+
+		return self.userid is not None
 
 
 	def do_upload(self, pckt):
 		"""\
 		Do a fileupload.
+		Returns False if the connection is unusable
+		afterwards (transfer broke), else True.
+		If option OPT_RESUME is given, the upload can be
+		resumed if interrupted: An empty value requests a
+		resume token, which is sent back with T_SUCCESS
+		(token(16) + offset(4)). To resume, the client sends
+		the same fileid and filesize with the resume token
+		and continues at the returned offset.
+		With option OPT_RECIPIENTS the file serves several
+		downloads, see get_fanout(). With option OPT_DIGEST
+		the contents are verified while they are received,
+		an upload with wrong digest is discarded.
 		"""
 		fileid   = pckt[1][:16]
-		filesize = struct.unpack('!I', pckt[1][16:])[0]
-		filepath = path_join(self.conf.uploaddir, fileid.hex())
-		timeout  = self.conf.recv_timeout
+		filesize = struct.unpack('!I', pckt[1][16:20])[0]
+		opts     = pckt[2]
+		offset   = 0
+		token    = None
+
+		try:
+			fanout = get_fanout(opts)
+			digest = get_digest_option(opts)
+		except ValueError as e:
+			self.conn.send_packet(Proto.T_ERROR, str(e).encode())
+			return True
+
+		if OPT_PART in opts:
+			return self.do_upload_part(fileid, filesize, opts,
+					fanout, digest)
 
-		LOG.debug("FileServer: uploading file " + filepath)
+		if OPT_RESUME in opts:
+			if opts[OPT_RESUME]:
+				# Resume partial upload
+				entry = self.fserv.store.get(fileid)
+				if not entry or entry['complete']\
+				   or entry['token'] != opts[OPT_RESUME]\
+				   or entry['size'] != filesize:
+					LOG.warning("FileServer.upload: invalid"\
+						" resume of {}".format(fileid.hex()))
+					self.conn.send_packet(Proto.T_ERROR,
+						b"Invalid resume token")
+					return True
+				token  = entry['token']
+				offset = entry['nrecv']
+			else:
+				token = random_buffer(RESUME_TOKEN_SIZE)
+
+		# Check size and reserve space before any
+		# byte is transferred.
+		err = self.admit_upload(filesize)
+		if err:
+			LOG.warning("FileServer.upload: {}, refused {} "\
+				"byte".format(err, filesize))
+			self.fserv.budget.reject()
+			self.conn.send_packet(Proto.T_ERROR, err.encode())
+			return True
+
+		if not self.fserv.budget.reserve(filesize-offset):
+			LOG.warning("FileServer.upload: budget exhausted, "\
+				"refused {} byte".format(filesize))
+			self.conn.send_packet(Proto.T_ERROR,
+				b"Server busy, try again later")
+			return True
+
+		try:
+			return self.__receive_file(fileid, filesize,
+					offset, token, fanout, digest)
+		finally:
+			self.fserv.budget.release(filesize-offset)
+
+
+	def do_upload_part(self, fileid, partsize, opts, fanout=None,
+			digest=None):
+		"""\
+		Upload a part of a chunked upload (option OPT_PART).
+		Parts may be uploaded in any order and in parallel
+		over several connections. They are written to their
+		position in the partial file, which is renamed once
+		all parts have been received. Since parts arrive
+		out of order, a digest (OPT_DIGEST of any part) is
+		verified after the last part in a separate pass.
+		Return:
+		  False if the transfer broke, else True
+		"""
+		store = self.fserv.store
 
-		# Try to open file for storing contents
 		try:
-			fout = open(filepath, "wb")
+			idx,count,filesize,offset,length = get_part_range(opts)
+			if partsize != length:
+				raise ValueError("Invalid size of part {}"\
+					.format(idx))
+		except ValueError as e:
+			self.conn.send_packet(Proto.T_ERROR, str(e).encode())
+			return True
+
+		err = self.admit_upload(filesize)
+		if not err and not store.begin_parts(fileid, filesize,
+				count, self.conf.fileserver_resume_ttl):
+			err = "Invalid part upload"
+		if err:
+			LOG.warning("FileServer.upload: {}, refused part "\
+				"{}/{} of {}".format(err, idx, count,
+				fileid.hex()))
+			self.fserv.budget.reject()
+			self.conn.send_packet(Proto.T_ERROR, err.encode())
+			return True
+
+		if not self.fserv.budget.reserve(length):
+			self.conn.send_packet(Proto.T_ERROR,
+				b"Server busy, try again later")
+			return True
+
+		if digest:
+			store.set_checksum(fileid, filesize, digest)
+
+		partpath = store.get_partial_path(fileid)
+		try:
+			# Open (or create) and preallocate the partial
+			# file, parts may arrive in any order.
+			store.make_dirs(fileid)
+			fd = os.open(partpath, os.O_RDWR|os.O_CREAT, 0o644)
+			fout = open(fd, "r+b")
+			preallocate(fout, filesize)
+			fout.seek(offset)
 			self.conn.send_packet(Proto.T_SUCCESS)
-#			self.conn.send_dict({'type':'ok'})
 		except Exception as e:
+			self.fserv.budget.release(length)
 			self.conn.send_packet(Proto.T_ERROR,
 				b"Internal server error")
-			LOG.error("FileServer.upload: Failed to open {}"\
-				.format(filepath))
-			return
+			LOG.error("FileServer.upload: Failed to open {}, {}"\
+				.format(partpath, e))
+			return True
 
-		# Receive 'filesize' bytes and write them to 'fout'.
-		nrecv = 0
-		while nrecv < filesize:
-			try:
-				buf = self.conn.recv(
-					max_bytes=filesize-nrecv,
-					timeout_sec=10)
-				if not buf: break
-				fout.write(buf)
-				nrecv += len(buf)
+		try:
+			tstart = monotonic()
+			nrecv  = self.__receive_stream(fout, length)
+			fout.close()
+		finally:
+			self.fserv.budget.release(length)
 
-			except Exception as e:
-				LOG.warning("FileServer.upload: recv, " + str(e))
-				break
+		if nrecv != length:
+			LOG.warning("Failed to upload part {}/{} of {}, "\
+				"stopped at {}/{}".format(idx, count,
+				fileid.hex(), nrecv, length))
+			self.conn.send_packet(Proto.T_ERROR,
+				"Failed, only uploaded {}/{} bytes"\
+				.format(nrecv, length).encode())
+			return False
+
+		ndone,nparts = store.add_part(fileid, idx)
+		LOG.debug("Uploaded part {}/{} of {} ({} done), {}"\
+			.format(idx, count, fileid.hex(), ndone,
+			rate_str(length, monotonic()-tstart)))
+
+		if ndone == nparts:
+			# Last part received, file is complete
+			digest  = store.get(fileid)['checksum']
+			content = None
+			if digest or self.conf.fileserver_dedup:
+				content = hash_file(partpath,
+					self.conf.fileserver_chunk_size)\
+					.digest()
+			if digest and digest != content:
+				LOG.warning("FileServer.upload: digest "\
+					"mismatch of {}".format(fileid.hex()))
+				store.delete(fileid)
+				self.conn.send_packet(Proto.T_ERROR,
+					b"Digest mismatch")
+				return True
+
+			os.replace(partpath, store.get_path(fileid))
+			store.set_complete(fileid, filesize)
+			if fanout:
+				store.set_fanout(fileid, filesize, *fanout)
+			if digest:
+				store.set_checksum(fileid, filesize, digest)
+			self.__dedup(fileid, filesize, content)
+			LOG.debug("Uploaded {} byte, file '{}' in {} parts"\
+				.format(filesize, fileid.hex(), nparts))
+
+		self.conn.send_packet(Proto.T_SUCCESS)
+		return True
+
+
+	def admit_upload(self, filesize):
+		"""\
+		Check if an upload of given size is allowed.
+		Return:
+		  None if allowed, else error message
+		"""
+		if filesize > self.conf.fileserver_max_filesize:
+			return "File too large (max {} byte)".format(
+				self.conf.fileserver_max_filesize)
+
+		st = os.statvfs(self.conf.uploaddir)
+		if st.f_bavail * st.f_frsize < filesize:
+			return "Not enough disk space"
+		return None
+
+
+	def __receive_file(self, fileid, filesize, offset, token,
+			fanout=None, digest=None):
+		"""\
+		Receive file of given size from client and store
+		it in uploaddir. The file is received to a partial
+		file, which is renamed when complete.
+		Args:
+		  fileid:   Id of file
+		  filesize: Size of complete file
+		  offset:   Bytes already received
+		  token:    Resume token or None
+		  fanout:   (count, ttl) of multi-recipient upload
+		            or None
+		  digest:   Expected SHA-256 of file or None
+		Return:
+		  False if the transfer broke, else True
+		"""
+		store    = self.fserv.store
+		filepath = store.get_path(fileid)
+		partpath = store.get_partial_path(fileid)
+		ttl      = self.conf.fileserver_resume_ttl
+
+		LOG.debug("FileServer: uploading file {}, offset={}"\
+			.format(filepath, offset))
+
+		# The contents are hashed on the fly for verifying
+		# the digest and for deduplication.
+		hasher = None
+		if digest or self.conf.fileserver_dedup:
+			hasher = hashlib.sha256()
+
+		# Try to open and preallocate file for storing
+		# contents
+		try:
+			if offset:
+				if hasher:
+					# Hash bytes received so far
+					hash_file(partpath,
+						self.conf.fileserver_chunk_size,
+						offset, hasher)
+				fout = open(partpath, "r+b")
+				fout.seek(offset)
+			else:
+				store.make_dirs(fileid)
+				fout = open(partpath, "wb")
+				preallocate(fout, filesize)
+				if token:
+					store.add_partial(fileid, filesize,
+							token, ttl)
+			if token:
+				self.conn.send_packet(Proto.T_SUCCESS,
+					token + struct.pack('!I', offset))
+			else:	self.conn.send_packet(Proto.T_SUCCESS)
+#			self.conn.send_dict({'type':'ok'})
+		except Exception as e:
+			self.conn.send_packet(Proto.T_ERROR,
+				b"Internal server error")
+			LOG.error("FileServer.upload: Failed to open {}, {}"\
+				.format(partpath, e))
+			return True
+
+		# Receive missing bytes and write them to 'fout'.
+		tstart = monotonic()
+		nrecv  = offset + self.__receive_stream(fout,
+					filesize-offset, hasher)
 		fout.close()
 
 		# Validate if everything was transmitted successfully
 		if nrecv != filesize:
 			LOG.warning("Failed to upload complete file. "\
 				"Stopped at {}/{}".format(nrecv, filesize))
-			os_remove(filepath)
+			if token:
+				# Keep partial file for resuming
+				store.set_received(fileid, nrecv, ttl)
+			else:	os_remove(partpath)
 			self.conn.send_packet(Proto.T_ERROR,
 				"Failed, only uploaded "\
 				"{}/{} bytes".format(nrecv,filesize)\
 				.encode())
+			return False
+
+		elif digest and hasher.digest() != digest:
+			# Corrupted in transit, the upload must be
+			# repeated.
+			LOG.warning("FileServer.upload: digest mismatch "\
+				"of {}".format(fileid.hex()))
+			store.delete(fileid)
+			self.conn.send_packet(Proto.T_ERROR,
+				b"Digest mismatch")
+			return True
+
 		else:
-			LOG.debug("Uploaded {} byte, file '{}'"\
-				.format(filesize, filepath))
+			os.replace(partpath, filepath)
+			store.set_complete(fileid, filesize)
+			if fanout:
+				store.set_fanout(fileid, filesize, *fanout)
+			if digest:
+				store.set_checksum(fileid, filesize, digest)
+			self.__dedup(fileid, filesize,
+				hasher.digest() if hasher else None)
+			LOG.debug("Uploaded {} byte, file '{}', {}"\
+				.format(filesize-offset, filepath,
+				rate_str(filesize-offset,
+					monotonic()-tstart)))
 			self.conn.send_packet(Proto.T_SUCCESS)
+			return True
+
+
+	def __receive_stream(self, fout, nbytes, hasher=None):
+		"""\
+		Receive 'nbytes' bytes from client and write them
+		to 'fout' at its current position. Receiving and
+		writing are overlapped, see FileWriter.
+		Args:
+		  fout:   File opened for writing
+		  nbytes: Number of bytes to receive
+		  hasher: hashlib object updated with the written
+		          bytes or None
+		Return:
+		  Number of bytes written
+		"""
+		writer = FileWriter(fout,
+				self.conf.fileserver_upload_buffers,
+				self.conf.fileserver_chunk_size, hasher)
+		writer.start()
+
+		nrecv = 0
+		sock  = self.conn.conn
+		while nrecv < nbytes and not writer.error:
+			buf = writer.get_buffer()
+			try:
+				view = memoryview(buf)[:nbytes-nrecv]
+				n = recv_into(sock, view, timeout_sec=10)
+				view.release()
+				if not n:
+					writer.release_buffer(buf)
+					break
+				writer.put_buffer(buf, n)
+				nrecv += n
+				self.fserv.throttle(self.userid, n)
+
+			except Exception as e:
+				LOG.warning("FileServer.upload: recv, " + str(e))
+				writer.release_buffer(buf)
+				break
+
+		writer.finish()
+
+		if writer.error:
+			LOG.error("FileServer.upload: write, {}"\
+				.format(writer.error))
+
+		# Bytes which really reached the disk
+		return writer.nwritten
+
+
+	def __dedup(self, fileid, filesize, digest=None):
+		"""\
+		Move complete upload to the content-addressed blob
+		store, if deduplication is enabled. A file with
+		the contents of an existing blob is replaced by a
+		link to that blob.
+		Args:
+		  digest: SHA-256 of the file or None, if it must
+		          be computed from the file.
+		"""
+		if not self.conf.fileserver_dedup:
+			return
+
+		store = self.fserv.store
+		try:
+			if not digest:
+				digest = hash_file(store.get_path(fileid),
+					self.conf.fileserver_chunk_size)\
+					.digest()
+			if store.add_blob(fileid, filesize, digest):
+				LOG.debug("FileServer: {} is a duplicate of "\
+					"blob {}".format(fileid.hex(),
+					digest.hex()))
+		except Exception as e:
+			LOG.error("FileServer.dedup: {}, {}".format(
+				fileid.hex(), e))
 
 
 	def do_download(self, pckt):
 		"""\
 		Do the file download (Send file to client).
+		Options OPT_OFFSET and OPT_LENGTH select the range
+		of the file to send, T_SUCCESS always carries the
+		size of the complete file. With option OPT_PART a
+		part of the file is sent, the file is deleted (if
+		enabled) after all parts have been downloaded. Files
+		uploaded with OPT_RECIPIENTS are deleted after the
+		last of their downloads. If requested (empty option
+		OPT_DIGEST), the digest of a verified upload is
+		appended to T_SUCCESS.
+		Returns False if the connection is unusable
+		afterwards (transfer broke), else True.
 		"""
-		fileid   = pckt[1]
-		filepath = path_join(self.conf.uploaddir,
-				fileid.hex())
+		fileid   = pckt[1][:16]
+		filepath = self.fserv.store.get_path(fileid)
 		LOG.debug("FileServer: downloading file " + filepath)
 
 		# Try to open file for sending
 		try:
 			fin  = open(filepath, "rb")
 			size = os_stat(filepath).st_size
-			self.conn.send_packet(Proto.T_SUCCESS,
-				struct.pack('!I', size))
-			LOG.debug("FileServer: Sending: T_SUCCESS,"\
-				" filesize={}".format(size))
 		except Exception as e:
 			self.conn.send_packet(Proto.T_ERROR,
 				b"Requested file doesn\'t exist")
 			LOG.error("FileServer.download: Failed to open {}"\
 				.format(filepath))
-			return
+			return True
 
-		# Read file contents and send them to client
-		nread = 0
-		while nread < size:
-			buf = fin.read()
-			nbuf = len(buf)
-			if not buf: break
+		try:
+			part = get_part_range(pckt[2])
+			if part:
+				if part[2] != size:
+					raise ValueError("Filesize mismatch")
+				offset,length = part[3:]
+			else:
+				offset = get_uint_option(pckt[2],
+						OPT_OFFSET, 0)
+				length = get_uint_option(pckt[2],
+						OPT_LENGTH, size-offset)
+			if offset > size:
+				raise ValueError("Offset exceeds filesize")
+			length = min(length, size-offset)
+		except ValueError as e:
+			fin.close()
+			self.conn.send_packet(Proto.T_ERROR,
+				"Invalid range, {}".format(e).encode())
+			return True
 
-			try:
-				self.conn.send(buf)
-				nread += nbuf
-				LOG.debug("FileServer.download(): sent {} byte".format(nbuf))
+		response = struct.pack('!I', size)
+		if OPT_DIGEST in pckt[2]:
+			entry = self.fserv.store.get(fileid)
+			if entry and entry['checksum']:
+				response += pack_option(OPT_DIGEST,
+						entry['checksum'])
 
-			except Exception as e:
-				LOG.error("FileServer: download, " + str(e))
-				break
+		self.conn.send_packet(Proto.T_SUCCESS, response)
+		LOG.debug("FileServer: Sending: T_SUCCESS,"\
+			" filesize={}, range={}+{}".format(
+			size, offset, length))
+
+		# Send file contents to client
+		nread  = 0
+		tstart = monotonic()
+		try:
+			nread = self.send_file(fin, length, offset)
+		except Exception as e:
+			LOG.error("FileServer: download, " + str(e))
 		fin.close()
 
-		LOG.debug("Downloaded file '{}', size={}/{}"\
-				.format(fileid, nread, size))
+		LOG.debug("Downloaded file '{}', size={}/{}, {}"\
+				.format(fileid.hex(), nread, length,
+				rate_str(nread, monotonic()-tstart)))
 
-		# Delete file after download?
-		if self.conf.fileserver_delete_files:
-			os_remove(filepath)
+		if part and nread == length:
+			# Delete after all parts were downloaded
+			done = self.fserv.download_part_done(
+					fileid, self.userid, part[0], part[1])
+		else:
+			# Delete once the end of file was sent
+			done = nread == length and offset+length == size
+
+		# Delete file after download? A file with fan-out
+		# is deleted after its last download.
+		if self.conf.fileserver_delete_files and done\
+		   and self.fserv.store.count_download(fileid):
+			self.fserv.store.delete(fileid)
 			LOG.debug("Deleted file '{}'"\
-				.format(fileid))
+				.format(fileid.hex()))
+
+		return nread == length
 
 
-	def __recv_initial_packet(self):
+	def send_file(self, fin, count, offset=0):
+		"""\
+		Send 'count' bytes of file 'fin' starting at
+		'offset' to the client. If enabled, socket.sendfile
+		is used, which is zero-copy for plain TCP and
+		kernel TLS sockets. Otherwise the file is sent in
+		chunks using a single reusable buffer, so memory
+		usage is bounded by the chunksize. With bandwidth
+		limits, sendfile is called per chunk as well.
+		Return:
+		  Number of bytes sent
+		"""
+		if count == 0:
+			# Empty file or range, sendfile refuses count 0
+			return 0
+
+		sock  = self.conn.conn
+		chunk = self.conf.fileserver_chunk_size
+
+		if self.conf.fileserver_sendfile:
+			if not self.fserv.is_shaped():
+				nsent = sock.sendfile(fin, offset, count)
+				self.fserv.throttle(self.userid, nsent)
+				return nsent
+
+			nsent = 0
+			while nsent < count:
+				n = sock.sendfile(fin, offset+nsent,
+						min(chunk, count-nsent))
+				if not n: break
+				nsent += n
+				self.fserv.throttle(self.userid, n)
+			return nsent
+
+		buf   = memoryview(bytearray(chunk))
+		nsent = 0
+		fin.seek(offset)
+
+		while nsent < count:
+			n = fin.readinto(buf[:min(len(buf), count-nsent)])
+			if not n: break
+			sock.sendall(buf[:n])
+			nsent += n
+			self.fserv.throttle(self.userid, n)
+		return nsent
+
+
+	def __recv_initial_packet(self, timeout_sec, idle=False):
 		"""\
 		Receive the initial packet:
 			'type'   : 'file-upload'|'file-download',
 			'fileid' : FILE_ID,
 			'size'   : FILE_SIZE
+			options  : See parse_options()
 		Key 'size' only exists if message type is 'file-upload'.
 
+		Args:
+		  timeout_sec: Receive timeout
+		  idle:        Waiting for further transfer, a
+		               timeout or close isn't an error.
 		Return:
-		  msg: The initial message
+		  (type, data, options): The initial message
 		Raises:
 		  Exception: select,recv,type error
 		"""
 
 		try:
 			pckt = self.conn.recv_packet(
-				timeout_sec=self.conf.recv_timeout)
+				timeout_sec=timeout_sec)
 		except Exception as e:
-			LOG.error("FileServer.__recv_initial_packet: "+str(e))
+			if not idle:
+				LOG.error("FileServer.__recv_initial_packet: "+str(e))
 			return None
 
 		if not pckt:
-			LOG.error("FileServer.__recv_initial_packet: timeout")
+			if not idle:
+				LOG.error("FileServer.__recv_initial_packet: timeout")
 			return None
 
 		elif pckt[0] not in (Proto.T_FILE_UPLOAD, Proto.T_FILE_DOWNLOAD):
@@ -268,4 +1364,85 @@ class FileTransferThread(threading.Thread):
 				"Invalid msg-type '{}'".format(pckt[0]))
 			return None
 
-		return pckt
+		# Split off the options
+		nfixed = 20 if pckt[0] == Proto.T_FILE_UPLOAD else 16
+		if not pckt[1] or len(pckt[1]) < nfixed:
+			LOG.error("FileServer.__recv_initial_packet: "\
+				"Invalid packet size")
+			return None
+
+		try:
+			opts = parse_options(pckt[1][nfixed:])
+		except ValueError as e:
+			LOG.error("FileServer.__recv_initial_packet: "+str(e))
+			return None
+
+		return pckt[0], pckt[1][:nfixed], opts
+
+
+
+class FileWriter(threading.Thread):
+	"""\
+	Writer stage of the upload pipeline.
+	The receiving thread fills buffers from a pool of
+	preallocated buffers, while this thread writes the filled
+	buffers to the file and returns them to the pool. So the
+	network isn't idle during disk writes and vice versa.
+	"""
+	def __init__(self, fout, nbuffers, bufsize, hasher=None):
+		"""\
+		Args:
+		  fout:     File opened for writing
+		  nbuffers: Number of buffers in pool
+		  bufsize:  Size of each buffer
+		  hasher:   hashlib object, which is updated with
+		            the written bytes, or None
+		"""
+		super().__init__(daemon=True)
+		self.fout     = fout
+		self.hasher   = hasher
+		self.free     = queue.Queue()	# Empty buffers
+		self.filled   = queue.Queue()	# (buffer, nbytes)
+		self.nwritten = 0		# Bytes written
+		self.error    = None		# Write error
+
+		for i in range(max(nbuffers, 2)):
+			self.free.put(bytearray(bufsize))
+
+
+	def get_buffer(self):
+		""" Get empty buffer, blocks if all are in use """
+		return self.free.get()
+
+	def put_buffer(self, buf, nbytes):
+		""" Pass filled buffer to writer """
+		self.filled.put((buf, nbytes))
+
+	def release_buffer(self, buf):
+		""" Return unused buffer to pool """
+		self.free.put(buf)
+
+	def finish(self):
+		""" Wait until all buffers are written """
+		self.filled.put(None)
+		self.join()
+
+
+	def run(self):
+		while True:
+			item = self.filled.get()
+			if item is None:
+				break
+
+			buf,nbytes = item
+			if not self.error:
+				try:
+					with memoryview(buf) as view:
+						self.fout.write(view[:nbytes])
+						if self.hasher:
+							self.hasher.update(
+								view[:nbytes])
+					self.nwritten += nbytes
+				except Exception as e:
+					self.error = e
+			self.free.put(buf)
@@ -0,0 +1,183 @@
+import os
+import sys
+import threading
+import logging
+
+from time import time
+
+"""\
+The janitor is a background thread of the fileserver, which
+cleans up uploaddir on a schedule ([fileserver] janitor_interval):
+
+  - Expired partial uploads and files with fan-out
+    (see UploadStore.delete_expired)
+  - Complete files completed more than [fileserver] max_age
+    seconds ago, whether they have been downloaded or not
+    (disabled by default). Files are aged by their
+    completion time in the upload db, not by their mtime: a
+    deduplicated file is a hardlink sharing the mtime of its
+    (possibly old) blob.
+  - Leftovers of broken uploads without db entry, older
+    than [fileserver] resume_ttl
+  - Unreferenced blobs, if deduplication is enabled
+  - State of chunked downloads without a part sent within
+    [fileserver] resume_ttl (see FileServer.download_parts)
+
+The thread runs with the lowest CPU priority (nice 19), which
+also gives it the lowest best-effort I/O priority on Linux.
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class Janitor(threading.Thread):
+
+	def __init__(self, fileserver):
+		"""\
+		Args:
+		  fileserver: FileServer instance
+		"""
+		super().__init__(daemon=True)
+		self.fserv = fileserver
+		self.conf  = fileserver.conf
+		self.store = fileserver.store
+
+		self.nruns  = 0	# Number of sweeps
+		self.nfiles = 0	# Number of reclaimed files
+		self.nbytes = 0	# Number of reclaimed bytes
+
+		self.wakeup = threading.Event()
+		self.done   = False
+
+
+	def run(self):
+		self.__lower_priority()
+
+		while not self.done:
+			try:
+				self.sweep()
+			except Exception as e:
+				LOG.error("Janitor: " + str(e))
+			self.wakeup.wait(self.conf.fileserver_janitor_interval)
+
+
+	def stop(self):
+		"""\
+		Stop janitor thread and wait for it.
+		"""
+		self.done = True
+		self.wakeup.set()
+		if self.is_alive():
+			self.join()
+
+
+	def sweep(self):
+		"""\
+		Do a single cleanup run.
+		Return:
+		  (nfiles, nbytes): Files and bytes reclaimed
+		"""
+		nfiles,nbytes = self.store.delete_expired()
+
+		n,b = self.__expire_files()
+		nfiles += n
+		nbytes += b
+
+		if self.conf.fileserver_dedup:
+			n,b = self.store.collect_blobs()
+			nfiles += n
+			nbytes += b
+
+		n = self.fserv.purge_download_parts(
+				self.conf.fileserver_resume_ttl)
+		if n:
+			LOG.debug("Janitor: forgot {} abandoned chunked "\
+				"download(s)".format(n))
+
+		self.nruns  += 1
+		self.nfiles += nfiles
+		self.nbytes += nbytes
+
+		if nfiles:
+			LOG.info("Janitor: reclaimed {} files, {} byte"\
+				.format(nfiles, nbytes))
+		return nfiles, nbytes
+
+
+	def get_stats(self):
+		return {
+			'janitor_runs'  : self.nruns,
+			'janitor_files' : self.nfiles,
+			'janitor_bytes' : self.nbytes
+		}
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __expire_files(self):
+		"""\
+		Delete complete files completed more than max_age
+		seconds ago and partial files without db entry older
+		than resume_ttl.
+		"""
+		now     = time()
+		max_age = self.conf.fileserver_max_age
+		nfiles  = 0
+		nbytes  = 0
+
+		# Completion time of the complete files
+		completed = self.store.get_completed() if max_age else {}
+
+		for fileid,path,partial in self.store.iter_files():
+			if self.done:
+				break
+			try:
+				st = os.stat(path)
+			except FileNotFoundError:
+				continue
+
+			age = now - st.st_mtime
+			if not partial and fileid:
+				if not max_age:
+					continue
+				t = completed.get(fileid)
+				if t is None:
+					# File of an older version, the mtime
+					# is only its own if it isn't a link.
+					t = min(st.st_mtime, now)\
+						if st.st_nlink == 1 else now
+					self.store.set_completed(fileid,
+						st.st_size, t)
+				if now - t < max_age:
+					continue
+				LOG.debug("Janitor: file {} expired"\
+					.format(fileid.hex()))
+				nbytes += self.store.delete(fileid)
+				nfiles += 1
+
+			elif age >= self.conf.fileserver_resume_ttl\
+			     and not (fileid and self.store.get(fileid)):
+				# Leftover of broken upload or
+				# unknown file.
+				LOG.debug("Janitor: removing " + path)
+				os.remove(path)
+				nfiles += 1
+				nbytes += st.st_size
+
+		return nfiles, nbytes
+
+
+	def __lower_priority(self):
+		"""\
+		Set lowest priority for this thread. On Linux
+		the nice value applies to the calling thread only,
+		elsewhere the priority is left unchanged.
+		"""
+		if not sys.platform.startswith('linux'):
+			return
+		try:
+			os.setpriority(os.PRIO_PROCESS,
+				threading.get_native_id(), 19)
+		except Exception as e:
+			LOG.warning("Janitor: setpriority, " + str(e))
@@ -0,0 +1,274 @@
+import os
+import errno
+import queue
+import threading
+import importlib
+import logging
+
+from os.path import join as path_join
+from os.path import basename
+from socket import socket, AF_UNIX, SOCK_DGRAM
+from socket import SOL_SOCKET, SO_SNDBUF, SO_RCVBUF
+from select import select
+
+"""\
+Message bus between the nodes (worker processes, server
+instances) of a retro server cluster.
+
+A bus connects named nodes and transports opaque message
+buffers between them. Which bus is used, is configured by
+the key 'bus' in section [cluster]:
+
+  unix          UnixBus, nodes on the same host (default)
+  local         LocalBus, nodes within one process (tests)
+  module:Class  Any other MessageBus implementation
+
+Nodes on several hosts need a module:Class bus, none of the
+buses here crosses hosts (see Readme, Cluster mode).
+
+UnixBus:
+Every node binds a unix datagram socket named <node>.sock
+inside a shared directory (busdir). Other nodes are
+discovered by listing that directory, so a new node simply
+appears by binding its socket.
+
+  busdir/
+  |__ node1-worker0.sock
+  |__ node1-worker1.sock
+  |__ ...
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+# Largest message we accept (a single datagram)
+BUS_MAX_MSGSIZE = 0x40000
+
+
+class MessageBus:
+	"""\
+	Bus interface, all bus implementations are derived
+	from this class.
+	"""
+
+	def __init__(self, busdir, node):
+		"""\
+		Args:
+		  busdir: Bus address (e.g. directory of UnixBus)
+		  node:   Name of this node
+		"""
+		self.dir  = busdir
+		self.node = node
+
+
+	def open(self):
+		"""\
+		Attach node to the bus.
+		Return:
+		  True on success, else False
+		"""
+		raise NotImplementedError()
+
+
+	def nodes(self):
+		"""\
+		Returns a list with the names of all other nodes.
+		"""
+		raise NotImplementedError()
+
+
+	def send(self, node, buf):
+		"""\
+		Send message to given node.
+		Return:
+		  True on success, else False
+		"""
+		raise NotImplementedError()
+
+
+	def broadcast(self, buf):
+		"""\
+		Send message to all other nodes.
+		"""
+		for node in self.nodes():
+			self.send(node, buf)
+
+
+	def recv(self, timeout_sec=None):
+		"""\
+		Receive next message.
+		Return:
+		  (node, buf): Sending node and message buffer
+		  False:       Timeout exceeded
+		"""
+		raise NotImplementedError()
+
+
+	def close(self):
+		""" Detach node from the bus """
+		raise NotImplementedError()
+
+
+
+class UnixBus(MessageBus):
+
+	def __init__(self, busdir, node):
+		"""\
+		Args:
+		  busdir: Directory holding the node sockets
+		  node:   Name of this node
+		"""
+		super().__init__(busdir, node)
+		self.path = path_join(busdir, node + ".sock")
+		self.fd   = None
+
+
+	def open(self):
+		"""\
+		Create and bind the node socket.
+		Return:
+		  True on success, else False
+		"""
+		try:
+			os.makedirs(self.dir, exist_ok=True)
+			if os.path.exists(self.path):
+				os.unlink(self.path)
+
+			self.fd = socket(AF_UNIX, SOCK_DGRAM)
+			self.fd.setsockopt(SOL_SOCKET, SO_SNDBUF, BUS_MAX_MSGSIZE)
+			self.fd.setsockopt(SOL_SOCKET, SO_RCVBUF, BUS_MAX_MSGSIZE)
+			self.fd.bind(self.path)
+			return True
+		except Exception as e:
+			LOG.error("UnixBus.open: " + str(e))
+			return False
+
+
+	def nodes(self):
+		"""\
+		Returns a list with the names of all other nodes.
+		"""
+		nodes = []
+		for f in os.listdir(self.dir):
+			if f.endswith('.sock'):
+				node = f[:-5]
+				if node != self.node:
+					nodes.append(node)
+		return nodes
+
+
+	def send(self, node, buf):
+		"""\
+		Send message to given node.
+		Return:
+		  True on success, else False
+		"""
+		try:
+			self.fd.sendto(buf, path_join(self.dir, node+".sock"))
+			return True
+		except OSError as e:
+			if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+				# Node is gone, nobody listens at socket
+				LOG.debug("UnixBus: node {} is gone".format(node))
+			else:
+				LOG.warning("UnixBus.send({}): {}".format(node, e))
+			return False
+
+
+	def recv(self, timeout_sec=None):
+		"""\
+		Receive next message.
+		Return:
+		  (node, buf): Sending node and message buffer
+		  False:       Timeout exceeded
+		"""
+		r,_,_ = select([self.fd], [], [], timeout_sec)
+		if not r:
+			return False
+
+		buf,addr = self.fd.recvfrom(BUS_MAX_MSGSIZE)
+		node = basename(addr)[:-5] if addr else None
+		return node, buf
+
+
+	def close(self):
+		""" Close and remove node socket """
+		if self.fd:
+			self.fd.close()
+			self.fd = None
+		try: os.unlink(self.path)
+		except: pass
+
+
+
+class LocalBus(MessageBus):
+	"""\
+	Bus connecting nodes within a single process. All
+	nodes with the same busdir are connected.
+	"""
+
+	# All local buses, key=busdir, value=dict(node:Queue)
+	buses = {}
+	lock  = threading.Lock()
+
+	def __init__(self, busdir, node):
+		super().__init__(busdir, node)
+		self.queue = None
+
+
+	def open(self):
+		with LocalBus.lock:
+			bus = LocalBus.buses.setdefault(self.dir, {})
+			self.queue = queue.Queue()
+			bus[self.node] = self.queue
+		return True
+
+
+	def nodes(self):
+		with LocalBus.lock:
+			bus = LocalBus.buses.get(self.dir, {})
+			return [n for n in bus if n != self.node]
+
+
+	def send(self, node, buf):
+		with LocalBus.lock:
+			q = LocalBus.buses.get(self.dir, {}).get(node)
+		if not q:
+			return False
+		q.put((self.node, bytes(buf)))
+		return True
+
+
+	def recv(self, timeout_sec=None):
+		try:
+			return self.queue.get(timeout=timeout_sec)
+		except queue.Empty:
+			return False
+
+
+	def close(self):
+		with LocalBus.lock:
+			bus = LocalBus.buses.get(self.dir, {})
+			if bus.get(self.node) is self.queue:
+				bus.pop(self.node)
+
+
+
+def get_bus_class(name):
+	"""\
+	Get bus class by name ('unix', 'local' or 'module:Class').
+	Raise:
+	  ValueError: Invalid bus name
+	"""
+	if name == 'unix':
+		return UnixBus
+	elif name == 'local':
+		return LocalBus
+	elif ':' in name:
+		modname,clsname = name.split(':', 1)
+		cls = getattr(importlib.import_module(modname), clsname)
+		if not issubclass(cls, MessageBus):
+			raise ValueError("{} is no MessageBus".format(name))
+		return cls
+	else:
+		raise ValueError("Invalid bus '{}'".format(name))
@@ -0,0 +1,435 @@
+import os
+import socketserver
+import threading
+import functools
+import logging
+
+from bisect import bisect_left
+from time import perf_counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""\
+Metrics of the server (counters, gauges and histograms) and
+an exporter serving them in the Prometheus text format
+([metrics] section).
+
+Metrics are defined once at module level and updated on the
+hot paths, an update costs a lock and an addition (well
+below a microsecond):
+
+  PACKETS = Metrics.counter('retro_packets_total',
+		'Packets received', ('type',))
+  ...
+  PACKETS.labels(pckt_type).inc()
+
+Besides, the statistics dictionaries of the servers
+(get_stats) are exported as gauges 'retro_<key>' on every
+scrape (see Registry.add_collector).
+
+Every process (worker, service process) has its own metrics
+and exporter, the port (socket path) is numbered by process,
+see start_exporter().
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+# Default histogram buckets (seconds)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+		0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+	"""\
+	Base class of all metrics. A metric with label names
+	is a family of child metrics, one per label values
+	(see labels()).
+	"""
+	TYPE = 'untyped'
+
+	def __init__(self, name, help, labelnames=(), labelvalues=()):
+		self.name        = name
+		self.help        = help
+		self.labelnames  = labelnames
+		self.labelvalues = labelvalues
+		self.children    = {}	# key=label values, value=Metric
+		self.lock        = threading.Lock()
+
+
+	def labels(self, *values):
+		"""\
+		Get child metric for given label values, which
+		are converted to str.
+		"""
+		child = self.children.get(values)
+		if child is None:
+			with self.lock:
+				child = self.children.get(values)
+				if child is None:
+					child = self.new_child(tuple(
+						str(v) for v in values))
+					self.children[values] = child
+		return child
+
+
+	def new_child(self, labelvalues):
+		return type(self)(self.name, self.help, (),
+				labelvalues)
+
+
+	def expose(self):
+		"""\
+		Returns metric in Prometheus text format.
+		"""
+		lines = ["# HELP {} {}".format(self.name, self.help),
+			 "# TYPE {} {}".format(self.name, self.TYPE)]
+		if self.labelnames:
+			for child in list(self.children.values()):
+				lines += child.samples(self.labelnames)
+		else:	lines += self.samples(())
+		return "\n".join(lines)
+
+
+	def samples(self, labelnames):
+		""" Returns the sample lines of a single metric """
+		raise NotImplementedError
+
+
+	def format_labels(self, labelnames, extra=()):
+		pairs = list(zip(labelnames, self.labelvalues)) + list(extra)
+		if not pairs:
+			return ""
+		return "{" + ",".join('{}="{}"'.format(k, v.replace('\\',
+			'\\\\').replace('"', '\\"')) for k,v in pairs) + "}"
+
+
+
+class Counter(Metric):
+	TYPE = 'counter'
+
+	def __init__(self, *args):
+		super().__init__(*args)
+		self.value = 0
+
+
+	def inc(self, n=1):
+		# acquire/release is cheaper than a with block,
+		# the addition can't raise.
+		self.lock.acquire()
+		self.value += n
+		self.lock.release()
+
+
+	def samples(self, labelnames):
+		return ["{}{} {}".format(self.name,
+			self.format_labels(labelnames), self.value)]
+
+
+
+class Gauge(Metric):
+	TYPE = 'gauge'
+
+	def __init__(self, *args):
+		super().__init__(*args)
+		self.value = 0
+		self.func  = None
+
+
+	def set(self, value):
+		self.value = value
+
+
+	def inc(self, n=1):
+		self.lock.acquire()
+		self.value += n
+		self.lock.release()
+
+
+	def dec(self, n=1):
+		self.lock.acquire()
+		self.value -= n
+		self.lock.release()
+
+
+	def set_function(self, func):
+		"""\
+		Get the value from func on every scrape.
+		"""
+		self.func = func
+
+
+	def samples(self, labelnames):
+		value = self.func() if self.func else self.value
+		return ["{}{} {}".format(self.name,
+			self.format_labels(labelnames), value)]
+
+
+
+class Histogram(Metric):
+	TYPE = 'histogram'
+
+	def __init__(self, name, help, labelnames=(), labelvalues=(),
+			buckets=LATENCY_BUCKETS):
+		super().__init__(name, help, labelnames, labelvalues)
+		self.buckets = tuple(buckets)
+		self.counts  = [0] * (len(self.buckets) + 1)
+		self.sum     = 0.0
+
+
+	def new_child(self, labelvalues):
+		return Histogram(self.name, self.help, (), labelvalues,
+				self.buckets)
+
+
+	def observe(self, value):
+		i = bisect_left(self.buckets, value)
+		self.lock.acquire()
+		self.counts[i] += 1
+		self.sum += value
+		self.lock.release()
+
+
+	def time(self):
+		"""\
+		Context manager observing the time spent in the
+		with block.
+		"""
+		return Timer(self)
+
+
+	def samples(self, labelnames):
+		with self.lock:
+			counts = list(self.counts)
+			total  = self.sum
+
+		lines = []
+		n = 0
+		for le,count in zip(self.buckets + ('+Inf',), counts):
+			n += count
+			lines.append("{}_bucket{} {}".format(self.name,
+				self.format_labels(labelnames,
+				[('le', str(le))]), n))
+		labels = self.format_labels(labelnames)
+		lines.append("{}_sum{} {}".format(self.name, labels, total))
+		lines.append("{}_count{} {}".format(self.name, labels, n))
+		return lines
+
+
+
+class Timer:
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self.histogram.observe(perf_counter() - self.start)
+
+
+
+class Registry:
+	"""\
+	Keeps all metrics and collectors of a process.
+	"""
+	def __init__(self):
+		self.metrics    = {}	# key=name, value=Metric
+		self.collectors = []
+		self.lock       = threading.Lock()
+
+
+	def register(self, metric):
+		"""\
+		Add metric, a metric with the same name already
+		registered is returned instead.
+		"""
+		with self.lock:
+			return self.metrics.setdefault(metric.name, metric)
+
+
+	def add_collector(self, func):
+		"""\
+		Add function returning a statistics dictionary,
+		whose numeric values are exported as gauges
+		'retro_<key>' (e.g. RetroServer.get_stats).
+		"""
+		self.collectors.append(func)
+
+
+	def expose(self):
+		"""\
+		Returns all metrics in Prometheus text format.
+		"""
+		parts = [m.expose() for m in list(self.metrics.values())]
+
+		for func in self.collectors:
+			try:
+				stats = func()
+			except Exception as e:
+				LOG.error("Metrics: collector, " + str(e))
+				continue
+			for key,value in sorted(stats.items()):
+				if isinstance(value, bool):
+					value = int(value)
+				elif not isinstance(value, (int, float)):
+					continue
+				parts.append("# TYPE retro_{0} gauge\n"\
+					"retro_{0} {1}".format(key, value))
+
+		return "\n".join(parts) + "\n"
+
+
+# Metrics of this process
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+	""" Create counter in default registry """
+	return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+	""" Create gauge in default registry """
+	return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+	""" Create histogram in default registry """
+	return REGISTRY.register(Histogram(name, help, labelnames,
+			(), buckets))
+
+
+def timed(histogram):
+	"""\
+	Decorator observing the duration of each call in given
+	histogram. If the histogram has a label, it's set to the
+	function name.
+	"""
+	def decorator(func):
+		child = histogram.labels(func.__name__)\
+			if histogram.labelnames else histogram
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			start = perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				child.observe(perf_counter() - start)
+		return wrapper
+	return decorator
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+		body = self.server.registry.expose().encode()
+		self.send_response(200)
+		self.send_header('Content-Type',
+			'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def address_string(self):
+		# Unix sockets have no client address
+		return str(self.client_address or 'unix')
+
+	def log_message(self, format, *args):
+		pass
+
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+		socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+
+class MetricsExporter(threading.Thread):
+	"""\
+	Serves the metrics over HTTP at a local port or a
+	unix socket.
+	"""
+	def __init__(self, registry, port=0, path=None):
+		"""\
+		Args:
+		  registry: Registry to export
+		  port:     TCP port (bound to localhost)
+		  path:     Path of unix socket, used instead of
+		            port if given
+		"""
+		super().__init__(daemon=True)
+		self.registry = registry
+		self.port     = port
+		self.path     = path
+		self.httpd    = None
+
+
+	def open(self):
+		try:
+			if self.path:
+				if os.path.exists(self.path):
+					os.remove(self.path)
+				self.httpd = UnixHTTPServer(self.path,
+						MetricsHandler)
+				addr = self.path
+			else:
+				self.httpd = ThreadingHTTPServer(
+					('127.0.0.1', self.port),
+					MetricsHandler)
+				addr = "127.0.0.1:{}".format(self.port)
+		except Exception as e:
+			LOG.error("MetricsExporter.open: " + str(e))
+			return False
+
+		self.httpd.registry = self.registry
+		LOG.info("Serving metrics at " + addr)
+		return True
+
+
+	def run(self):
+		self.httpd.serve_forever()
+
+
+	def stop(self):
+		if self.httpd:
+			self.httpd.shutdown()
+			self.httpd.server_close()
+			if self.path and os.path.exists(self.path):
+				os.remove(self.path)
+			self.httpd = None
+
+
+
+def start_exporter(conf, index, collector=None):
+	"""\
+	Start exporter for this process, if enabled. Process
+	'index' serves at [metrics] port + index, or at the
+	unix socket path with suffix '.<index>' (index > 0).
+	Args:
+	  conf:      ServerConfig
+	  index:     Index of process
+	  collector: Function returning a stats dictionary
+	             or None
+	Return:
+	  MetricsExporter or None
+	"""
+	if not conf.metrics_enable:
+		return None
+	if collector:
+		REGISTRY.add_collector(collector)
+
+	path = conf.metrics_socket
+	if path and index:
+		path += ".{}".format(index)
+	exporter = MetricsExporter(REGISTRY,
+			conf.metrics_port + index, path)
+	if not exporter.open():
+		return None
+	exporter.start()
+	return exporter
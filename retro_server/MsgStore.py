@@ -5,9 +5,23 @@ import sqlite3
 
 from libretro.protocol import Proto
 
+from . import Metrics
 
 LOG = logging.getLogger(__name__)
 
+# Seconds to wait for a database lock held by another
+# worker process.
+DB_TIMEOUT = 10
+
+# Latency of database calls (MsgStore and ServerDb)
+DB_LATENCY = Metrics.histogram('retro_db_seconds',
+		'Database call latency', ('call',))
+
+STORED   = Metrics.counter('retro_offline_stored_total',
+		'Messages stored for offline receivers')
+REPLAYED = Metrics.counter('retro_offline_replayed_total',
+		'Stored messages delivered after login')
+
 
 """\
 This is used to store messages, sent while the receiver
@@ -25,6 +39,9 @@ with the following schema:
   pckt_type is either Proto.T_CHATMSG or Proto.T_FILEMSG
   packet is the packet buffer
 
+The databases are opened in WAL mode with a busy timeout, so
+several worker processes can access them concurrently.
+
 """
 class MsgStore:
 
@@ -42,6 +59,7 @@ class MsgStore:
 		self.conf = serv.conf
 
 
+	@Metrics.timed(DB_LATENCY)
 	def store_msg(self, pckt_type, pckt_buffer):
 		"""\
 		Store message to coresponding receiver database.
@@ -58,9 +76,11 @@ class MsgStore:
 		db.execute(q, (pckt_type, pckt_buffer))
 		db.commit()
 		db.close()
+		STORED.inc()
 		return True
 
 
+	@Metrics.timed(DB_LATENCY)
 	def get_msgs(self, receiver_id, delete_after=False):
 		"""\
 		Get all unreceived messages of a certain user.
@@ -81,6 +101,11 @@ class MsgStore:
 		db = self.__open(receiver_id)
 		if not db: return None
 
+		# Read and delete within a single transaction,
+		# so messages stored by another worker meanwhile
+		# don't get lost.
+		db.execute("BEGIN IMMEDIATE;")
+
 		q = "SELECT * FROM msg;"
 		for row in db.execute(q):
 			pckt_buf = Proto.pack_header(row[1],
@@ -90,7 +115,8 @@ class MsgStore:
 		if delete_after:
 			# Delete all messages
 			db.execute("DELETE FROM msg;")
-			db.commit()
+			REPLAYED.inc(len(msgs))
+		db.commit()
 
 		db.close()
 		return msgs
@@ -100,7 +126,9 @@ class MsgStore:
 		try:
 			db_name = receiver_id.hex() + ".db"
 			path  = path_join(self.conf.msgdir, db_name)
-			db = sqlite3.connect(path, check_same_thread=False)
+			db = sqlite3.connect(path, timeout=DB_TIMEOUT,
+					check_same_thread=False)
+			db.execute("PRAGMA journal_mode=WAL;")
 			db.execute(MsgStore.CREATE_TABLE_MSG)
 			db.commit()
 		except Exception as e:
@@ -0,0 +1,135 @@
+import threading
+import logging
+
+from time import monotonic
+
+"""\
+The presence directory knows which user is connected to
+which node of the cluster.
+
+Every node keeps its own replica of the directory, which is
+updated by the presence messages of the other nodes (see
+Router.py). Nodes send heartbeats, if a node doesn't show
+up for a while, all its users are considered offline.
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class PresenceDirectory:
+
+	def __init__(self, node_timeout):
+		"""\
+		Args:
+		  node_timeout: Seconds after which a silent node
+		                is removed
+		"""
+		self.node_timeout = node_timeout
+
+		# Users connected to other nodes.
+		# Key=userid, value=RemoteConn
+		self.users = {}
+
+		# Address index, key=host, value=dict(userid:RemoteConn)
+		self.hosts = {}
+
+		# Known nodes, key=node, value=time last seen
+		self.nodes = {}
+
+		self.lock = threading.Lock()
+
+
+	def touch(self, node):
+		"""\
+		Mark node as alive.
+		Return:
+		  True if node is new, else False
+		"""
+		with self.lock:
+			is_new = node not in self.nodes
+			self.nodes[node] = monotonic()
+		return is_new
+
+
+	def set_online(self, conn):
+		"""\
+		Add user (RemoteConn) to directory.
+		"""
+		with self.lock:
+			self.__remove(self.users.get(conn.userid))
+			self.users[conn.userid] = conn
+			self.hosts.setdefault(conn.host, {})[conn.userid] = conn
+
+
+	def set_offline(self, node, userid):
+		"""\
+		Remove user from directory, if it's connected
+		to given node.
+		"""
+		with self.lock:
+			conn = self.users.get(userid)
+			if conn and conn.node == node:
+				self.__remove(conn)
+
+
+	def get(self, userid):
+		"""\
+		Get RemoteConn by userid or None.
+		"""
+		return self.users.get(userid)
+
+
+	def get_by_address(self, address):
+		"""\
+		Get RemoteConn by (ip-)address or None.
+		"""
+		conns = self.hosts.get(address)
+		if conns:
+			for conn in list(conns.values()):
+				return conn
+		return None
+
+
+	def drop_node(self, node):
+		"""\
+		Remove node and all of its users.
+		"""
+		with self.lock:
+			self.nodes.pop(node, None)
+			for conn in list(self.users.values()):
+				if conn.node == node:
+					self.__remove(conn)
+
+
+	def expire_nodes(self):
+		"""\
+		Remove all nodes which didn't show up within
+		node_timeout seconds.
+		Return:
+		  List with removed nodes
+		"""
+		limit = monotonic() - self.node_timeout
+		with self.lock:
+			nodes = [n for n,t in self.nodes.items() if t < limit]
+
+		for node in nodes:
+			LOG.warning("Presence: node {} timed out".format(node))
+			self.drop_node(node)
+		return nodes
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __remove(self, conn):
+		"""\
+		Remove RemoteConn from directory (lock must be held).
+		"""
+		if not conn:
+			return
+		self.users.pop(conn.userid, None)
+		conns = self.hosts.get(conn.host)
+		if conns and conns.get(conn.userid) is conn:
+			conns.pop(conn.userid)
+			if not conns:
+				self.hosts.pop(conn.host)
@@ -3,6 +3,8 @@ import sys
 import signal
 
 from ssl import SSLError
+from time import monotonic
+from time import sleep as time_sleep
 from base64 import b64encode,b64decode
 import logging
 
@@ -16,6 +18,11 @@ from . AudioServer import *
 from . MsgStore import MsgStore
 from . ServerDb import ServerDb
 from . ClientThread import ClientThread
+from . Router import Router
+from . ServiceProcess import ServiceProcess
+from . SessionTable import SessionTable
+from . UploadStore import UploadStore
+from . import Metrics
 
 
 """\
@@ -35,12 +42,28 @@ from . ClientThread import ClientThread
  |   |__ <userid2>.pem
  |   |__ ...
  |__ uploads/		# To store uploaded files
+ |__ uploads.db		# State of uploads (see UploadStore.py)
  |__ msg/		# To store unsent messages
+ |__ ipc/		# Sockets of worker processes
  |__ server.db		# Database with users and regkeys (see ServerDb.py)
 """
 
 LOG = logging.getLogger()
 
+ACCEPTED = Metrics.counter('retro_connections_accepted_total',
+		'Accepted chat connections')
+
+# Restart delay of a failed worker (s), doubled on every
+# failure up to the maximum. A worker running for at least
+# RESTART_WINDOW seconds restarts with the minimum delay.
+RESTART_DELAY_MIN = 1
+RESTART_DELAY_MAX = 60
+
+# The supervisor gives up if a worker fails more than
+# RESTART_MAX_FAILURES times within RESTART_WINDOW seconds.
+RESTART_WINDOW = 60
+RESTART_MAX_FAILURES = 5
+
 
 class RetroServer:
 
@@ -57,12 +80,14 @@ class RetroServer:
 		# The chatserver listening context
 		self.serv = TLSListener(self.conf, 'server')
 
-		# The fileserver context (type=FileServer).
+		# The fileserver context (type=FileServer or
+		# ServiceProcess if running in its own process).
 		# This will be initialized by self.start_servers()
 		# if self.conf.fileserver_enable is True.
 		self.fileserv = None
 
-		# Audioserver context (type=AudioServer)
+		# Audioserver context (type=AudioServer or
+		# ServiceProcess if running in its own process).
 		# This will be initialized by self.start_servers()
 		# if self.conf.audioserver_enabled is True.
 		self.audioserv = None
@@ -74,12 +99,29 @@ class RetroServer:
 		# Key=ClientId(8 byte), value=ClientThread
 		self.conns = {}
 
+		# Address index and tokens of connected clients,
+		# used to authorize file/audio connections.
+		self.sessions = SessionTable()
+
 		# Message storage
 		self.msgStore = MsgStore(self)
 
 		# Server database (users, regkeys)
 		self.servDb = ServerDb(self)
 
+		# Worker index (if running with several worker
+		# processes) or None.
+		self.worker = None
+
+		# Router between worker processes and cluster
+		# nodes (type=Router). This will be initialized
+		# by self.start_servers() if running with several
+		# workers or in cluster mode.
+		self.router = None
+
+		# Metrics exporter (type=MetricsExporter) or None
+		self.metrics = None
+
 		# Server is done?
 		self.done = False
 
@@ -101,6 +143,22 @@ class RetroServer:
 			return False
 
 
+	def migrate_uploads(self):
+		"""\
+		Move the files in uploaddir to the configured
+		layout ([fileserver] sharded). Must be done while
+		the server isn't running.
+		"""
+		try:
+			nmoved = UploadStore(self.conf).migrate()
+			LOG.info("Migrate uploads: moved {} files".format(
+				nmoved))
+			return True
+		except Exception as e:
+			LOG.error("Migrate uploads: " + str(e))
+			return False
+
+
 	def load(self):
 		"""\
 		Load the server config file, setup logger, ...
@@ -116,39 +174,144 @@ class RetroServer:
 	def run(self):
 		"""\
 		Run retro server.
+		If more than one worker is configured, a supervisor
+		is started which forks the worker processes.
 		"""
+		if self.conf.daemonize:
+			# Start the daemon process
+			try:
+				self.__daemonize()
+			except Exception as e:
+				LOG.error("Daemonize: " + str(e))
+				return False
 
-		if not self.__start_servers():
+		if self.conf.server_workers > 1:
+			return self.__run_supervisor()
+		else:	return self.__run_server()
+
+
+	def add_user(self, userid):
+		"""\
+		Add newly registered user.
+		"""
+		self.users.append(userid)
+		if self.router:
+			self.router.new_user(userid)
+
+
+	def add_conn(self, cli):
+		"""\
+		Add authenticated client (ClientThread).
+		"""
+		self.conns[cli.userid] = cli
+		self.sessions.add(cli, cli.conn.host)
+		if self.router:
+			self.router.user_online(cli)
+
+
+	def remove_conn(self, cli):
+		"""\
+		Remove disconnected client (ClientThread).
+		"""
+		self.conns.pop(cli.userid, None)
+		self.sessions.remove(cli, cli.conn.host)
+		if self.router:
+			self.router.user_offline(cli)
+
+
+	def issue_token(self, userid):
+		"""\
+		Create transfer token for given user, valid until
+		the user disconnects.
+		"""
+		token = self.sessions.issue_token(userid)
+		if self.router:
+			self.router.add_token(token,
+				SessionTable.TRANSFER, [userid], 0)
+		return token
+
+
+	def invite_call(self, callid, userid, callee):
+		"""\
+		Record the invitation of callee to a call
+		(T_START_CALL). Only users of a running call may
+		invite further users (conference).
+		Return:
+		  False if the call id belongs to a call of other
+		  users
+		"""
+		known = self.sessions.check_token(callid,
+				SessionTable.CALL)
+		if known and userid not in known:
 			return False
+		return self.__add_token(
+			SessionTable.invite_key(callid, callee),
+			SessionTable.INVITE, [userid, callee])
 
-		while not self.done:
-			try:
-				# Accept client and start client thread
-				conn = self.serv.accept(
-						self.conf.accept_timeout)
-				if not conn: continue # Timeout
 
-				LOG.info("Server: accepted "\
-					+ conn.tostr())
+	def add_call_token(self, callid, userid, caller):
+		"""\
+		Register callid as token for the calling partners
+		when the callee accepts an invitation
+		(T_ACCEPT_CALL). A callee invited to a running call
+		(conference) is added to the users of the token.
+		Return:
+		  False if the callee wasn't invited by the caller
+		"""
+		invite = self.sessions.check_token(
+				SessionTable.invite_key(callid, userid),
+				SessionTable.INVITE)
+		if not invite or invite[0] != caller:
+			return False
 
-				cli = ClientThread(self, conn)
-				cli.start()
+		known = self.sessions.check_token(callid,
+				SessionTable.CALL)
+		if not known:
+			userids = [caller, userid]
+		elif caller not in known:
+			return False
+		else:
+			userids = list(known)
+			if userid not in userids:
+				userids.append(userid)
+		return self.__add_token(callid, SessionTable.CALL,
+				userids)
 
-			except SSLError as e:
-				LOG.warning("accept: {}".format(e))
-				continue
 
-			except Exception as e:
-				LOG.error("{}".format(e))
-				break
-			except KeyboardInterrupt:
-				LOG.error("Interrupted, closing server...")
-				break
+	def get_conn(self, userid):
+		"""\
+		Get connection by userid or None if user is
+		offline everywhere. If the user is connected to
+		another worker/node, a RemoteConn is returned.
+		"""
+		conn = self.conns.get(userid)
+		if not conn and self.router:
+			conn = self.router.get_conn(userid)
+		return conn
 
-		self.done = True
-		self.__close()
 
-		return True
+	def get_stats(self):
+		"""\
+		Returns dictionary with statistics of all servers
+		running in this process.
+		"""
+		stats = {'connections' : len(self.conns)}
+		if isinstance(self.fileserv, FileServer):
+			stats.update(self.fileserv.get_stats())
+		if isinstance(self.audioserv, AudioServer):
+			stats.update(self.audioserv.get_stats())
+		return stats
+
+
+	def log_stats(self, *args):
+		"""\
+		Log statistics (called on SIGUSR1).
+		"""
+		stats = self.get_stats()
+		LOG.info("Stats: " + " ".join("{}={}".format(k, v)
+				for k,v in sorted(stats.items())))
+		if isinstance(self.audioserv, AudioServer):
+			self.audioserv.log_call_stats()
 
 
 	def get_all_users(self):
@@ -169,9 +332,11 @@ class RetroServer:
 		Get connection (ClientThread) by (ip-)address
 		or None if connection doesn't exist.
 		"""
-		for conn in self.conns.values():
-			if conn.conn.host == address:
-				return conn
+		conn = self.sessions.get_by_address(address)
+		if conn:
+			return conn
+		if self.router:
+			return self.router.get_conn_by_address(address)
 		return None
 
 	def get_user_status(self, userid):
@@ -187,7 +352,7 @@ class RetroServer:
 		"""
 		if userid not in self.users:
 			return Proto.T_FRIEND_UNKNONW
-		elif userid in self.conns:
+		elif self.get_conn(userid):
 			return Proto.T_FRIEND_ONLINE
 		else:	return Proto.T_FRIEND_OFFLINE
 
@@ -220,21 +385,105 @@ class RetroServer:
 
 	#--- PRIVATE ---------------------------------------------------------
 
+	def __add_token(self, token, kind, userids):
+		"""\
+		Add token valid for token_ttl seconds, pass it to
+		the other nodes.
+		"""
+		if not self.sessions.add_token(token, kind, userids,
+				self.conf.token_ttl):
+			return False
+		if self.router:
+			self.router.add_token(token, kind, userids,
+				self.conf.token_ttl)
+		return True
+
+
+	def __run_server(self):
+		"""\
+		Start all servers and run the chatserver accept
+		loop.
+		"""
+		if not self.__start_servers():
+			return False
+
+		signal.signal(signal.SIGUSR1, self.log_stats)
+
+		while not self.done:
+			try:
+				# Accept client and start client thread
+				conn = self.serv.accept(
+						self.conf.accept_timeout)
+				if not conn: continue # Timeout
+
+				LOG.info("Server: accepted "\
+					+ conn.tostr())
+				ACCEPTED.inc()
+
+				cli = ClientThread(self, conn)
+				cli.start()
+
+			except SSLError as e:
+				LOG.warning("accept: {}".format(e))
+				continue
+
+			except Exception as e:
+				LOG.error("{}".format(e))
+				break
+			except KeyboardInterrupt:
+				LOG.error("Interrupted, closing server...")
+				break
+
+		self.done = True
+		self.__close()
+
+		return True
+
+
 	def __start_servers(self):
 		"""\
 		Start the chatserver, fileserver and audioserver.
+		If running as worker process, in cluster mode or
+		with file-/audioserver in separate processes, the
+		router is started as well. Only worker 0 runs the
+		file- and audioserver.
 		"""
+		node = self.conf.cluster_node
+		run_fileserv  = self.conf.fileserver_enable\
+				and not self.worker
+		run_audioserv = self.conf.audioserver_enable\
+				and not self.worker
+
+		if self.worker is None:
+			LOG.info("Starting Retroserver ...")
+			self.conf.debug()
+		else:
+			LOG.info("Starting worker {} (pid={}) ..."\
+				.format(self.worker, os.getpid()))
+			node += "-worker{}".format(self.worker)
+
+		# Fork the service processes before any thread
+		# is started.
+		if run_fileserv and self.conf.fileserver_process:
+			self.fileserv = ServiceProcess(self,
+					'fileserver', FileServer)
+			self.fileserv.start()
 
-		if self.conf.daemonize:
-			# Start the daemon process
+		if run_audioserv and self.conf.audioserver_process:
+			self.audioserv = ServiceProcess(self,
+					'audioserver', AudioServer)
+			self.audioserv.start()
+
+		if self.worker is not None or self.conf.cluster_enable\
+				or self.fileserv or self.audioserv:
 			try:
-				self.__daemonize()
+				self.router = Router(self, node)
 			except Exception as e:
-				LOG.error("Daemonize: " + str(e))
+				LOG.error("Router: " + str(e))
 				return False
-
-		LOG.info("Starting Retroserver ...")
-		self.conf.debug()
+			if not self.router.open():
+				return False
+			self.router.start()
 
 		hex_user_ids = [id.hex() for id in self.users]
 		LOG.debug("Users: [{}]".format(
@@ -244,20 +493,26 @@ class RetroServer:
 			self.conf.server_address,
 			self.conf.server_port))
 
-		# Default TLS server listen
-		if not self.serv.listen():
+		# Default TLS server listen. All workers share
+		# the listen port.
+		if not self.serv.listen(
+				reuse_port=self.worker is not None):
 			return False
 
 		# Starting fileserver (if enabled)
-		if self.conf.fileserver_enable:
+		if run_fileserv and not self.fileserv:
 			self.fileserv = FileServer(self)
 			self.fileserv.start()
 
 		# Starting audioserver (if enabled)
-		if self.conf.audioserver_enable:
+		if run_audioserv and not self.audioserv:
 			self.audioserv = AudioServer(self)
 			self.audioserv.start()
 
+		# Metrics exporter of this process
+		self.metrics = Metrics.start_exporter(self.conf,
+				self.worker or 0, self.get_stats)
+
 		return True
 
 
@@ -266,12 +521,16 @@ class RetroServer:
 
 		if self.fileserv:
 			LOG.debug("Waiting for fileserver to stop ...")
-			self.fileserv.done = True
+			if isinstance(self.fileserv, ServiceProcess):
+				self.fileserv.stop()
+			else:	self.fileserv.done = True
 
 
 		if self.audioserv:
 			LOG.debug("Waiting for audioserver to stop ...")
-			self.audioserv.done = True
+			if isinstance(self.audioserv, ServiceProcess):
+				self.audioserv.stop()
+			else:	self.audioserv.done = True
 
 
 		for conn in self.conns.values():
@@ -287,13 +546,152 @@ class RetroServer:
 			except Exception as e:
 				LOG.warning("Failed to join thread: " + str(e))
 
+		if self.router:
+			self.router.done = True
+
+		if self.metrics:
+			self.metrics.stop()
+
 		LOG.info("Shutting down chatserver")
 		self.serv.close()
 
-		# Delete pidfile (if exists)
+		# Delete pidfile (if exists), this is done
+		# by the supervisor when running with workers.
+		if self.worker is None:
+			try: os.remove(self.conf.pidfile)
+			except:	pass
+
+
+	def __run_supervisor(self):
+		"""\
+		Fork the worker processes and restart them if
+		they terminate unexpectedly, with exponential
+		backoff. If a worker keeps failing, all workers
+		are stopped. On SIGTERM/SIGHUP all workers are
+		stopped.
+		"""
+		LOG.info("Starting supervisor with {} workers ..."\
+			.format(self.conf.server_workers))
+
+		workers  = {}	# Key=pid, value=worker index
+		started  = {}	# Key=worker index, value=start time
+		failures = {}	# Key=worker index, value=[failure times]
+		delays   = {}	# Key=worker index, value=restart delay
+		pending  = {}	# Key=worker index, value=restart time
+		ok = True
+
+		def stop_workers(*args):
+			self.done = True
+			for pid in workers:
+				try: os.kill(pid, signal.SIGTERM)
+				except OSError: pass
+
+		def forward_signal(signum, frame):
+			for pid in workers:
+				try: os.kill(pid, signum)
+				except OSError: pass
+
+		signal.signal(signal.SIGTERM, stop_workers)
+		signal.signal(signal.SIGHUP, stop_workers)
+		signal.signal(signal.SIGUSR1, forward_signal)
+
+		for i in range(self.conf.server_workers):
+			pid = self.__fork_worker(i)
+			workers[pid] = i
+			started[i] = monotonic()
+
+		while workers or pending:
+			if self.done:
+				pending.clear()
+
+			# Restart failed workers whose delay is over
+			now = monotonic()
+			for i,t in list(pending.items()):
+				if t <= now:
+					del pending[i]
+					workers[self.__fork_worker(i)] = i
+					started[i] = now
+
+			try:
+				if pending:
+					pid,status = os.waitpid(-1, os.WNOHANG)
+					if not pid:
+						time_sleep(min(0.5, max(0, min(
+							pending.values()) - now)))
+						continue
+				else:	pid,status = os.waitpid(-1, 0)
+			except ChildProcessError:
+				if pending:
+					time_sleep(min(0.5, max(0, min(
+						pending.values()) - now)))
+					continue
+				break
+			except KeyboardInterrupt:
+				LOG.error("Interrupted, stopping workers...")
+				stop_workers()
+				continue
+
+			i = workers.pop(pid, None)
+			if i is None or self.done:
+				continue
+
+			# Back off if the worker failed shortly after
+			# it was started.
+			now = monotonic()
+			if now - started[i] >= RESTART_WINDOW:
+				delays[i] = RESTART_DELAY_MIN
+			else:	delays[i] = min(2 * delays.get(i, 0)
+						or RESTART_DELAY_MIN,
+						RESTART_DELAY_MAX)
+			failures[i] = [t for t in failures.get(i, [])
+					if now - t < RESTART_WINDOW] + [now]
+
+			if len(failures[i]) > RESTART_MAX_FAILURES:
+				LOG.error("Worker {} failed {} times within {} s,"\
+					" stopping supervisor".format(i,
+					len(failures[i]), RESTART_WINDOW))
+				ok = False
+				stop_workers()
+				continue
+
+			LOG.warning("Worker {} terminated (status={}), "\
+				"restarting in {} s ...".format(i, status,
+				delays[i]))
+			pending[i] = now + delays[i]
+
+		LOG.info("All workers stopped")
+
 		try: os.remove(self.conf.pidfile)
 		except:	pass
 
+		return ok
+
+
+	def __fork_worker(self, index):
+		"""\
+		Fork worker process with given index.
+		Return:
+		  Pid of worker (in supervisor process)
+		"""
+		pid = os.fork()
+		if pid > 0:
+			return pid
+
+		# Worker process
+		def stop_server(*args):
+			self.done = True
+
+		signal.signal(signal.SIGTERM, stop_server)
+		signal.signal(signal.SIGHUP, stop_server)
+
+		self.worker = index
+		try:
+			ok = self.__run_server()
+		except Exception as e:
+			LOG.error("Worker {}: {}".format(index, e))
+			ok = False
+		os._exit(0 if ok else 1)
+
 
 	def __daemonize(self):
 		"""\
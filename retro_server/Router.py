@@ -0,0 +1,274 @@
+import struct
+import threading
+import logging
+
+from time import monotonic
+
+from libretro.protocol import Proto
+
+from . MessageBus import get_bus_class
+from . PresenceDirectory import PresenceDirectory
+
+"""\
+The router connects the nodes of a retro server cluster.
+A node is either a worker process (see RetroServer, section
+[server] workers) or a complete server instance running in
+cluster mode (section [cluster]).
+
+Every node only knows the clients it has accepted itself.
+The router announces these clients (presence) to all other
+nodes and keeps track of clients connected elsewhere as
+RemoteConn instances (see PresenceDirectory.py). Packets sent
+to a RemoteConn are passed to the owning node, which delivers
+them to its client (or stores them, if the client went
+offline in the meantime). A packet received from the bus is
+never passed on to another node, so each cross-node packet
+is forwarded exactly once.
+
+Bus messages start with a single byte message type:
+
+  M_HELLO    Node started, all peers answer with M_ONLINE
+  M_ONLINE   userid(8) + host
+  M_OFFLINE  userid(8)
+  M_PACKET   userid(8) + pckt_type(2) + pckt_data
+  M_NEWUSER  userid(8)
+  M_PING     Heartbeat
+  M_TOKEN    token(16) + kind(1) + ttl(4) + userid(8) + ...
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class RemoteConn:
+	"""\
+	Client connected to another node.
+	"""
+	def __init__(self, router, node, userid, host):
+		self.router = router
+		self.node   = node	# Node the client is connected to
+		self.userid = userid	# Userid of client
+		self.host   = host	# Address of client
+
+
+	def send_packet(self, pckt_type, *pckt_data):
+		"""\
+		Send packet to the client via the owning node.
+		Return:
+		  True on success, else False
+		"""
+		return self.router.send_packet(self.node, self.userid,
+				pckt_type, b''.join(pckt_data))
+
+
+
+class Router(threading.Thread):
+
+	M_HELLO   = 1
+	M_ONLINE  = 2
+	M_OFFLINE = 3
+	M_PACKET  = 4
+	M_NEWUSER = 5
+	M_PING    = 6
+	M_TOKEN   = 7
+
+
+	def __init__(self, server, node):
+		"""\
+		Args:
+		  server: RetroServer instance
+		  node:   Name of this node
+		"""
+		super().__init__(daemon=True)
+
+		self.serv = server
+		self.conf = server.conf
+		self.node = node
+
+		bus_class = get_bus_class(self.conf.cluster_bus)
+		self.bus  = bus_class(self.conf.ipcdir, node)
+
+		# Users connected to other nodes
+		self.presence = PresenceDirectory(
+				3 * self.conf.cluster_heartbeat)
+
+		self.done = False
+
+
+	def open(self):
+		"""\
+		Attach to the bus.
+		"""
+		LOG.info("Router: node {}, bus {} at {}".format(
+			self.node, self.conf.cluster_bus,
+			self.conf.ipcdir))
+		return self.bus.open()
+
+
+	def run(self):
+		"""\
+		Run the router main loop.
+		"""
+		# Ask all peers for their connected clients
+		self.bus.broadcast(bytes([Router.M_HELLO]))
+		next_ping = monotonic() + self.conf.cluster_heartbeat
+
+		while not self.done:
+			try:
+				msg = self.bus.recv(timeout_sec=1)
+				if msg:
+					self.__handle_message(*msg)
+
+				if monotonic() >= next_ping:
+					self.bus.broadcast(bytes([Router.M_PING]))
+					self.presence.expire_nodes()
+					next_ping = monotonic()\
+						+ self.conf.cluster_heartbeat
+
+			except Exception as e:
+				LOG.error("Router.run: " + str(e))
+
+		self.bus.close()
+
+
+	def get_conn(self, userid):
+		"""\
+		Get RemoteConn by userid or None if user isn't
+		connected to any other node.
+		"""
+		return self.presence.get(userid)
+
+
+	def get_conn_by_address(self, address):
+		"""\
+		Get RemoteConn by (ip-)address or None.
+		"""
+		return self.presence.get_by_address(address)
+
+
+	def user_online(self, cli):
+		"""\
+		Announce local client (ClientThread) to all nodes.
+		"""
+		self.bus.broadcast(self.__online_msg(cli))
+
+
+	def user_offline(self, cli):
+		"""\
+		Announce that local client disconnected.
+		"""
+		self.bus.broadcast(bytes([Router.M_OFFLINE]) + cli.userid)
+
+
+	def new_user(self, userid):
+		"""\
+		Announce newly registered user.
+		"""
+		self.bus.broadcast(bytes([Router.M_NEWUSER]) + userid)
+
+
+	def add_token(self, token, kind, userids, ttl):
+		"""\
+		Pass token (see SessionTable.py) to all nodes.
+		"""
+		self.bus.broadcast(bytes([Router.M_TOKEN]) + token\
+			+ struct.pack('!BI', kind, ttl) + b''.join(userids))
+
+
+	def send_packet(self, node, userid, pckt_type, pckt_data):
+		"""\
+		Pass packet to the node given user is connected to.
+		Return:
+		  True on success, else False
+		"""
+		msg = bytes([Router.M_PACKET]) + userid\
+			+ struct.pack('!H', pckt_type) + pckt_data
+
+		if not self.bus.send(node, msg):
+			# Node is gone, forget its clients
+			self.presence.drop_node(node)
+			return False
+		return True
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __handle_message(self, node, buf):
+		"""\
+		Handle message received from other node.
+		"""
+		if not node or not buf:
+			return
+
+		mtype = buf[0]
+		self.presence.touch(node)
+
+		if mtype == Router.M_HELLO:
+			# Node (re)started, forget its former clients
+			# and tell it about ours.
+			self.presence.drop_node(node)
+			self.presence.touch(node)
+			for cli in list(self.serv.conns.values()):
+				self.bus.send(node, self.__online_msg(cli))
+
+		elif mtype == Router.M_ONLINE:
+			userid = buf[1:9]
+			host   = buf[9:].decode()
+			self.presence.set_online(RemoteConn(self, node,
+							userid, host))
+			LOG.debug("Router: {} online at {}".format(
+				userid.hex(), node))
+
+		elif mtype == Router.M_OFFLINE:
+			userid = buf[1:9]
+			self.presence.set_offline(node, userid)
+			self.serv.sessions.revoke_tokens(userid)
+			LOG.debug("Router: {} offline".format(userid.hex()))
+
+		elif mtype == Router.M_PACKET:
+			self.__deliver_packet(buf[1:9],
+				struct.unpack('!H', buf[9:11])[0],
+				buf[11:])
+
+		elif mtype == Router.M_NEWUSER:
+			userid = buf[1:9]
+			if userid not in self.serv.users:
+				self.serv.users.append(userid)
+
+		elif mtype == Router.M_PING:
+			pass
+
+		elif mtype == Router.M_TOKEN:
+			token = buf[1:17]
+			kind,ttl = struct.unpack('!BI', buf[17:22])
+			userids = [buf[i:i+8] for i in range(22, len(buf), 8)]
+			self.serv.sessions.add_token(token, kind, userids, ttl)
+
+		else:
+			LOG.warning("Router: Invalid message-type "\
+				"'{}' from {}".format(mtype, node))
+
+
+	def __deliver_packet(self, userid, pckt_type, pckt_data):
+		"""\
+		Deliver packet received from other node to local
+		client. The packet is never passed on to another
+		node. If the client is gone and the packet is a
+		message, it's stored.
+		"""
+		cli = self.serv.conns.get(userid)
+		if cli:
+			try:
+				cli.send_packet(pckt_type, pckt_data)
+				return
+			except Exception as e:
+				LOG.warning("Router: deliver to {}, {}"\
+					.format(userid.hex(), e))
+
+		if pckt_type in (Proto.T_CHATMSG, Proto.T_FILEMSG):
+			self.serv.msgStore.store_msg(pckt_type, pckt_data)
+
+
+	def __online_msg(self, cli):
+		return bytes([Router.M_ONLINE]) + cli.userid\
+			+ cli.conn.host.encode()
@@ -1,4 +1,5 @@
 import configparser
+from socket import gethostname
 from os.path import join as path_join
 import logging
 
@@ -28,28 +29,67 @@ class ServerConfig:
 		self.serverdb  = path_join(basedir, "server.db")
 		self.userdir   = path_join(basedir, "users")
 		self.uploaddir = path_join(basedir, "uploads")
+		self.uploaddb  = path_join(basedir, "uploads.db")
 		self.msgdir    = path_join(basedir, "msg")
 		self.loglevel  = logging.INFO
 		self.logfile   = path_join(basedir, "log.txt")
 		self.daemonize = False
 		self.daemondir = "/"
 		self.pidfile   = path_join(basedir, "retro_server.pid")
+		self.ipcdir    = path_join(basedir, "ipc")
 		self.recv_timeout   = 10
 		self.accept_timeout = 3
+		self.token_ttl      = 60
 
 		# [server]
 		self.server_address  = "0.0.0.0"
 		self.server_port     = 8443
+		self.server_workers  = 1
 
 		# [fileserver]
 		self.fileserver_enable       = False
 		self.fileserver_port         = 8444
 		self.fileserver_max_filesize = RETRO_MAX_FILESIZE
 		self.fileserver_delete_files = True
+		self.fileserver_process      = False
+		self.fileserver_chunk_size   = 0x10000
+		self.fileserver_sendfile     = True
+		self.fileserver_upload_buffers = 4
+		self.fileserver_upload_budget  = 4 * RETRO_MAX_FILESIZE
+		self.fileserver_resume_ttl     = 24 * 3600
+		self.fileserver_idle_timeout   = 30
+		self.fileserver_max_transfers  = 16
+		self.fileserver_max_queued     = 64
+		self.fileserver_max_transfers_per_user = 4
+		self.fileserver_rate_limit     = 0
+		self.fileserver_user_rate_limit = 0
+		self.fileserver_dedup          = False
+		self.fileserver_sharded        = False
+		self.fileserver_janitor_interval = 300
+		self.fileserver_max_age        = 0
 
 		# [audioserver]
 		self.audioserver_enable = False
 		self.audioserver_port   = 8445
+		self.audioserver_process = False
+		self.audioserver_relay_loops = 1
+		self.audioserver_splice = False
+		self.audioserver_max_calls = 1000
+		self.audioserver_udp = False
+		self.audioserver_max_delay_ms = 0
+		self.audioserver_frame_size = 1
+
+		# [cluster]
+		self.cluster_enable    = False
+		self.cluster_node      = gethostname()
+		self.cluster_bus       = 'unix'
+		self.cluster_heartbeat = 5
+
+		# [metrics]
+		self.metrics_enable = False
+		self.metrics_port   = 9150
+		self.metrics_socket = None
+		self.metrics_sample = 1
 
 
 	def read_file(self):
@@ -76,8 +116,12 @@ class ServerConfig:
 					fallback=self.userdir)
 			self.uploaddir = conf.get('default', 'uploaddir',
 					fallback=self.uploaddir)
+			self.uploaddb = conf.get('default', 'uploaddb',
+					fallback=self.uploaddb)
 			self.msgdir = conf.get('default', 'msgdir',
 					fallback=self.msgdir)
+			self.ipcdir = conf.get('default', 'ipcdir',
+					fallback=self.ipcdir)
 			self.keyfile = conf.get('default', 'keyfile',
 					fallback=self.keyfile)
 			self.certfile = conf.get('default', 'certfile',
@@ -88,11 +132,16 @@ class ServerConfig:
 			self.accept_timeout = conf.get('default',
 					'accept_timeout',
 					fallback=self.accept_timeout)
+			self.token_ttl = conf.getint('default',
+					'token_ttl',
+					fallback=self.token_ttl)
 
 			# [server]
 			self.server_address = conf.get('server', 'address',
 					fallback=self.server_address)
 			self.server_port = conf.getint('server', 'port')
+			self.server_workers = conf.getint('server', 'workers',
+					fallback=self.server_workers)
 
 			# [fileserver]
 			self.fileserver_enable = conf.getboolean(
@@ -106,6 +155,58 @@ class ServerConfig:
 			self.fileserver_delete_files = conf.getboolean(
 				'fileserver', 'delete_files',
 				fallback=self.fileserver_delete_files)
+			self.fileserver_process = conf.getboolean(
+				'fileserver', 'process',
+				fallback=self.fileserver_process)
+			chunk_size = conf.get(
+				'fileserver', 'chunk_size',
+				fallback=str(self.fileserver_chunk_size))
+			self.fileserver_chunk_size = int(chunk_size, 0)
+			self.fileserver_sendfile = conf.getboolean(
+				'fileserver', 'sendfile',
+				fallback=self.fileserver_sendfile)
+			self.fileserver_upload_buffers = conf.getint(
+				'fileserver', 'upload_buffers',
+				fallback=self.fileserver_upload_buffers)
+			upload_budget = conf.get(
+				'fileserver', 'upload_budget',
+				fallback=str(self.fileserver_upload_budget))
+			self.fileserver_upload_budget = int(upload_budget, 0)
+			self.fileserver_resume_ttl = conf.getint(
+				'fileserver', 'resume_ttl',
+				fallback=self.fileserver_resume_ttl)
+			self.fileserver_idle_timeout = conf.getint(
+				'fileserver', 'idle_timeout',
+				fallback=self.fileserver_idle_timeout)
+			self.fileserver_max_transfers = conf.getint(
+				'fileserver', 'max_transfers',
+				fallback=self.fileserver_max_transfers)
+			self.fileserver_max_queued = conf.getint(
+				'fileserver', 'max_queued',
+				fallback=self.fileserver_max_queued)
+			self.fileserver_max_transfers_per_user = conf.getint(
+				'fileserver', 'max_transfers_per_user',
+				fallback=self.fileserver_max_transfers_per_user)
+			rate_limit = conf.get(
+				'fileserver', 'rate_limit',
+				fallback=str(self.fileserver_rate_limit))
+			self.fileserver_rate_limit = int(rate_limit, 0)
+			rate_limit = conf.get(
+				'fileserver', 'user_rate_limit',
+				fallback=str(self.fileserver_user_rate_limit))
+			self.fileserver_user_rate_limit = int(rate_limit, 0)
+			self.fileserver_dedup = conf.getboolean(
+				'fileserver', 'dedup',
+				fallback=self.fileserver_dedup)
+			self.fileserver_sharded = conf.getboolean(
+				'fileserver', 'sharded',
+				fallback=self.fileserver_sharded)
+			self.fileserver_janitor_interval = conf.getint(
+				'fileserver', 'janitor_interval',
+				fallback=self.fileserver_janitor_interval)
+			self.fileserver_max_age = conf.getint(
+				'fileserver', 'max_age',
+				fallback=self.fileserver_max_age)
 
 			# [audioserver]
 			self.audioserver_enable = conf.getboolean(
@@ -113,6 +214,49 @@ class ServerConfig:
 				fallback=self.audioserver_enable)
 			self.audioserver_port = conf.getint('audioserver',
 				'port', fallback=self.audioserver_port)
+			self.audioserver_process = conf.getboolean(
+				'audioserver', 'process',
+				fallback=self.audioserver_process)
+			self.audioserver_relay_loops = conf.getint(
+				'audioserver', 'relay_loops',
+				fallback=self.audioserver_relay_loops)
+			self.audioserver_splice = conf.getboolean(
+				'audioserver', 'splice',
+				fallback=self.audioserver_splice)
+			self.audioserver_max_calls = conf.getint(
+				'audioserver', 'max_calls',
+				fallback=self.audioserver_max_calls)
+			self.audioserver_udp = conf.getboolean(
+				'audioserver', 'udp',
+				fallback=self.audioserver_udp)
+			self.audioserver_max_delay_ms = conf.getint(
+				'audioserver', 'max_delay_ms',
+				fallback=self.audioserver_max_delay_ms)
+			self.audioserver_frame_size = conf.getint(
+				'audioserver', 'frame_size',
+				fallback=self.audioserver_frame_size)
+
+			# [cluster]
+			self.cluster_enable = conf.getboolean(
+				'cluster', 'enabled',
+				fallback=self.cluster_enable)
+			self.cluster_node = conf.get('cluster', 'node',
+				fallback=self.cluster_node)
+			self.cluster_bus = conf.get('cluster', 'bus',
+				fallback=self.cluster_bus)
+			self.cluster_heartbeat = conf.getint('cluster',
+				'heartbeat', fallback=self.cluster_heartbeat)
+
+			# [metrics]
+			self.metrics_enable = conf.getboolean(
+				'metrics', 'enabled',
+				fallback=self.metrics_enable)
+			self.metrics_port = conf.getint('metrics', 'port',
+				fallback=self.metrics_port)
+			self.metrics_socket = conf.get('metrics', 'socket',
+				fallback=self.metrics_socket)
+			self.metrics_sample = conf.getint('metrics', 'sample',
+				fallback=self.metrics_sample)
 
 			return True
 		except configparser.NoOptionError as e:
@@ -134,20 +278,57 @@ class ServerConfig:
 		LOG.debug("  pidfile        = {}".format(self.pidfile))
 		LOG.debug("  userdir        = {}".format(self.userdir))
 		LOG.debug("  uploaddir      = {}".format(self.uploaddir))
+		LOG.debug("  uploaddb       = {}".format(self.uploaddb))
 		LOG.debug("  msgdir         = {}".format(self.msgdir))
+		LOG.debug("  ipcdir         = {}".format(self.ipcdir))
 		LOG.debug("  recv_timeout   = {}".format(self.recv_timeout))
 		LOG.debug("  accept_timeout = {}".format(self.accept_timeout))
+		LOG.debug("  token_ttl      = {}".format(self.token_ttl))
 		LOG.debug("[server]")
 		LOG.debug("  address        = {}".format(self.server_address))
 		LOG.debug("  port           = {}".format(self.server_port))
+		LOG.debug("  workers        = {}".format(self.server_workers))
 		LOG.debug("[fileserver]")
 		LOG.debug("  enabled        = {}".format(self.fileserver_enable))
 		LOG.debug("  port           = {}".format(self.fileserver_port))
 		LOG.debug("  max_filesize   = {}".format(self.fileserver_max_filesize))
 		LOG.debug("  delete_files   = {}".format(self.fileserver_delete_files))
+		LOG.debug("  process        = {}".format(self.fileserver_process))
+		LOG.debug("  chunk_size     = {}".format(self.fileserver_chunk_size))
+		LOG.debug("  sendfile       = {}".format(self.fileserver_sendfile))
+		LOG.debug("  upload_buffers = {}".format(self.fileserver_upload_buffers))
+		LOG.debug("  upload_budget  = {}".format(self.fileserver_upload_budget))
+		LOG.debug("  resume_ttl     = {}".format(self.fileserver_resume_ttl))
+		LOG.debug("  idle_timeout   = {}".format(self.fileserver_idle_timeout))
+		LOG.debug("  max_transfers  = {}".format(self.fileserver_max_transfers))
+		LOG.debug("  max_queued     = {}".format(self.fileserver_max_queued))
+		LOG.debug("  max_transfers_per_user = {}".format(self.fileserver_max_transfers_per_user))
+		LOG.debug("  rate_limit     = {}".format(self.fileserver_rate_limit))
+		LOG.debug("  user_rate_limit = {}".format(self.fileserver_user_rate_limit))
+		LOG.debug("  dedup          = {}".format(self.fileserver_dedup))
+		LOG.debug("  sharded        = {}".format(self.fileserver_sharded))
+		LOG.debug("  janitor_interval = {}".format(self.fileserver_janitor_interval))
+		LOG.debug("  max_age        = {}".format(self.fileserver_max_age))
 		LOG.debug("[audioserver]")
 		LOG.debug("  enabled        = {}".format(self.audioserver_enable))
 		LOG.debug("  port           = {}".format(self.audioserver_port))
+		LOG.debug("  process        = {}".format(self.audioserver_process))
+		LOG.debug("  relay_loops    = {}".format(self.audioserver_relay_loops))
+		LOG.debug("  splice         = {}".format(self.audioserver_splice))
+		LOG.debug("  max_calls      = {}".format(self.audioserver_max_calls))
+		LOG.debug("  udp            = {}".format(self.audioserver_udp))
+		LOG.debug("  max_delay_ms   = {}".format(self.audioserver_max_delay_ms))
+		LOG.debug("  frame_size     = {}".format(self.audioserver_frame_size))
+		LOG.debug("[cluster]")
+		LOG.debug("  enabled        = {}".format(self.cluster_enable))
+		LOG.debug("  node           = {}".format(self.cluster_node))
+		LOG.debug("  bus            = {}".format(self.cluster_bus))
+		LOG.debug("  heartbeat      = {}".format(self.cluster_heartbeat))
+		LOG.debug("[metrics]")
+		LOG.debug("  enabled        = {}".format(self.metrics_enable))
+		LOG.debug("  port           = {}".format(self.metrics_port))
+		LOG.debug("  socket         = {}".format(self.metrics_socket))
+		LOG.debug("  sample         = {}".format(self.metrics_sample))
 
 
 	def loglevel_string_to_level(self, loglevel_str):
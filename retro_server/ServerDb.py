@@ -6,6 +6,9 @@ import sqlite3
 from libretro.protocol import Proto
 from libretro.crypto import random_buffer
 
+from . MsgStore import DB_TIMEOUT, DB_LATENCY
+from . import Metrics
+
 
 LOG = logging.getLogger(__name__)
 
@@ -61,6 +64,7 @@ class ServerDb:
 		return userid
 
 
+	@Metrics.timed(DB_LATENCY)
 	def add_user(self, userid:bytes):
 		"""\
 		Add entry to table 'users'.
@@ -73,6 +77,7 @@ class ServerDb:
 		db.commit()
 		db.close()
 
+	@Metrics.timed(DB_LATENCY)
 	def user_exists(self, userid:bytes):
 		"""\
 		Returns True if given userid exists in
@@ -87,6 +92,7 @@ class ServerDb:
 		db.close()
 		return True if uid else False
 
+	@Metrics.timed(DB_LATENCY)
 	def delete_user(self, userid:bytes):
 		"""\
 		Delete given userid from table 'users'.
@@ -110,6 +116,7 @@ class ServerDb:
 				break
 		return regkey
 
+	@Metrics.timed(DB_LATENCY)
 	def add_regkey(self, regkey:bytes):
 		"""\
 		Add entry to table 'regkey'.
@@ -122,6 +129,7 @@ class ServerDb:
 		db.commit()
 		db.close()
 
+	@Metrics.timed(DB_LATENCY)
 	def regkey_exists(self, regkey:bytes):
 		"""\
 		Returns True if given regkey exists in
@@ -137,6 +145,7 @@ class ServerDb:
 		return True if rk else False
 
 
+	@Metrics.timed(DB_LATENCY)
 	def delete_regkey(self, regkey:bytes):
 		"""\
 		Delete given regkey from table 'register'.
@@ -154,7 +163,9 @@ class ServerDb:
 		Opens/Creats the server db
 		"""
 		try:
-			db = sqlite3.connect(self.path, check_same_thread=False)
+			db = sqlite3.connect(self.path, timeout=DB_TIMEOUT,
+					check_same_thread=False)
+			db.execute("PRAGMA journal_mode=WAL;")
 			db.execute(ServerDb.CREATE_TABLE_USERS)
 			db.commit()
 			db.execute(ServerDb.CREATE_TABLE_REGISTER)
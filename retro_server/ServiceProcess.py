@@ -0,0 +1,140 @@
+import os
+import signal
+import threading
+import logging
+
+from time import sleep as time_sleep
+
+from . Router import Router
+from . SessionTable import SessionTable
+from . import Metrics
+
+"""\
+Runs the fileserver or audioserver in a process of its own,
+so bulk file I/O and audio relaying don't compete with chat
+routing for the GIL.
+
+The service process is a node at the message bus (see
+Router.py). It doesn't accept chat clients itself, but its
+presence directory contains all clients connected to the
+chatserver, so the authorization of file/audio connections
+(RetroServer.get_conn_by_address) works as usual.
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class ServiceProcess:
+
+	def __init__(self, server, name, service_class):
+		"""\
+		Args:
+		  server:        RetroServer instance
+		  name:          Service name ('fileserver', ...)
+		  service_class: FileServer or AudioServer
+		"""
+		self.serv  = server
+		self.conf  = server.conf
+		self.name  = name
+		self.cls   = service_class
+		self.pid   = None
+
+
+	def start(self):
+		"""\
+		Fork the service process.
+		"""
+		pid = os.fork()
+		if pid > 0:
+			self.pid = pid
+			LOG.info("Started {} process (pid={})"\
+				.format(self.name, pid))
+			return
+
+		ok = False
+		try:
+			ok = self.__run()
+		except Exception as e:
+			LOG.error("{}: {}".format(self.name, e))
+		except KeyboardInterrupt:
+			pass
+		os._exit(0 if ok else 1)
+
+
+	def stop(self):
+		"""\
+		Stop service process and wait for it.
+		"""
+		if not self.pid:
+			return
+		try:
+			os.kill(self.pid, signal.SIGTERM)
+			os.waitpid(self.pid, 0)
+		except (OSError, ChildProcessError) as e:
+			LOG.warning("{}: stop, {}".format(self.name, e))
+		self.pid = None
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __run(self):
+		"""\
+		Service process main.
+		"""
+		serv = self.serv
+		serv.conns = {}
+		serv.sessions = SessionTable()
+
+		node = "{}-{}".format(self.conf.cluster_node, self.name)
+		if serv.worker is not None:
+			node += str(serv.worker)
+
+		serv.router = Router(serv, node)
+		if not serv.router.open():
+			return False
+		serv.router.start()
+
+		service = self.cls(serv)
+
+		def stop_service(*args):
+			service.done = True
+
+		def log_stats(*args):
+			stats = service.get_stats()
+			LOG.info("Stats {}: ".format(self.name) + " ".join(
+				"{}={}".format(k, v)
+				for k,v in sorted(stats.items())))
+			if hasattr(service, 'log_call_stats'):
+				service.log_call_stats()
+
+		signal.signal(signal.SIGTERM, stop_service)
+		signal.signal(signal.SIGHUP, stop_service)
+		signal.signal(signal.SIGUSR1, log_stats)
+
+		# Stop service if parent process terminates
+		ppid = os.getppid()
+		def watch_parent():
+			while os.getppid() == ppid:
+				time_sleep(1)
+			LOG.warning("{}: parent terminated".format(self.name))
+			service.done = True
+
+		threading.Thread(target=watch_parent,
+				daemon=True).start()
+
+		# The service processes export their metrics
+		# after the ports/sockets of the workers.
+		index = max(self.conf.server_workers, 1)
+		if self.name == 'audioserver':
+			index += 1
+		exporter = Metrics.start_exporter(self.conf, index,
+				service.get_stats)
+
+		service.run()
+
+		if exporter:
+			exporter.stop()
+
+		serv.router.done = True
+		return True
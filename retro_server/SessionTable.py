@@ -0,0 +1,209 @@
+import threading
+import logging
+
+from time import monotonic
+from hashlib import blake2b
+
+from libretro.crypto import random_buffer
+
+"""\
+Session table, used to authorize file- and audioserver
+connections in O(1).
+
+Tokens are handed out over the authenticated chat connection:
+
+  - Transfer tokens are sent with T_SUCCESS at the end of the
+    chat handshake and are valid until the client disconnects.
+    A client passes it in the initial fileserver packet.
+  - Invitations are recorded for each T_START_CALL, key is
+    derived from call id and callee (see invite_key), the
+    users are caller and callee.
+  - Call tokens are the call ids confirmed by the callee's
+    T_ACCEPT_CALL of an invitation. They are valid for all
+    partners of the call.
+
+Invitations and call tokens expire after [default] token_ttl
+seconds. Each token has a kind (TRANSFER, CALL or INVITE) and
+is only accepted by the listener it was issued for, a call id
+doesn't authorize fileserver connections. A token is never
+replaced by a token of another kind.
+
+Connections without a token are authorized by the address
+index (host -> connected clients) as a fallback.
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+TOKEN_SIZE = 16
+
+
+class SessionTable:
+
+	# Token kinds
+	TRANSFER = 1
+	CALL     = 2
+	INVITE   = 3
+
+	def __init__(self):
+
+		# Address index, key=host, value=dict(userid:conn)
+		self.hosts = {}
+
+		# Tokens, key=token, value=(kind, userids, expiry
+		# time). Expiry time is None for tokens valid until
+		# the user disconnects.
+		self.tokens = {}
+
+		# Tokens of each user, key=userid, value=set(tokens)
+		self.user_tokens = {}
+
+		# Time of next purge of expired tokens
+		self.next_purge = 0
+
+		self.lock = threading.Lock()
+
+
+	def add(self, conn, host):
+		"""\
+		Add client connection to address index.
+		"""
+		with self.lock:
+			self.hosts.setdefault(host, {})[conn.userid] = conn
+
+
+	def remove(self, conn, host):
+		"""\
+		Remove client connection from address index and
+		revoke all its tokens.
+		"""
+		with self.lock:
+			conns = self.hosts.get(host)
+			if conns and conns.get(conn.userid) is conn:
+				conns.pop(conn.userid)
+				if not conns:
+					self.hosts.pop(host)
+		self.revoke_tokens(conn.userid)
+
+
+	def get_by_address(self, host):
+		"""\
+		Get a connection by (ip-)address or None.
+		"""
+		conns = self.hosts.get(host)
+		if conns:
+			for conn in list(conns.values()):
+				return conn
+		return None
+
+
+	def issue_token(self, userid):
+		"""\
+		Create a transfer token, valid until given user
+		disconnects.
+		Return:
+		  Token (16 byte)
+		"""
+		token = random_buffer(TOKEN_SIZE)
+		self.add_token(token, SessionTable.TRANSFER, [userid])
+		return token
+
+
+	def add_token(self, token, kind, userids, ttl=None):
+		"""\
+		Add token for given users.
+		Args:
+		  token:   Token buffer
+		  kind:    TRANSFER, CALL or INVITE
+		  userids: List of userids
+		  ttl:     Seconds the token is valid or None
+		           (valid until users disconnect)
+		Return:
+		  False if the token exists with another kind
+		"""
+		expires = monotonic() + ttl if ttl else None
+		with self.lock:
+			entry = self.tokens.get(token)
+			if entry and entry[0] != kind:
+				LOG.warning("SessionTable: token exists "\
+					"with other kind, ignored")
+				return False
+			self.tokens[token] = (kind, tuple(userids), expires)
+			for userid in userids:
+				self.user_tokens.setdefault(userid,
+						set()).add(token)
+		if expires:
+			self.__purge_expired()
+		return True
+
+
+	def check_token(self, token, kind):
+		"""\
+		Get the users of given token.
+		Args:
+		  token: Token buffer
+		  kind:  Expected kind (TRANSFER, CALL or INVITE)
+		Return:
+		  Tuple with userids or None if token is invalid,
+		  expired or of another kind.
+		"""
+		entry = self.tokens.get(token)
+		if not entry:
+			return None
+
+		token_kind,userids,expires = entry
+		if token_kind != kind:
+			return None
+		if expires and expires < monotonic():
+			self.__remove_token(token)
+			return None
+		return userids
+
+
+	@staticmethod
+	def invite_key(callid, userid):
+		"""\
+		Get the key of the invitation of given user to
+		a call.
+		"""
+		return blake2b(callid + userid,
+				digest_size=TOKEN_SIZE).digest()
+
+
+	def revoke_tokens(self, userid):
+		"""\
+		Remove all tokens of given user.
+		"""
+		with self.lock:
+			tokens = self.user_tokens.pop(userid, ())
+		for token in tokens:
+			self.__remove_token(token)
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __remove_token(self, token):
+		with self.lock:
+			entry = self.tokens.pop(token, None)
+			if not entry:
+				return
+			for userid in entry[1]:
+				tokens = self.user_tokens.get(userid)
+				if tokens:
+					tokens.discard(token)
+
+
+	def __purge_expired(self):
+		"""\
+		Remove expired tokens, at most once a second.
+		"""
+		now = monotonic()
+		if now < self.next_purge:
+			return
+		self.next_purge = now + 1
+
+		with self.lock:
+			expired = [t for t,(_,_,exp) in self.tokens.items()
+					if exp and exp < now]
+		for token in expired:
+			self.__remove_token(token)
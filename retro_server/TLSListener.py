@@ -1,4 +1,5 @@
 from socket import socket, AF_INET, SOCK_STREAM, create_connection
+from socket import SOL_SOCKET, SO_REUSEPORT
 from ssl import SSLContext, PROTOCOL_TLS_SERVER, SSLError
 import logging
 
@@ -29,9 +30,13 @@ class TLSListener:
 		self.ssl  = SSLContext(PROTOCOL_TLS_SERVER)
 
 
-	def listen(self, backlog=10):
+	def listen(self, backlog=10, reuse_port=False):
 		"""\
 		Set server into listen mode.
+		Args:
+		  backlog:    Listen backlog
+		  reuse_port: Set SO_REUSEPORT, so several worker
+		              processes can share the listen port.
 		"""
 		listen_host = self.conf.server_address
 		listen_port = self.conf.server_port\
@@ -43,6 +48,8 @@ class TLSListener:
 				self.conf.keyfile)
 
 			fd = socket(AF_INET, SOCK_STREAM)
+			if reuse_port:
+				fd.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
 			self.serv = self.ssl.wrap_socket(
 					fd, server_side=True)
 			self.serv.bind((listen_host,listen_port))
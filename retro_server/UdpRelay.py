@@ -0,0 +1,344 @@
+import socket
+import selectors
+import struct
+import threading
+import logging
+
+from time import monotonic
+
+"""\
+UDP relay for audio calls ([audioserver] udp).
+
+Voice over TCP suffers from head-of-line blocking, a single
+lost segment stalls the stream. The UDP relay forwards the
+datagrams of a call between both partners, similar to TURN.
+It listens at the audioserver port (UDP). TCP stays
+available as fallback.
+
+Datagrams start with a single byte type:
+
+  T_JOIN  callid(16)
+          Join call, authorized like TCP connections (see
+          AudioServer.authorize). The server answers with
+          T_JOIN + status(1), 0x01 if the partner joined,
+          0x02 if refused. Clients repeat T_JOIN until they
+          got an answer, a waiting client gets no answer.
+  T_DATA  seq(4) + timestamp(4) + payload
+          Audio data, forwarded unchanged to the partner.
+          The sequence number and the sender's timestamp
+          (milliseconds) are used for the loss and jitter
+          counters of each direction.
+  T_BYE   Leave call
+
+Calls whose partner doesn't join within RENDEZVOUS_TIMEOUT
+or which are idle for IDLE_TIMEOUT seconds are removed.
+
+"""
+
+LOG = logging.getLogger(__name__)
+
+T_JOIN = 0x01
+T_DATA = 0x02
+T_BYE  = 0x03
+
+DATA_HEADER = struct.Struct('!BII')
+
+MAX_DATAGRAM = 0x10000
+
+# Max. datagrams handled per wakeup
+BATCH_SIZE = 64
+
+RENDEZVOUS_TIMEOUT = 10
+IDLE_TIMEOUT = 30
+
+
+class UdpLeg:
+	"""\
+	Participant of an UDP call, counters are for the
+	datagrams received from this participant.
+	"""
+	def __init__(self, call, addr, userid):
+		self.call      = call
+		self.addr      = addr	# (host, port)
+		self.userid    = userid
+		self.peer      = None	# Partner (UdpLeg)
+		self.npackets  = 0	# Datagrams received
+		self.nbytes    = 0	# Bytes received
+		self.first_seq = None	# First sequence number
+		self.max_seq   = 0	# Highest sequence number
+		self.jitter    = 0.0	# Interarrival jitter (ms)
+		self.transit   = None	# Last transit time (ms)
+		self.last_seen = monotonic()
+
+
+	def account(self, seq, timestamp):
+		"""\
+		Update counters with received datagram. The jitter
+		is estimated as in RFC 3550.
+		"""
+		self.npackets += 1
+		if self.first_seq is None:
+			self.first_seq = seq
+			self.max_seq   = seq
+		elif seq > self.max_seq:
+			self.max_seq = seq
+
+		transit = monotonic() * 1000 - timestamp
+		if self.transit is not None:
+			d = abs(transit - self.transit)
+			self.jitter += (d - self.jitter) / 16
+		self.transit = transit
+
+
+	def get_lost(self):
+		""" Returns number of lost datagrams """
+		if self.first_seq is None:
+			return 0
+		expected = self.max_seq - self.first_seq + 1
+		return max(expected - self.npackets, 0)
+
+
+
+class UdpCall:
+	def __init__(self, callid):
+		self.callid  = callid
+		self.legs    = []
+		self.created = monotonic()
+
+
+
+class UdpRelay(threading.Thread):
+
+	def __init__(self, audioserver):
+		"""\
+		Args:
+		  audioserver: AudioServer instance
+		"""
+		super().__init__(daemon=True)
+		self.aserv = audioserver
+		self.conf  = audioserver.conf
+		self.sock  = None
+
+		self.calls = {}		# key=callid, value=UdpCall
+		self.addrs = {}		# key=address, value=UdpLeg
+
+		# Counters of finished calls
+		self.ncalls   = 0
+		self.npackets = 0
+		self.nbytes   = 0
+		self.nlost    = 0
+		self.ndropped = 0	# Datagrams without call
+
+		self.done = False
+
+
+	def open(self):
+		"""\
+		Bind the UDP socket.
+		"""
+		try:
+			self.sock = socket.socket(socket.AF_INET,
+					socket.SOCK_DGRAM)
+			self.sock.bind((self.conf.server_address,
+					self.conf.audioserver_port))
+			self.sock.setblocking(False)
+		except Exception as e:
+			LOG.error("UdpRelay.open: " + str(e))
+			return False
+
+		LOG.info("Starting UDP audio relay at {}:{}".format(
+			self.conf.server_address,
+			self.conf.audioserver_port))
+		return True
+
+
+	def stop(self):
+		self.done = True
+		if self.is_alive():
+			self.join()
+
+
+	def run(self):
+		selector = selectors.DefaultSelector()
+		selector.register(self.sock, selectors.EVENT_READ)
+		buf  = bytearray(MAX_DATAGRAM)
+		view = memoryview(buf)
+		next_sweep = monotonic() + 1
+
+		while not self.done:
+			try:
+				if selector.select(timeout=1):
+					# Handle all queued datagrams,
+					# up to BATCH_SIZE.
+					for i in range(BATCH_SIZE):
+						try:
+							n,addr = self.sock.recvfrom_into(buf)
+						except (BlockingIOError,
+							InterruptedError):
+							break
+						if n:
+							self.__handle(view[:n], addr)
+
+				if monotonic() >= next_sweep:
+					self.__expire_calls()
+					next_sweep = monotonic() + 1
+
+			except Exception as e:
+				LOG.error("UdpRelay.run: " + str(e))
+
+		for call in list(self.calls.values()):
+			self.__remove_call(call)
+		selector.close()
+		self.sock.close()
+
+
+	def get_stats(self):
+		"""\
+		Returns dictionary with statistics of running and
+		finished UDP calls.
+		"""
+		legs = list(self.addrs.values())
+		jitter = [l.jitter for l in legs if l.npackets > 1]
+		return {
+			'udp_calls'       : len(self.calls),
+			'udp_calls_total' : self.ncalls,
+			'udp_packets'     : self.npackets\
+						+ sum(l.npackets for l in legs),
+			'udp_bytes'       : self.nbytes\
+						+ sum(l.nbytes for l in legs),
+			'udp_lost'        : self.nlost\
+						+ sum(l.get_lost() for l in legs),
+			'udp_dropped'     : self.ndropped,
+			'udp_jitter_ms'   : round(sum(jitter)/len(jitter), 1)\
+						if jitter else 0
+		}
+
+
+	#--- PRIVATE ---------------------------------------------------------
+
+	def __handle(self, data, addr):
+		"""\
+		Handle received datagram.
+		"""
+		typ = data[0]
+		leg = self.addrs.get(addr)
+
+		if typ == T_DATA:
+			if not leg or not leg.peer\
+			   or len(data) < DATA_HEADER.size:
+				self.ndropped += 1
+				return
+			_,seq,ts = DATA_HEADER.unpack_from(data)
+			leg.account(seq, ts)
+			leg.nbytes   += len(data)
+			leg.last_seen = monotonic()
+			try:
+				self.sock.sendto(data, leg.peer.addr)
+			except (BlockingIOError, InterruptedError):
+				pass	# Dropped like on the network
+			except OSError as e:
+				LOG.debug("UdpRelay: sendto, " + str(e))
+
+		elif typ == T_JOIN:
+			if len(data) != 17:
+				return
+			if leg:
+				# Repeated join
+				if leg.peer:
+					self.__reply(addr, 0x01)
+				return
+			self.__join(bytes(data[1:17]), addr)
+
+		elif typ == T_BYE:
+			if leg:
+				self.__remove_call(leg.call)
+
+		else:
+			self.ndropped += 1
+
+
+	def __join(self, callid, addr):
+		"""\
+		Add participant to call.
+		"""
+		call = self.calls.get(callid)
+		if not call:
+			max_calls = self.conf.audioserver_max_calls
+			if max_calls and len(self.calls) >= max_calls:
+				LOG.warning("UdpRelay: Too many calls, refused "\
+					"{}".format(addr[0]))
+				self.__reply(addr, 0x02)
+				return
+			call = UdpCall(callid)
+
+		userid = None
+		if len(call.legs) < 2:
+			userid = self.aserv.authorize(callid, addr[0],
+				[l.userid for l in call.legs])
+		if not userid:
+			LOG.warning("UdpRelay: No perm {}".format(addr[0]))
+			self.__reply(addr, 0x02)
+			return
+
+		leg = UdpLeg(call, addr, userid)
+		call.legs.append(leg)
+		self.calls[callid] = call
+		self.addrs[addr]   = leg
+
+		if len(call.legs) == 2:
+			a,b = call.legs
+			a.peer,b.peer = b,a
+			for l in call.legs:
+				l.last_seen = monotonic()
+				self.__reply(l.addr, 0x01)
+			LOG.debug("UdpRelay: call {} started".format(
+				callid.hex()[:16]))
+
+
+	def __reply(self, addr, status):
+		try:
+			self.sock.sendto(bytes([T_JOIN, status]), addr)
+		except OSError as e:
+			LOG.debug("UdpRelay: sendto, " + str(e))
+
+
+	def __expire_calls(self):
+		"""\
+		Remove calls whose partner didn't join or which
+		are idle.
+		"""
+		now = monotonic()
+		for call in list(self.calls.values()):
+			if len(call.legs) < 2:
+				expired = now - call.created > RENDEZVOUS_TIMEOUT
+				if expired:
+					for l in call.legs:
+						self.__reply(l.addr, 0x02)
+			else:
+				expired = all(now - l.last_seen > IDLE_TIMEOUT
+						for l in call.legs)
+			if expired:
+				self.__remove_call(call)
+
+
+	def __remove_call(self, call):
+		"""\
+		Remove call and add its counters to the totals.
+		"""
+		if self.calls.get(call.callid) is not call:
+			return
+		del self.calls[call.callid]
+
+		for leg in call.legs:
+			self.addrs.pop(leg.addr, None)
+			self.npackets += leg.npackets
+			self.nbytes   += leg.nbytes
+			self.nlost    += leg.get_lost()
+
+		if len(call.legs) == 2:
+			self.ncalls += 1
+		LOG.debug("UdpRelay: call {} finished, {}".format(
+			call.callid.hex()[:16], ", ".join(
+			"{}: {} packets, {} lost, jitter {:.1f} ms".format(
+			l.userid.hex(), l.npackets, l.get_lost(), l.jitter)
+			for l in call.legs)))
@@ -0,0 +1,648 @@
+from os.path import join as path_join
+from os.path import exists as path_exists
+from os import remove as os_remove
+import os
+from time import time
+import hashlib
+import logging
+import sqlite3
+
+from . MsgStore import DB_TIMEOUT
+
+
+LOG = logging.getLogger(__name__)
+
+
+"""\
+Keeps track of the files in uploaddir.
+
+A file is received to uploaddir/<fileid>.part and renamed to
+uploaddir/<fileid> once it's complete. With [fileserver]
+sharded enabled, files are spread over a two-level directory
+tree uploaddir/<h[0:2]>/<h[2:4]>/<fileid>, where h is a hash
+of the fileid (see get_path). Existing files are moved to
+the configured layout by migrate().
+
+With deduplication enabled ([fileserver] dedup), complete
+files are content-addressed: The file is hardlinked to the
+blob uploaddir/blobs/<d[0:2]>/<d[2:4]>/<d> of its SHA-256
+digest d. If the blob exists already, the file is replaced
+by a link to it. Blobs without references are removed by
+collect_blobs().
+
+The state of each upload is stored in a sqlite db
+(uploads.db) with the following schema:
+
+  +--------------------------------------------------------------------------+
+  | uploads                                                                  |
+  +--------+------+-------+----------+-------+---------+--------+------------+
+  | fileid | size | nrecv | complete | token | expires | nparts | recipients |
+  | PK     | INT  | INT   | INT      | BLOB  | REAL    | INT    | INT        |
+  +--------+------+-------+----------+-------+---------+--------+------------+
+
+  size        Announced filesize
+  nrecv       Number of bytes received (partial uploads)
+  complete    1 if upload is complete, else 0
+  token       Resume token of partial upload
+  expires     Time (unix) a partial upload or a file with
+              fan-out is deleted
+  nparts      Number of parts (chunked uploads), else 0
+  recipients  Downloads left of file with fan-out, 0 if
+              unlimited, NULL if file is deleted after the
+              first download.
+  digest      SHA-256 of deduplicated file (see blobs)
+  checksum    SHA-256 given by the uploader, verified on
+              upload
+  completed   Time (unix) the upload was completed, files
+              are aged by it (the mtime of a deduplicated
+              file is the one of its blob)
+
+  +--------------+
+  | parts        |
+  +--------+-----+
+  | fileid | idx |
+  | BLOB   | INT |
+  +--------+-----+
+
+  Parts of chunked uploads, which have been received.
+
+  +---------------------+
+  | blobs               |
+  +--------+------+------+
+  | digest | size | refs |
+  | PK     | INT  | INT  |
+  +--------+------+------+
+
+  Blobs of deduplicated files and number of files
+  referencing them.
+
+"""
+class UploadStore:
+
+	CREATE_TABLE_UPLOADS = '''CREATE TABLE IF NOT EXISTS uploads (
+			fileid BLOB PRIMARY KEY,
+			size INTEGER NOT NULL,
+			nrecv INTEGER NOT NULL DEFAULT 0,
+			complete INTEGER NOT NULL DEFAULT 0,
+			token BLOB,
+			expires REAL,
+			nparts INTEGER NOT NULL DEFAULT 0,
+			recipients INTEGER,
+			digest BLOB,
+			checksum BLOB,
+			completed REAL);'''
+
+	# Columns added after the first version of the table,
+	# they are added to existing dbs on open.
+	UPLOADS_NEW_COLUMNS = (
+		('nparts', 'INTEGER NOT NULL DEFAULT 0'),
+		('recipients', 'INTEGER'),
+		('digest', 'BLOB'),
+		('checksum', 'BLOB'),
+		('completed', 'REAL')
+	)
+
+	CREATE_TABLE_BLOBS = '''CREATE TABLE IF NOT EXISTS blobs (
+			digest BLOB PRIMARY KEY,
+			size INTEGER NOT NULL,
+			refs INTEGER NOT NULL DEFAULT 0);'''
+
+	CREATE_TABLE_PARTS = '''CREATE TABLE IF NOT EXISTS parts (
+			fileid BLOB NOT NULL,
+			idx INTEGER NOT NULL,
+			PRIMARY KEY (fileid, idx));'''
+
+	def __init__(self, conf):
+		"""\
+		Args:
+		  conf: ServerConfig instance
+		"""
+		self.conf = conf
+		self.path = conf.uploaddb
+		# Columns of existing db checked?
+		self.columns_checked = False
+
+
+	def get_path(self, fileid, sharded=None):
+		"""\
+		Returns path of complete file.
+		Args:
+		  fileid:  Id of file
+		  sharded: Use sharded layout, default is the
+		           configured layout
+		"""
+		if sharded is None:
+			sharded = self.conf.fileserver_sharded
+		if not sharded:
+			return path_join(self.conf.uploaddir, fileid.hex())
+
+		h = hashlib.blake2s(fileid, digest_size=2).hexdigest()
+		return path_join(self.conf.uploaddir, h[0:2], h[2:4],
+				fileid.hex())
+
+
+	def make_dirs(self, fileid):
+		"""\
+		Create the directory of given file, if missing.
+		"""
+		if self.conf.fileserver_sharded:
+			os.makedirs(os.path.dirname(self.get_path(fileid)),
+					exist_ok=True)
+
+
+	def get_partial_path(self, fileid):
+		"""\
+		Returns path of partial file.
+		"""
+		return self.get_path(fileid) + ".part"
+
+
+	def get_blob_path(self, digest):
+		"""\
+		Returns path of blob with given digest.
+		"""
+		d = digest.hex()
+		return path_join(self.conf.uploaddir, "blobs",
+				d[0:2], d[2:4], d)
+
+
+	def get(self, fileid):
+		"""\
+		Get upload entry by fileid.
+		Return:
+		  Dictionary with keys 'size', 'nrecv', 'complete',
+		  'token', 'expires', 'nparts', 'recipients',
+		  'checksum', 'completed' or None if not found.
+		"""
+		db = self.__open()
+		if not db: return None
+		row = db.execute("SELECT size,nrecv,complete,token,"\
+			"expires,nparts,recipients,checksum,completed "\
+			"FROM uploads WHERE fileid=?;",
+			(fileid,)).fetchone()
+		db.close()
+
+		if not row:
+			return None
+		return {
+			'size'     : row[0],
+			'nrecv'    : row[1],
+			'complete' : bool(row[2]),
+			'token'    : row[3],
+			'expires'  : row[4],
+			'nparts'   : row[5],
+			'recipients' : row[6],
+			'checksum' : row[7],
+			'completed' : row[8]
+		}
+
+
+	def add_partial(self, fileid, size, token, ttl):
+		"""\
+		Add (or reset) entry for partial upload. The digest
+		of a former file with this id is kept, so add_blob
+		or delete release its blob.
+		"""
+		db = self.__open()
+		if not db: return False
+		db.execute("INSERT OR IGNORE INTO uploads "\
+			"(fileid,size) VALUES (?,?);", (fileid, size))
+		db.execute("UPDATE uploads SET size=?, nrecv=0, "\
+			"complete=0, token=?, expires=?, nparts=0, "\
+			"recipients=NULL, checksum=NULL, completed=NULL "\
+			"WHERE fileid=?;", (size, token, time()+ttl, fileid))
+		db.commit()
+		db.close()
+		return True
+
+
+	def begin_parts(self, fileid, size, nparts, ttl):
+		"""\
+		Add entry for chunked upload, if it doesn't exist
+		yet and extend its expiry time.
+		Return:
+		  True on success, False if an upload with other
+		  size or number of parts exists.
+		"""
+		db = self.__open()
+		if not db: return False
+		db.execute("BEGIN IMMEDIATE;")
+		db.execute("INSERT OR IGNORE INTO uploads "\
+			"(fileid,size,nparts,expires) VALUES (?,?,?,?);",
+			(fileid, size, nparts, time()+ttl))
+		row = db.execute("SELECT size,nparts,complete FROM "\
+			"uploads WHERE fileid=?;", (fileid,)).fetchone()
+		ok = row and row[0] == size and row[1] == nparts\
+			and not row[2]
+		if ok:
+			db.execute("UPDATE uploads SET expires=? "\
+				"WHERE fileid=?;", (time()+ttl, fileid))
+		db.commit()
+		db.close()
+		return ok
+
+
+	def add_part(self, fileid, idx):
+		"""\
+		Mark part of chunked upload as received.
+		Return:
+		  (nrecv, nparts): Number of received parts and
+		                   number of all parts
+		"""
+		db = self.__open()
+		if not db: return (0, 0)
+		db.execute("BEGIN IMMEDIATE;")
+		db.execute("INSERT OR IGNORE INTO parts VALUES (?,?);",
+			(fileid, idx))
+		nrecv = db.execute("SELECT COUNT(*) FROM parts "\
+			"WHERE fileid=?;", (fileid,)).fetchone()[0]
+		row = db.execute("SELECT nparts FROM uploads "\
+			"WHERE fileid=?;", (fileid,)).fetchone()
+		db.commit()
+		db.close()
+		return nrecv, row[0] if row else 0
+
+
+	def set_received(self, fileid, nrecv, ttl):
+		"""\
+		Update number of received bytes of partial upload
+		and extend its expiry time.
+		"""
+		return self.__execute("UPDATE uploads SET nrecv=?, "\
+			"expires=? WHERE fileid=?;",
+			(nrecv, time()+ttl, fileid))
+
+
+	def set_complete(self, fileid, size):
+		"""\
+		Mark upload as complete, an entry is added if
+		missing. The time of completion is stored. The
+		checksum of a former file is cleared, set_checksum
+		stores the one of the new file.
+		"""
+		db = self.__open()
+		if not db: return False
+		db.execute("DELETE FROM parts WHERE fileid=?;",
+			(fileid,))
+		db.execute("INSERT OR IGNORE INTO uploads "\
+			"(fileid,size) VALUES (?,?);", (fileid, size))
+		db.execute("UPDATE uploads SET complete=1, size=?, "\
+			"nrecv=?, token=NULL, expires=NULL, checksum=NULL, "\
+			"completed=? WHERE fileid=?;",
+			(size, size, time(), fileid))
+		db.commit()
+		db.close()
+		return True
+
+
+	def set_completed(self, fileid, size, completed):
+		"""\
+		Set completion time of a complete file which has
+		none yet (file of an older version).
+		"""
+		db = self.__open()
+		if not db: return False
+		db.execute("INSERT OR IGNORE INTO uploads "\
+			"(fileid,size,nrecv,complete) VALUES (?,?,?,1);",
+			(fileid, size, size))
+		db.execute("UPDATE uploads SET completed=? WHERE "\
+			"fileid=? AND completed IS NULL;",
+			(completed, fileid))
+		db.commit()
+		db.close()
+		return True
+
+
+	def get_completed(self):
+		"""\
+		Returns dictionary with the completion time of all
+		complete uploads, key=fileid. The value is None for
+		files completed by an older version.
+		"""
+		db = self.__open()
+		if not db: return {}
+		rows = db.execute("SELECT fileid,completed FROM uploads "\
+			"WHERE complete=1;").fetchall()
+		db.close()
+		return dict(rows)
+
+
+	def set_fanout(self, fileid, size, count, ttl):
+		"""\
+		Register complete upload (see set_complete) for
+		several downloads.
+		Args:
+		  fileid: Id of file
+		  size:   Filesize
+		  count:  Number of downloads (0 = unlimited)
+		  ttl:    Seconds until the file is deleted
+		          (0 = never)
+		"""
+		expires = time() + ttl if ttl else None
+		return self.__execute("UPDATE uploads SET expires=?, "\
+			"recipients=? WHERE fileid=?;",
+			(expires, count, fileid))
+
+
+	def count_download(self, fileid):
+		"""\
+		Count complete download of a file.
+		Return:
+		  True if the file may be deleted, i.e. it has no
+		  fan-out or this was its last download.
+		"""
+		db = self.__open()
+		if not db: return True
+		db.execute("BEGIN IMMEDIATE;")
+		row = db.execute("SELECT recipients FROM uploads "\
+			"WHERE fileid=?;", (fileid,)).fetchone()
+		if not row or row[0] is None:
+			last = True
+		elif row[0] == 0:
+			last = False
+		else:
+			last = row[0] == 1
+			db.execute("UPDATE uploads SET recipients=? "\
+				"WHERE fileid=?;", (row[0]-1, fileid))
+		db.commit()
+		db.close()
+		return last
+
+
+	def set_checksum(self, fileid, size, checksum):
+		"""\
+		Store the SHA-256 checksum of a file. If the file
+		has no entry yet, it's added as complete file.
+		"""
+		db = self.__open()
+		if not db: return False
+		db.execute("INSERT OR IGNORE INTO uploads "\
+			"(fileid,size,nrecv,complete) VALUES (?,?,?,1);",
+			(fileid, size, size))
+		db.execute("UPDATE uploads SET checksum=? "\
+			"WHERE fileid=?;", (checksum, fileid))
+		db.commit()
+		db.close()
+		return True
+
+
+	def add_blob(self, fileid, size, digest):
+		"""\
+		Add complete file to the blob store. If a blob with
+		the same digest exists, the file is replaced by a
+		link to the blob, else the file becomes the blob.
+		Return:
+		  True if the file was a duplicate, else False
+		"""
+		path = self.get_path(fileid)
+		blob = self.get_blob_path(digest)
+
+		db = self.__open()
+		if not db: return False
+
+		# The blob must not be collected while linking
+		db.execute("BEGIN IMMEDIATE;")
+		try:
+			duplicate = path_exists(blob)
+			if duplicate:
+				tmppath = path + ".link"
+				os.link(blob, tmppath)
+				os.replace(tmppath, path)
+			else:
+				os.makedirs(os.path.dirname(blob),
+						exist_ok=True)
+				os.link(path, blob)
+
+			# Release blob of a former file with this id
+			row = db.execute("SELECT digest FROM uploads "\
+				"WHERE fileid=?;", (fileid,)).fetchone()
+			if row and row[0]:
+				db.execute("UPDATE blobs SET refs=refs-1 "\
+					"WHERE digest=?;", (row[0],))
+
+			db.execute("INSERT OR IGNORE INTO blobs "\
+				"(digest,size) VALUES (?,?);", (digest, size))
+			db.execute("UPDATE blobs SET refs=refs+1 "\
+				"WHERE digest=?;", (digest,))
+			db.execute("INSERT OR IGNORE INTO uploads "\
+				"(fileid,size,nrecv,complete) "\
+				"VALUES (?,?,?,1);", (fileid, size, size))
+			db.execute("UPDATE uploads SET digest=? "\
+				"WHERE fileid=?;", (digest, fileid))
+			db.commit()
+		except Exception as e:
+			LOG.error("UploadStore.add_blob: " + str(e))
+			db.rollback()
+			duplicate = False
+		db.close()
+		return duplicate
+
+
+	def collect_blobs(self):
+		"""\
+		Delete blobs which aren't referenced by any file.
+		Return:
+		  (nblobs, nbytes): Number and size of deleted blobs
+		"""
+		db = self.__open()
+		if not db: return (0, 0)
+
+		db.execute("BEGIN IMMEDIATE;")
+		rows = db.execute("SELECT digest,size FROM blobs "\
+			"WHERE refs<=0;").fetchall()
+		nbytes = 0
+		for digest,size in rows:
+			try:
+				os_remove(self.get_blob_path(digest))
+			except FileNotFoundError:
+				pass
+			except Exception as e:
+				LOG.warning("UploadStore.collect_blobs: "+str(e))
+				continue
+			db.execute("DELETE FROM blobs WHERE digest=?;",
+				(digest,))
+			nbytes += size
+		db.commit()
+		db.close()
+
+		if rows:
+			LOG.debug("UploadStore: collected {} blobs, {} "\
+				"byte".format(len(rows), nbytes))
+		return len(rows), nbytes
+
+
+	def get_blob_stats(self):
+		"""\
+		Returns dictionary with statistics of the blob store.
+		The dedup ratio is the size of all files divided by
+		the size of the stored blobs.
+		"""
+		db = self.__open()
+		if not db: return {}
+		row = db.execute("SELECT COUNT(*), SUM(size), "\
+			"SUM(size*refs) FROM blobs WHERE refs>0;").fetchone()
+		db.close()
+
+		nblobs,stored,total = row[0], row[1] or 0, row[2] or 0
+		return {
+			'dedup_blobs'        : nblobs,
+			'dedup_stored_bytes' : stored,
+			'dedup_file_bytes'   : total,
+			'dedup_ratio'        : round(total/stored, 2)\
+						if stored else 1.0
+		}
+
+
+	def delete(self, fileid):
+		"""\
+		Delete upload entry and its (partial) file. The
+		reference to its blob is released, the blob itself
+		is removed by collect_blobs().
+		Return:
+		  Number of bytes freed
+		"""
+		nbytes = 0
+		for path in (self.get_path(fileid),
+			     self.get_partial_path(fileid)):
+			if path_exists(path):
+				try:
+					st = os.stat(path)
+					os_remove(path)
+					if st.st_nlink == 1:
+						nbytes += st.st_size
+				except Exception as e:
+					LOG.warning("UploadStore.delete: "+str(e))
+		self.__execute("DELETE FROM parts WHERE fileid=?;",
+			(fileid,))
+		self.__execute("UPDATE blobs SET refs=refs-1 WHERE "\
+			"digest=(SELECT digest FROM uploads WHERE "\
+			"fileid=?);", (fileid,))
+		self.__execute("DELETE FROM uploads WHERE fileid=?;",
+			(fileid,))
+		return nbytes
+
+
+	def delete_expired(self):
+		"""\
+		Delete all expired partial uploads and files with
+		fan-out.
+		Return:
+		  (nfiles, nbytes): Number of deleted uploads and
+		                    bytes freed
+		"""
+		db = self.__open()
+		if not db: return (0, 0)
+		rows = db.execute("SELECT fileid FROM uploads "\
+			"WHERE expires<?;", (time(),)).fetchall()
+		db.close()
+
+		nbytes = 0
+		for row in rows:
+			LOG.debug("UploadStore: upload {} expired"\
+				.format(row[0].hex()))
+			nbytes += self.delete(row[0])
+		return len(rows), nbytes
+
+
+	def iter_files(self):
+		"""\
+		Iterate over all files in uploaddir (any layout),
+		except the blobs.
+		Yield:
+		  (fileid, path, partial): fileid is None for files
+		  which aren't uploads, partial is True for partial
+		  files.
+		"""
+		top = self.conf.uploaddir
+		for dirpath,dirnames,filenames in os.walk(top):
+			if dirpath == top and "blobs" in dirnames:
+				dirnames.remove("blobs")
+			for name in filenames:
+				path    = path_join(dirpath, name)
+				partial = name.endswith(".part")
+				if partial:
+					name = name[:-5]
+				try:
+					fileid = bytes.fromhex(name)
+				except ValueError:
+					fileid = None
+				yield fileid, path, partial
+
+
+	def migrate(self):
+		"""\
+		Move all files in uploaddir to the configured
+		layout (flat or sharded). The fileserver must not
+		be running.
+		Return:
+		  Number of moved files
+		"""
+		nmoved = 0
+		for fileid,path,partial in list(self.iter_files()):
+			if not fileid:
+				continue
+			self.make_dirs(fileid)
+			if partial:
+				newpath = self.get_partial_path(fileid)
+			else:	newpath = self.get_path(fileid)
+			if path != newpath:
+				os.replace(path, newpath)
+				nmoved += 1
+
+		# Remove empty shard directories
+		top = self.conf.uploaddir
+		blobs = path_join(top, "blobs")
+		for dirpath,dirnames,filenames in os.walk(top,
+						topdown=False):
+			if dirpath == top or dirpath.startswith(blobs):
+				continue
+			try:
+				os.rmdir(dirpath)
+			except OSError:
+				pass	# Not empty
+		return nmoved
+
+
+	def __execute(self, q, args):
+		db = self.__open()
+		if not db: return False
+		db.execute(q, args)
+		db.commit()
+		db.close()
+		return True
+
+
+	def __open(self):
+		"""\
+		Opens/Creates the upload db
+		"""
+		try:
+			db = sqlite3.connect(self.path, timeout=DB_TIMEOUT,
+					check_same_thread=False)
+			db.execute("PRAGMA journal_mode=WAL;")
+			db.execute(UploadStore.CREATE_TABLE_UPLOADS)
+			db.execute(UploadStore.CREATE_TABLE_PARTS)
+			db.execute(UploadStore.CREATE_TABLE_BLOBS)
+			self.__add_new_columns(db)
+			db.commit()
+		except Exception as e:
+			LOG.error("UploadStore.open(): " + str(e))
+			db = None
+		return db
+
+
+	def __add_new_columns(self, db):
+		"""\
+		Add missing columns to table uploads of a db created
+		by an older version.
+		"""
+		if self.columns_checked:
+			return
+		cols = [r[1] for r in db.execute(
+				"PRAGMA table_info(uploads);").fetchall()]
+		for name,decl in UploadStore.UPLOADS_NEW_COLUMNS:
+			if name not in cols:
+				LOG.info("UploadStore: adding column " + name)
+				db.execute("ALTER TABLE uploads ADD COLUMN "\
+					"{} {};".format(name, decl))
+		self.columns_checked = True
@@ -21,6 +21,7 @@ HELP="""\
 
   -c, --config-dir=PATH		Basedirectory
   -R, --create-regkey=PATH	Create registration keyfile
+  -M, --migrate-uploads		Move uploads to configured layout
 """
 
 
@@ -30,10 +31,12 @@ def main():
 	argv = sys.argv[1:]
 	basedir = None
 	regkey_file = None
+	migrate = False
 
 	try:
-		opts,rem = getopt(argv, 'c:hR:',
-			['help', 'config=','create-regkey='])
+		opts,rem = getopt(argv, 'c:hR:M',
+			['help', 'config=','create-regkey=',
+			 'migrate-uploads'])
 
 	except GetoptError as ge:
 		print('Error: {}'.format(ge))
@@ -50,6 +53,9 @@ def main():
 		elif opt in ('-R', '--create-regkey'):
 			regkey_file = arg
 
+		elif opt in ('-M', '--migrate-uploads'):
+			migrate = True
+
 	if not basedir:
 		print("! Missing basedir (-c <basedir>)")
 		return
@@ -59,9 +65,11 @@ def main():
 	if not server.load():
 		return
 
-	# Create registration key or run server
+	# Create registration key, migrate uploads or run server
 	if regkey_file:
 		server.create_registration_key(regkey_file)
+	elif migrate:
+		server.migrate_uploads()
 	else:	server.run()
 
 